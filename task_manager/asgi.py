@@ -9,8 +9,23 @@ https://docs.djangoproject.com/en/3.2/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'task_manager.settings')
 
-application = get_asgi_application()
+# What get_asgi_application() does, with the handler from tasks/streams.py
+django.setup(set_prefix=False)
+
+# Imported once the apps are loaded
+from django.conf import settings  # noqa: E402
+
+from tasks.streams import TaskASGIHandler, task_events_app  # noqa: E402
+
+django_application = TaskASGIHandler()
+
+
+# The task change feed streams outside of Django's request handling
+async def application(scope, receive, send):
+    if scope['type'] == 'http' and scope['path'] == settings.TASK_EVENTS_PATH:
+        return await task_events_app(scope, receive, send)
+    return await django_application(scope, receive, send)
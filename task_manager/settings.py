@@ -10,8 +10,12 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.2/ref/settings/
 """
 
+import os
+import tempfile
 from pathlib import Path
 
+from django.core.exceptions import ImproperlyConfigured
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -43,23 +47,32 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'tasks.middleware.RequestMetricsMiddleware',
+    'tasks.middleware.CompressionMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'tasks.middleware.ShardMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
 ROOT_URLCONF = 'task_manager.urls'
 
+TEMPLATE_LOADERS = [
+    'django.template.loaders.filesystem.Loader',
+    'django.template.loaders.app_directories.Loader',
+]
+
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
         'DIRS': ["templates"],
-        'APP_DIRS': True,
         'OPTIONS': {
+            # Compiled templates are kept in memory outside of development
+            'loaders': TEMPLATE_LOADERS if DEBUG else [('django.template.loaders.cached.Loader', TEMPLATE_LOADERS)],
             'context_processors': [
                 'django.template.context_processors.debug',
                 'django.template.context_processors.request',
@@ -73,16 +86,222 @@ TEMPLATES = [
 WSGI_APPLICATION = 'task_manager.wsgi.application'
 
 
+# REST framework
+#
+# JSON goes through orjson and MessagePack is offered (Accept:
+# application/msgpack or ?format=msgpack) when those libraries are installed,
+# see tasks/renderers.py. Without them responses render as before.
+
+REST_FRAMEWORK = {
+    'DEFAULT_RENDERER_CLASSES': [
+        'tasks.renderers.FastJSONRenderer',
+        'tasks.renderers.MessagePackRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    'DEFAULT_CONTENT_NEGOTIATION_CLASS': 'tasks.renderers.AvailableRendererNegotiation',
+}
+
+
 # Database
 # https://docs.djangoproject.com/en/3.2/ref/settings/#databases
 
+#
+# Connections are kept open for TASK_DB_CONN_MAX_AGE seconds and checked at
+# the start of every request (see tasks/db.py). Setting TASK_DB_REPLICA adds
+# a 'replica' alias that the task list and history reads are routed to, a
+# user who just wrote reads from the primary for TASK_DB_PIN_SECONDS while the
+# replica catches up. With SQLite the replica is a second file kept in sync
+# by external replication (or a plain copy when trying it out locally).
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'NAME': os.environ.get('TASK_DB_NAME', BASE_DIR / 'db.sqlite3'),
+        'CONN_MAX_AGE': int(os.environ.get('TASK_DB_CONN_MAX_AGE', 60)),
+    }
+}
+
+if os.environ.get('TASK_DB_REPLICA'):
+    DATABASES['replica'] = {
+        **DATABASES['default'],
+        'NAME': os.environ['TASK_DB_REPLICA'],
+        # Tests run against the primary only
+        'TEST': {'MIRROR': 'default'},
     }
+
+# Sharding: TASK_DB_SHARDS names more SQLite files (comma separated), each
+# added as a 'shard_<n>' alias. Users' tasks are spread over 'default' and
+# those shards (see tasks/shards.py), `rebalance_shards` moves users around.
+# Each shard hands out ids from its own TASK_SHARD_ID_SPAN wide range. Writes
+# of a user being moved are refused for TASK_SHARD_FREEZE_SECONDS at the end
+# of the move, let requests in flight finish before it.
+
+for index, name in enumerate(filter(None, os.environ.get('TASK_DB_SHARDS', '').split(',')), start=1):
+    DATABASES[f'shard_{index}'] = {**DATABASES['default'], 'NAME': name}
+
+TASK_SHARDS = ['default'] + [alias for alias in DATABASES if alias.startswith('shard_')]
+TASK_SHARD_ID_SPAN = 10 ** 12
+TASK_SHARD_FREEZE_SECONDS = 2
+
+# The backends whose id sequences tasks.shards.reserve_id_ranges() can move
+TASK_SHARD_ENGINES = ('django.db.backends.sqlite3', 'django.db.backends.postgresql')
+if len(TASK_SHARDS) > 1:
+    for alias in TASK_SHARDS:
+        if DATABASES[alias]['ENGINE'] not in TASK_SHARD_ENGINES:
+            raise ImproperlyConfigured(
+                f"Sharding needs SQLite or PostgreSQL databases, {alias!r} uses {DATABASES[alias]['ENGINE']}"
+            )
+
+DATABASE_ROUTERS = ['tasks.routers.ShardRouter', 'tasks.routers.ReplicaRouter']
+
+TASK_DB_REPLICA_ALIAS = 'replica' if 'replica' in DATABASES else None
+TASK_DB_PIN_SECONDS = 10
+TASK_DB_HEALTH_CHECKS = True
+
+# Applied to every new SQLite connection. WAL lets readers run alongside the
+# single writer, busy_timeout makes writers queue instead of failing.
+TASK_SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -64 * 1024,
+    'temp_store': 'MEMORY',
+}
+
+
+# Caches
+# https://docs.djangoproject.com/en/3.2/topics/cache/
+#
+# Task reads are cached in the 'tasks' alias. Local memory is per process,
+# use TASK_CACHE_BACKEND=file (or any shared backend) with several workers.
+
+TASK_CACHE_BACKENDS = {
+    'locmem': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'tasks',
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
+    'file': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ.get('TASK_CACHE_LOCATION', BASE_DIR / 'cache' / 'tasks'),
+        'OPTIONS': {'MAX_ENTRIES': 100000},
+    },
 }
 
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'tasks': TASK_CACHE_BACKENDS[os.environ.get('TASK_CACHE_BACKEND', 'locmem')],
+}
+
+TASK_CACHE_ALIAS = 'tasks'
+TASK_CACHE_TIMEOUT = 300
+
+
+# Task history
+#
+# With write-behind on, history rows collected in a buffered_history() block
+# are inserted in bulk once the surrounding transaction commits (see
+# tasks/history.py), 'job' hands them to the background workers instead.
+# `compact_history` folds rows older than the retention window into per-task
+# summaries.
+
+TASK_HISTORY_WRITE_BEHIND = True
+TASK_HISTORY_RETENTION_DAYS = 90
+
+
+# Background jobs
+#
+# Queued in the database and run by `manage.py run_workers` (see
+# tasks/jobs.py). Failed jobs are retried after TASK_JOBS_BACKOFF seconds,
+# doubled per attempt up to TASK_JOBS_MAX_BACKOFF. TASK_JOBS_SCHEDULE maps a
+# job to (period in seconds, payload): the workers queue it once per period.
+# Finished jobs are kept TASK_JOBS_KEEP_DONE seconds, at least as long as the
+# longest period.
+
+TASK_JOBS_THREADS = 4
+TASK_JOBS_POLL_INTERVAL = 1.0
+TASK_JOBS_MAX_ATTEMPTS = 5
+TASK_JOBS_BACKOFF = 10
+TASK_JOBS_MAX_BACKOFF = 60 * 60
+TASK_JOBS_LEASE = 5 * 60
+TASK_JOBS_KEEP_DONE = 7 * 24 * 60 * 60
+TASK_JOBS_SCHEDULE = {
+    # Tombstones stay a while for delta sync clients, see tasks/sync.py
+    'archive_tasks': (24 * 60 * 60, {'days': 30}),
+    'compact_history': (24 * 60 * 60, {}),
+    'recount_tasks': (7 * 24 * 60 * 60, {}),
+}
+
+
+# Request metrics
+#
+# Every worker process dumps its per-route histograms to TASK_METRICS_DIR,
+# /metrics merges them (see tasks/metrics.py). Workers of one deployment must
+# share the directory, and it should be emptied when the deployment restarts.
+# /metrics answers staff users, and scrapers sending TASK_METRICS_TOKEN as a
+# bearer token.
+
+TASK_METRICS_DIR = os.environ.get('TASK_METRICS_DIR', Path(tempfile.gettempdir()) / 'task_manager-metrics')
+TASK_METRICS_FLUSH_INTERVAL = 1.0
+TASK_METRICS_TOKEN = os.environ.get('TASK_METRICS_TOKEN')
+
+
+# API tokens
+#
+# Signed, stateless tokens (see tasks/authentication.py). The user behind a
+# token is resolved from an in-process LRU, then the shared task cache, and
+# only then the database. Revocation is seen at once by the revoking process
+# and by the others within TASK_API_TOKEN_LOCAL_TTL seconds.
+
+TASK_API_TOKEN_MAX_AGE = 30 * 24 * 60 * 60
+TASK_API_TOKEN_LOCAL_TTL = 5
+TASK_API_TOKEN_LOCAL_SIZE = 10000
+TASK_API_TOKEN_CACHE_TIMEOUT = 300
+
+
+# Task change feed
+#
+# Server-Sent Events at TASK_EVENTS_PATH, served by the ASGI application only
+# (see task_manager/asgi.py and tasks/events.py). LocalEventBackend fans
+# events out within one process. With several web worker processes
+# (WEB_CONCURRENCY, as read by gunicorn and uvicorn) the events go through the
+# database instead, DatabaseEventBackend, where each worker polls them every
+# TASK_EVENTS_POLL_INTERVAL seconds and they are kept TASK_EVENTS_KEEP
+# seconds. Each worker keeps the last TASK_EVENTS_REPLAY_SIZE events for
+# Last-Event-ID resume, and every connection buffers at most
+# TASK_EVENTS_QUEUE_SIZE undelivered events before it is closed and left to
+# resume.
+
+WEB_CONCURRENCY = int(os.environ.get('WEB_CONCURRENCY', 1))
+
+TASK_EVENTS_BACKEND = os.environ.get(
+    'TASK_EVENTS_BACKEND',
+    'tasks.events.LocalEventBackend' if WEB_CONCURRENCY == 1 else 'tasks.events.DatabaseEventBackend',
+)
+if TASK_EVENTS_BACKEND == 'tasks.events.LocalEventBackend' and WEB_CONCURRENCY > 1:
+    raise ImproperlyConfigured(
+        f'LocalEventBackend only reaches the streams of its own process, {WEB_CONCURRENCY} web workers need '
+        'TASK_EVENTS_BACKEND = tasks.events.DatabaseEventBackend'
+    )
+TASK_EVENTS_POLL_INTERVAL = 0.5
+TASK_EVENTS_KEEP = 60 * 60
+TASK_EVENTS_PATH = '/api/v1/events/'
+TASK_EVENTS_REPLAY_SIZE = 1000
+TASK_EVENTS_QUEUE_SIZE = 100
+TASK_EVENTS_KEEPALIVE = 15
+TASK_EVENTS_RETRY = 3000
+
+
+# Delta sync
+#
+# Sync tokens stay this many seconds behind the present, so writes that commit
+# after later-stamped ones are still picked up (see tasks/sync.py).
+
+TASK_SYNC_GRACE_SECONDS = 5
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
@@ -2,7 +2,11 @@ from django.contrib import admin
 from django.contrib.auth.views import LogoutView
 from django.urls import include, path
 from rest_framework.routers import SimpleRouter
-from tasks.api_views import TaskHistoryViewSet, TaskViewSet
+from tasks import async_views
+from tasks.api_views import (ArchivedTaskViewSet, ObtainTokenView,
+                             RevokeTokensView, TaskHistoryViewSet,
+                             TaskStatusRollupViewSet, TaskViewSet)
+from tasks.metrics import metrics_view
 from tasks.views import (GenericCompleteTaskView, GenericPendingTaskView,
                          GenericTaskCreateView, GenericTaskDeleteView,
                          GenericTaskDetailView, GenericTaskUpdateView,
@@ -13,6 +17,8 @@ router = SimpleRouter()
 
 router.register(r'tasks', TaskViewSet)
 router.register(r'task/(?P<task_id>\d+)/history', TaskHistoryViewSet)
+router.register(r'analytics/rollups', TaskStatusRollupViewSet)
+router.register(r'archive/tasks', ArchivedTaskViewSet)
 
 urlpatterns = [
     path("", home_view, name="home"),
@@ -27,6 +33,12 @@ urlpatterns = [
     path("delete-task/<pk>", GenericTaskDeleteView.as_view(), name="delete_task"),
     path("completed-tasks", GenericCompleteTaskView.as_view(), name="completed_tasks"),
     path("pending-tasks", GenericPendingTaskView.as_view(), name="pending_tasks"),
+    path("metrics", metrics_view, name="metrics"),
+    path("api/v1/auth/token/", ObtainTokenView.as_view(), name="obtain_token"),
+    path("api/v1/auth/token/revoke/", RevokeTokensView.as_view(), name="revoke_tokens"),
     path("api/v1/", include(router.urls)),
+    path("api/v1/async/tasks/", async_views.task_list_view, name="async_tasks"),
+    path("api/v1/async/tasks/<int:pk>/", async_views.task_detail_view, name="async_task_detail"),
+    path("api/v1/async/task/<int:task_id>/history/", async_views.task_history_view, name="async_task_history"),
 ]
 
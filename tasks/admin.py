@@ -2,6 +2,7 @@ from django.contrib import admin
 
 # Register your models here.
 
-from tasks.models import Task
+from tasks.models import Job, Task
 
 admin.sites.site.register(Task)
+admin.sites.site.register(Job)
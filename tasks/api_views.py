@@ -1,15 +1,39 @@
 from django.db import transaction
+from django.db.models import Sum
 
 from django_filters.rest_framework import (BooleanFilter, CharFilter,
-                                           ChoiceFilter, DateRangeFilter,
+                                           ChoiceFilter, DateFromToRangeFilter,
+                                           DateRangeFilter,
                                            DjangoFilterBackend, FilterSet)
 
-from rest_framework.pagination import LimitOffsetPagination
+from django.contrib.auth import authenticate
+
+from rest_framework.decorators import action
+from rest_framework.exceptions import AuthenticationFailed, ValidationError
+from rest_framework.pagination import LimitOffsetPagination, _positive_int
 from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.views import APIView
 from rest_framework.viewsets import ModelViewSet, ReadOnlyModelViewSet
 
-from tasks.models import STATUS_CHOICES, Task, TaskHistory
-from tasks.serializers import TaskHistorySerializer, TaskSerializer
+from tasks.authentication import (SignedTokenAuthentication, issue_token,
+                                  revoke_tokens)
+
+from tasks.cache import cached_response
+from tasks.exports import export_response
+from tasks.models import (STATUS_CHOICES, ArchivedTask, Task, TaskHistory,
+                          TaskStatusRollup)
+from tasks.pagination import KeysetModeMixin, OptionalPagination
+from tasks.routers import replica_reads
+from tasks.rollups import COMPLETED
+from tasks.search import search_tasks
+from tasks.serializers import (ArchivedTaskHistorySerializer,
+                               ArchivedTaskSerializer, TaskHistorySerializer,
+                               TaskSerializer, TaskStatusRollupSerializer)
+from tasks.services import TaskService
+from tasks.shards import shard_db
+from tasks.sync import changes_since
 
 
 # Task filter
@@ -17,82 +41,193 @@ class TaskFilter(FilterSet):
     title = CharFilter(lookup_expr='icontains')
     status = ChoiceFilter(choices=STATUS_CHOICES)
     completed = BooleanFilter()
+    search = CharFilter(method='filter_search')
+
+    # Ranked full-text prefix search over title and description, see tasks/search.py
+    def filter_search(self, queryset, name, value):
+        return search_tasks(queryset, value, self.request.user)
+
+# List responses built from .values() rows, see the serializers' from_values().
+# With ?fields= only the columns of those fields are selected, plus the keyset
+# ordering the cursors are built from.
+class ValuesListMixin():
+
+    def list(self, request, *args, **kwargs):
+        serializer_class = self.get_serializer_class()
+        fields = serializer_class.requested_fields(request)
+        columns = serializer_class.columns_for(fields)
+        if fields is not None:
+            columns += tuple(field for field in getattr(self.paginator, 'keyset_ordering', ()) if field not in columns)
+        queryset = self.filter_queryset(self.get_queryset()).values(*columns)
+
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response([serializer_class.from_values(row, fields=fields) for row in page])
+
+        return Response([serializer_class.from_values(row, fields=fields) for row in queryset])
+
+# Versioned response cache with ETags for list and retrieve, see tasks/cache.py
+class CachedReadMixin():
+
+    def list(self, request, *args, **kwargs):
+        return cached_response(request, lambda: super(CachedReadMixin, self).list(request, *args, **kwargs))
 
-# Tasks utility functions 
-class TaskUtilityFunctions():
-
-    def create_task_history(self, task, old_status, new_status):
-        task_history = TaskHistory(task=task, old_status=old_status, new_status=new_status)
-        task_history.save()
-    
-    def priority_cascading_logic(self, priority, task_id=None):
-        priority = int(priority)
-        updated_tasks = []
-        with transaction.atomic():
-            tasks = Task.objects.filter(deleted=False, completed=False, user=self.request.user).exclude(pk=task_id).select_for_update().order_by('priority')
-            for task in tasks:
-                if task.priority == priority:
-                    task.priority = priority + 1
-                    priority += 1
-                    updated_tasks.append(task)
-
-            # bulk update the tasks...
-            Task.objects.bulk_update(updated_tasks, ['priority'])
-
-# Task pagination
-class TaskPagination(LimitOffsetPagination):
+    def retrieve(self, request, *args, **kwargs):
+        return cached_response(request, lambda: super(CachedReadMixin, self).retrieve(request, *args, **kwargs))
+
+# List reads from the replica database unless the user just wrote, see tasks/routers.py
+class ReplicaReadMixin():
+
+    def list(self, request, *args, **kwargs):
+        with replica_reads(request.user):
+            return super(ReplicaReadMixin, self).list(request, *args, **kwargs)
+
+# Task pagination, keyset pages on (priority, id) when `?cursor=` is passed
+class TaskPagination(KeysetModeMixin, LimitOffsetPagination):
     default_limit = 5
     max_limit = 20
 
+    keyset_ordering = ('priority', 'id')
+    keyset_default_limit = default_limit
+    keyset_max_limit = max_limit
+
 # Task viewset
-class TaskViewSet(ModelViewSet, TaskUtilityFunctions):
+class TaskViewSet(CachedReadMixin, ReplicaReadMixin, ValuesListMixin, ModelViewSet):
     queryset = Task.objects.all()
     serializer_class = TaskSerializer
 
+    authentication_classes = api_settings.DEFAULT_AUTHENTICATION_CLASSES + [SignedTokenAuthentication]
     permission_classes = [IsAuthenticated]
     filter_backends = [DjangoFilterBackend]
     filterset_class = TaskFilter
 
     pagination_class = TaskPagination
 
+    batch_max_items = 500
+    sync_default_limit = 500
+    sync_max_limit = 1000
+
     def get_queryset(self):
-        return Task.objects.filter(user=self.request.user, deleted=False)
+        return Task.objects.filter(user=self.request.user).select_related(
+            *self.serializer_class.select_related_fields
+        )
 
-    def create(self, request, *args, **kwargs):
-        # Apply priority cascading
-        self.priority_cascading_logic(request.data['priority'])
+    # Writes go through TaskService, DRF's create/update/destroy load the task once
+    def perform_create(self, serializer):
+        serializer.instance = TaskService(self.request.user).create(serializer.validated_data)
 
-        return super().create(request, *args, **kwargs)
+    def perform_update(self, serializer):
+        serializer.instance = TaskService(self.request.user).update(serializer.instance, serializer.validated_data)
 
-    def perform_create(self, serializer):
-        serializer.save(user=self.request.user)
-   
-    def update(self, request, *args, **kwargs):
-        # Get the current active task instance
-        task = self.get_object()
+    def perform_destroy(self, instance):
+        TaskService(self.request.user).delete(instance)
 
-        # Apply priority cascading
-        self.priority_cascading_logic(request.data['priority'], task.id)
+    # Streams every task matching the TaskFilter parameters, unpaginated
+    @action(detail=False, url_path=r'export/(?P<export_format>ndjson|csv)')
+    def export(self, request, export_format, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset()).order_by('priority', 'id')
+        return export_response(queryset, TaskSerializer, export_format, filename='tasks')
 
-        old_status = task.status
-        new_status = request.data['status']
-        
-        # Check for the status changes
-        if old_status != new_status:
-            self.create_task_history(task, old_status, new_status)
-        
-        return super().update(request, *args, **kwargs)
+    # Delta sync: the tasks changed since ?token= (all live tasks without one),
+    # deleted ones as ids, and the token for the next call. See tasks/sync.py.
+    @action(detail=False)
+    def sync(self, request, *args, **kwargs):
+        try:
+            limit = _positive_int(request.query_params.get('limit', self.sync_default_limit), strict=True, cutoff=self.sync_max_limit)
+        except ValueError:
+            raise ValidationError({'limit': ['A positive integer is required.']})
 
+        changed, deleted, token, has_more = changes_since(
+            request.user, request.query_params.get('token'), limit, TaskSerializer.values_fields
+        )
+        return Response({
+            'changed': [TaskSerializer.from_values(row) for row in changed],
+            'deleted': deleted,
+            'token': token,
+            'has_more': has_more,
+        })
 
-    def perform_destroy(self, instance):
-        task = self.get_object()
-        old_status = task.status
-        new_status = 'CANCELLED'
+    # Batch writes: {"create": [task, ...], "update": [{"id": .., ...}, ...], "delete": [id, ...]}
+    # All operations are validated first and applied together in one transaction,
+    # with errors reported per item.
+    @action(detail=False, methods=['post'])
+    def batch(self, request, *args, **kwargs):
+        if not isinstance(request.data, dict):
+            raise ValidationError({'detail': 'Expected an object with create, update and delete lists'})
+        operations = {key: request.data.get(key) or [] for key in ('create', 'update', 'delete')}
+        if not all(isinstance(items, list) for items in operations.values()):
+            raise ValidationError({'detail': 'create, update and delete must be lists'})
+        if sum(len(items) for items in operations.values()) > self.batch_max_items:
+            raise ValidationError({'detail': f'A batch is limited to {self.batch_max_items} operations'})
+
+        with transaction.atomic(using=shard_db()):
+            creates, updates, deletes = self.validate_batch(**operations)
+            created, updated = TaskService(request.user).batch(creates, updates, deletes)
+
+        return Response({
+            'created': [TaskSerializer(task).data for task in created],
+            'updated': [TaskSerializer(task).data for task in updated],
+            'deleted': [task.id for task in deletes],
+        })
+
+    def validate_batch(self, create, update, delete):
+        errors = {}
+
+        create_serializer = TaskSerializer(data=create, many=True)
+        if not create_serializer.is_valid():
+            errors['create'] = create_serializer.errors
+
+        # Anything but an integer id is reported on its item, and never looked up
+        update_ids = [item.get('id') if isinstance(item, dict) else None for item in update]
+        update_ids = [task_id if is_task_id(task_id) else None for task_id in update_ids]
+        delete_ids = [task_id if is_task_id(task_id) else None for task_id in delete]
+        tasks = self.get_queryset().select_for_update().in_bulk(
+            [pk for pk in update_ids + delete_ids if pk is not None]
+        )
+
+        updates, update_errors, seen = [], [], set()
+        for task_id, item in zip(update_ids, update):
+            if task_id is None:
+                update_errors.append({'id': ['A valid integer is required.']})
+                continue
+            if task_id not in tasks:
+                update_errors.append({'id': ['Task not found.']})
+                continue
+            if task_id in seen or task_id in delete_ids:
+                update_errors.append({'id': ['Task appears more than once in the batch.']})
+                continue
+            seen.add(task_id)
+            serializer = TaskSerializer(tasks[task_id], data=item, partial=True)
+            if serializer.is_valid():
+                updates.append((tasks[task_id], serializer.validated_data))
+                update_errors.append({})
+            else:
+                update_errors.append(serializer.errors)
+        if any(update_errors):
+            errors['update'] = update_errors
 
-        if old_status != new_status:
-            self.create_task_history(task, old_status, new_status)
+        delete_errors = []
+        for index, task_id in enumerate(delete_ids):
+            if task_id is None:
+                delete_errors.append({'id': ['A valid integer is required.']})
+            elif task_id not in tasks:
+                delete_errors.append({'id': ['Task not found.']})
+            elif task_id in delete_ids[:index]:
+                delete_errors.append({'id': ['Task appears more than once in the batch.']})
+            else:
+                delete_errors.append({})
+        if any(delete_errors):
+            errors['delete'] = delete_errors
 
-        Task.objects.filter(pk=task.id, user=self.request.user).update(deleted=True)
+        if errors:
+            raise ValidationError(errors)
+
+        return create_serializer.validated_data, updates, [tasks[task_id] for task_id in delete_ids]
+
+
+# Batch ids are JSON integers, booleans excluded
+def is_task_id(value):
+    return isinstance(value, int) and not isinstance(value, bool)
 
 
 # Task History filter..
@@ -101,15 +236,136 @@ class TaskHistoryFilter(FilterSet):
     new_status = ChoiceFilter(choices=STATUS_CHOICES)
     old_status = ChoiceFilter(choices=STATUS_CHOICES)
 
+# Task History pagination, unpaginated unless `?cursor=` is passed
+class TaskHistoryPagination(KeysetModeMixin, OptionalPagination):
+    keyset_ordering = ('updated_date', 'id')
+
 # Task History viewset(readonly)
-class TaskHistoryViewSet(ReadOnlyModelViewSet):
+class TaskHistoryViewSet(CachedReadMixin, ReplicaReadMixin, ValuesListMixin, ReadOnlyModelViewSet):
     queryset = TaskHistory.objects.all()
     serializer_class = TaskHistorySerializer
 
+    authentication_classes = api_settings.DEFAULT_AUTHENTICATION_CLASSES + [SignedTokenAuthentication]
     permission_classes = [IsAuthenticated]
     filter_backends = [DjangoFilterBackend]
     filterset_class = TaskHistoryFilter
 
+    pagination_class = TaskHistoryPagination
+
+    # Streams the task's history matching the TaskHistoryFilter parameters
+    @action(detail=False, url_path=r'export/(?P<export_format>ndjson|csv)')
+    def export(self, request, export_format, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset()).order_by('updated_date', 'id')
+        return export_response(queryset, TaskHistorySerializer, export_format, filename=f"task-{kwargs['task_id']}-history")
+
     def get_queryset(self):
         task_id = self.kwargs['task_id']  
-        return TaskHistory.objects.filter(task__user=self.request.user, task=task_id)
+        return TaskHistory.objects.filter(task__user=self.request.user, task=task_id).select_related(
+            *self.serializer_class.select_related_fields
+        )
+
+
+# Status rollup filter, ?day_after=&day_before= bound the days
+class TaskStatusRollupFilter(FilterSet):
+    day = DateFromToRangeFilter()
+    status = ChoiceFilter(choices=STATUS_CHOICES)
+
+# Status rollup pagination
+class TaskStatusRollupPagination(LimitOffsetPagination):
+    default_limit = 100
+    max_limit = 1000
+
+# Status analytics viewset(readonly), over the daily rollups kept by tasks/rollups.py
+class TaskStatusRollupViewSet(ReadOnlyModelViewSet):
+    queryset = TaskStatusRollup.objects.all()
+    serializer_class = TaskStatusRollupSerializer
+
+    authentication_classes = api_settings.DEFAULT_AUTHENTICATION_CLASSES + [SignedTokenAuthentication]
+    permission_classes = [IsAuthenticated]
+    filter_backends = [DjangoFilterBackend]
+    filterset_class = TaskStatusRollupFilter
+
+    pagination_class = TaskStatusRollupPagination
+
+    def get_queryset(self):
+        return TaskStatusRollup.objects.filter(user=self.request.user).order_by('day', 'status')
+
+    # Transitions per status, completions per day and the average time from
+    # PENDING to COMPLETED over the filtered days
+    @action(detail=False)
+    def summary(self, request, *args, **kwargs):
+        rollups = self.filter_queryset(self.get_queryset())
+
+        status_counts = dict(
+            rollups.order_by('status').values('status').annotate(count=Sum('transitions')).values_list('status', 'count')
+        )
+        completions = rollups.filter(status=COMPLETED).values(
+            'day', 'transitions', 'timed_completions', 'completion_seconds'
+        )
+
+        timed = seconds = 0
+        completions_per_day = []
+        for row in completions:
+            completions_per_day.append({'day': row['day'], 'completions': row['transitions']})
+            timed += row['timed_completions']
+            seconds += row['completion_seconds']
+
+        return Response({
+            'status_counts': status_counts,
+            'completions_per_day': completions_per_day,
+            'average_completion_seconds': seconds / timed if timed else None,
+        })
+
+
+# Archived task filter
+class ArchivedTaskFilter(FilterSet):
+    title = CharFilter(lookup_expr='icontains')
+    status = ChoiceFilter(choices=STATUS_CHOICES)
+    completed = BooleanFilter()
+
+# Archived task pagination
+class ArchivedTaskPagination(LimitOffsetPagination):
+    default_limit = 20
+    max_limit = 100
+
+# Archived tasks viewset(readonly), tasks moved out by `archive_tasks`
+class ArchivedTaskViewSet(ReadOnlyModelViewSet):
+    queryset = ArchivedTask.objects.all()
+    serializer_class = ArchivedTaskSerializer
+
+    authentication_classes = api_settings.DEFAULT_AUTHENTICATION_CLASSES + [SignedTokenAuthentication]
+    permission_classes = [IsAuthenticated]
+    filter_backends = [DjangoFilterBackend]
+    filterset_class = ArchivedTaskFilter
+
+    pagination_class = ArchivedTaskPagination
+
+    def get_queryset(self):
+        return ArchivedTask.objects.filter(user=self.request.user).select_related('user').order_by('-id')
+
+    @action(detail=True)
+    def history(self, request, *args, **kwargs):
+        task = self.get_object()
+        history = task.history.order_by('updated_date', 'id')
+        return Response(ArchivedTaskHistorySerializer(history, many=True).data)
+
+
+# API token for username/password, see tasks/authentication.py
+class ObtainTokenView(APIView):
+    authentication_classes = []
+    permission_classes = []
+
+    def post(self, request, *args, **kwargs):
+        user = authenticate(request, username=request.data.get('username'), password=request.data.get('password'))
+        if user is None:
+            raise AuthenticationFailed('Invalid username or password.')
+        return Response({'token': issue_token(user)})
+
+# Revokes every API token of the user
+class RevokeTokensView(APIView):
+    authentication_classes = api_settings.DEFAULT_AUTHENTICATION_CLASSES + [SignedTokenAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, *args, **kwargs):
+        revoke_tokens(request.user)
+        return Response(status=204)
@@ -1,6 +1,26 @@
 from django.apps import AppConfig
+from django.contrib.auth import get_user_model
+from django.core.signals import request_started
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_migrate, post_save
 
 
 class TasksConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'tasks'
+
+    def ready(self):
+        import tasks.background  # noqa: F401 registers the background jobs
+        from tasks.authentication import user_saved
+        from tasks.db import apply_sqlite_pragmas, check_persistent_connections
+        from tasks.metrics import install_query_timer
+        from tasks.shards import reserve_id_ranges, user_created, user_deleted
+
+        # Query count and time for the request metrics, on every new connection
+        connection_created.connect(install_query_timer, dispatch_uid='tasks.metrics.install_query_timer')
+        connection_created.connect(apply_sqlite_pragmas, dispatch_uid='tasks.db.apply_sqlite_pragmas')
+        request_started.connect(check_persistent_connections, dispatch_uid='tasks.db.check_persistent_connections')
+        post_save.connect(user_saved, sender=get_user_model(), dispatch_uid='tasks.authentication.user_saved')
+        post_save.connect(user_created, sender=get_user_model(), dispatch_uid='tasks.shards.user_created')
+        post_delete.connect(user_deleted, sender=get_user_model(), dispatch_uid='tasks.shards.user_deleted')
+        post_migrate.connect(reserve_id_ranges, sender=self, dispatch_uid='tasks.shards.reserve_id_ranges')
@@ -0,0 +1,157 @@
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.request import Request
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+from tasks.api_views import TaskFilter, TaskHistoryFilter, TaskPagination, TaskViewSet
+from tasks.models import Task, TaskHistory
+from tasks.renderers import FastJSONRenderer
+from tasks.routers import replica_reads
+from tasks.serializers import TaskHistorySerializer, TaskSerializer
+
+
+# Native async versions of the read endpoints, for the ASGI entry point.
+#
+# The views themselves never block the event loop. Django 4.0 has no async
+# ORM (aget/acount/async iteration arrive in 4.1), so all database work of a
+# view is done in one sync_to_async call: the boundary is explicit and a
+# request crosses it at most twice (authentication, then data). Requests
+# authenticate like the DRF viewsets, with a session or an API token.
+
+
+def render_json(data, status=200):
+    return HttpResponse(FastJSONRenderer().render(data), status=status, content_type='application/json')
+
+
+def not_authenticated(detail=None):
+    return render_json({'detail': detail or 'Authentication credentials were not provided.'}, status=403)
+
+
+def not_found():
+    return render_json({'detail': 'Not found.'}, status=404)
+
+
+def method_not_allowed(request):
+    response = render_json({'detail': f'Method "{request.method}" not allowed.'}, status=405)
+    response['Allow'] = 'GET, HEAD'
+    return response
+
+
+# Resolves the user off the event loop with the task viewsets' authenticators:
+# the session, or an API token (see tasks/authentication.py). Returns the user,
+# or None and why the credentials were refused.
+@sync_to_async
+def get_user(request):
+    authenticators = [authentication() for authentication in TaskViewSet.authentication_classes]
+    try:
+        user = Request(request, authenticators=authenticators).user
+    except AuthenticationFailed as error:
+        return None, error.detail
+    return (user, None) if user.is_authenticated else (None, None)
+
+
+# Authentication and method checks shared by the views below
+async def authorise(request):
+    if request.method not in ('GET', 'HEAD'):
+        return None, method_not_allowed(request)
+    user, failure = await get_user(request)
+    if user is None:
+        return None, not_authenticated(failure)
+    return user, None
+
+
+# Same 400 body as DjangoFilterBackend on invalid filter parameters
+def filtered(filterset_class, request, queryset):
+    filterset = filterset_class(request.GET, queryset=queryset, request=request)
+    if not filterset.is_valid():
+        errors = filterset.errors.get_json_data()
+        return None, {field: [error['message'] for error in messages] for field, messages in errors.items()}
+    return filterset.qs, None
+
+
+def get_limit_offset(request):
+    paginator = TaskPagination()
+    try:
+        offset = max(int(request.GET.get(paginator.offset_query_param, 0)), 0)
+    except ValueError:
+        offset = 0
+    limit = paginator.default_limit
+    if paginator.limit_query_param in request.GET:
+        try:
+            limit = min(max(int(request.GET[paginator.limit_query_param]), 1), paginator.max_limit)
+        except ValueError:
+            pass
+    return limit, offset
+
+
+def page_link(request, limit, offset):
+    url = request.build_absolute_uri()
+    url = replace_query_param(url, 'limit', limit)
+    return replace_query_param(url, 'offset', offset) if offset > 0 else remove_query_param(url, 'offset')
+
+
+# Filtering may query (search) and routing looks up the user's shard, both
+# stay off the event loop with the rest of the reads
+@sync_to_async
+def fetch_task_page(user, request, limit, offset):
+    queryset, errors = filtered(TaskFilter, request, Task.objects.filter(user=user).order_by('priority', 'id'))
+    if errors:
+        return errors, None, None
+    with replica_reads(user):
+        count = queryset.count()
+        rows = queryset.values(*TaskSerializer.values_fields)[offset:offset + limit]
+        return None, count, [TaskSerializer.from_values(row) for row in rows]
+
+
+@sync_to_async
+def fetch_task(queryset):
+    row = queryset.values(*TaskSerializer.values_fields).first()
+    return TaskSerializer.from_values(row) if row is not None else None
+
+
+@sync_to_async
+def fetch_history(user, request, task_id):
+    queryset, errors = filtered(TaskHistoryFilter, request, TaskHistory.objects.filter(task__user=user, task=task_id))
+    if errors:
+        return errors, None
+    with replica_reads(user):
+        return None, [TaskHistorySerializer.from_values(row) for row in queryset.values(*TaskHistorySerializer.values_fields)]
+
+
+async def task_list_view(request):
+    user, denied = await authorise(request)
+    if denied:
+        return denied
+
+    limit, offset = get_limit_offset(request)
+    errors, count, results = await fetch_task_page(user, request, limit, offset)
+    if errors:
+        return render_json(errors, status=400)
+
+    return render_json({
+        'count': count,
+        'next': page_link(request, limit, offset + limit) if offset + limit < count else None,
+        'previous': page_link(request, limit, max(offset - limit, 0)) if offset > 0 else None,
+        'results': results,
+    })
+
+
+async def task_detail_view(request, pk):
+    user, denied = await authorise(request)
+    if denied:
+        return denied
+
+    task = await fetch_task(Task.objects.filter(pk=pk, user=user))
+    return render_json(task) if task is not None else not_found()
+
+
+async def task_history_view(request, task_id):
+    user, denied = await authorise(request)
+    if denied:
+        return denied
+
+    errors, history = await fetch_history(user, request, task_id)
+    if errors:
+        return render_json(errors, status=400)
+    return render_json(history)
@@ -0,0 +1,147 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core import signing
+from rest_framework.authentication import BaseAuthentication, get_authorization_header
+from rest_framework.exceptions import AuthenticationFailed
+
+from tasks.cache import task_cache
+from tasks.models import ApiTokenGeneration
+
+# Stateless API tokens: "Authorization: Token <token>".
+#
+# A token is the user id and the user's token generation, signed with a
+# timestamp. Checking the signature needs no storage, and the principal (the
+# user and their current generation) comes from an in-process LRU or the
+# shared cache, so an authenticated request makes no database query. Revoking
+# bumps the generation, which invalidates every token issued before.
+
+TOKEN_SALT = 'tasks.api-token'
+
+
+def token_signer():
+    return signing.TimestampSigner(salt=TOKEN_SALT)
+
+
+def principal_key(user_id):
+    return f'tasks:principal:{user_id}'
+
+
+# A small thread-safe LRU whose entries expire after `ttl` seconds
+class LocalPrincipals:
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, user_id):
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self.entries[user_id]
+                return None
+            self.entries.move_to_end(user_id)
+            return entry[1]
+
+    def set(self, user_id, principal):
+        with self.lock:
+            self.entries[user_id] = (time.monotonic() + self.ttl, principal)
+            self.entries.move_to_end(user_id)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def discard(self, user_id):
+        with self.lock:
+            self.entries.pop(user_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+local_principals = LocalPrincipals(settings.TASK_API_TOKEN_LOCAL_SIZE, settings.TASK_API_TOKEN_LOCAL_TTL)
+
+
+def load_principal(user_id):
+    user = User.objects.filter(pk=user_id, is_active=True).first()
+    if user is None:
+        return None
+    generation = ApiTokenGeneration.objects.filter(user=user).values_list('generation', flat=True).first() or 0
+    return user, generation
+
+
+# (user, generation), or None for an unknown or inactive user
+def get_principal(user_id):
+    principal = local_principals.get(user_id)
+    if principal is not None:
+        return principal
+
+    cache = task_cache()
+    principal = cache.get(principal_key(user_id))
+    if principal is None:
+        principal = load_principal(user_id)
+        if principal is None:
+            return None
+        cache.set(principal_key(user_id), principal, settings.TASK_API_TOKEN_CACHE_TIMEOUT)
+
+    local_principals.set(user_id, principal)
+    return principal
+
+
+def forget_principal(user_id):
+    task_cache().delete(principal_key(user_id))
+    local_principals.discard(user_id)
+
+
+# A saved user may have been deactivated, see TasksConfig.ready()
+def user_saved(sender, instance, **kwargs):
+    forget_principal(instance.pk)
+
+
+def issue_token(user):
+    generation = ApiTokenGeneration.objects.filter(user=user).values_list('generation', flat=True).first() or 0
+    return token_signer().sign(f'{user.pk}:{generation}')
+
+
+def revoke_tokens(user):
+    generation, _ = ApiTokenGeneration.objects.get_or_create(user=user)
+    generation.generation += 1
+    generation.save(update_fields=['generation'])
+    forget_principal(user.pk)
+
+
+class SignedTokenAuthentication(BaseAuthentication):
+    keyword = 'Token'
+
+    def authenticate(self, request):
+        header = get_authorization_header(request).split()
+        if not header or header[0].lower() != self.keyword.lower().encode():
+            return None
+        if len(header) != 2:
+            raise AuthenticationFailed('Invalid token header.')
+
+        try:
+            token = header[1].decode()
+            user_id, generation = token_signer().unsign(token, max_age=settings.TASK_API_TOKEN_MAX_AGE).split(':')
+            user_id, generation = int(user_id), int(generation)
+        except signing.SignatureExpired:
+            raise AuthenticationFailed('Token expired.')
+        except (signing.BadSignature, UnicodeDecodeError, ValueError):
+            raise AuthenticationFailed('Invalid token.')
+
+        principal = get_principal(user_id)
+        if principal is None or principal[1] != generation:
+            raise AuthenticationFailed('Invalid token.')
+        # Every request gets its own copy of the shared cached user
+        return copy.copy(principal[0]), token
+
+    def authenticate_header(self, request):
+        return self.keyword
@@ -0,0 +1,78 @@
+from io import StringIO
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import transaction
+from django.utils.dateparse import parse_datetime
+
+from tasks.cache import invalidate_user_tasks
+from tasks.counters import recount_task_counters
+from tasks.history import write_history
+from tasks.jobs import job
+from tasks.models import Task, TaskHistory
+from tasks.shards import use_shard_for
+
+# The jobs run by `run_workers` (see tasks/jobs.py). Loaded when the app is
+# ready, so the registry is complete in web and worker processes alike.
+
+
+# History rows handed off by buffered_history() with TASK_HISTORY_WRITE_BEHIND = 'job'.
+# Rows on a shard other than 'default' commit on their own, before the job is
+# marked done. The request already moved the users' cache versions on, before
+# these rows existed: they move again once the rows are in.
+@job('write_task_history', priority=10, atomic=True)
+def write_task_history(rows):
+    user_ids = {row['user_id'] for row in rows}
+    for user_id in user_ids:
+        user_rows = [row for row in rows if row['user_id'] == user_id]
+        user = User(pk=user_id)
+        with use_shard_for(user):
+            write_user_history(user_rows)
+            invalidate_user_tasks(user)
+
+
+def write_user_history(rows):
+    task_ids = {row['task_id'] for row in rows}
+    # A task archived meanwhile took its history along
+    live_ids = set(Task.all_objects.filter(id__in=task_ids).values_list('id', flat=True))
+    history = []
+    for row in rows:
+        if row['task_id'] not in live_ids:
+            continue
+        entry = TaskHistory(
+            task=Task(id=row['task_id'], user_id=row['user_id']),
+            old_status=row['old_status'],
+            new_status=row['new_status'],
+            updated_date=parse_datetime(row['updated_date']),
+        )
+        entry.pending_since = row['pending_since'] and parse_datetime(row['pending_since'])
+        history.append(entry)
+    write_history(history)
+
+
+# Queued by adjust_task_counters() when the user has no counter row yet
+@job('recount_task_counters', priority=50, atomic=True)
+def recount_user_task_counters(user_id):
+    user = User.objects.filter(pk=user_id).first()
+    if user is not None:
+        with use_shard_for(user) as db, transaction.atomic(using=db):
+            recount_task_counters(user)
+            invalidate_user_tasks(user)
+
+
+# Maintenance commands, queued by TASK_JOBS_SCHEDULE. They commit batch by
+# batch and pick up where they stopped when retried.
+
+@job('archive_tasks', priority=200, max_attempts=3)
+def archive_tasks(**options):
+    call_command('archive_tasks', stdout=StringIO(), **options)
+
+
+@job('compact_history', priority=200, max_attempts=3)
+def compact_history(**options):
+    call_command('compact_history', stdout=StringIO(), **options)
+
+
+@job('recount_tasks', priority=200, max_attempts=3)
+def recount_tasks(**options):
+    call_command('recount_tasks', stdout=StringIO(), **options)
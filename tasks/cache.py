@@ -0,0 +1,131 @@
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.cache import patch_vary_headers
+from django.utils.http import parse_etags
+
+from tasks.shards import shard_db
+
+
+# Read responses are cached under a per-user version number. Every write path
+# bumps the version once its transaction commits, which orphans all of the
+# user's cached responses at once without having to track their keys.
+
+def task_cache():
+    return caches[settings.TASK_CACHE_ALIAS]
+
+
+def version_key(user_id):
+    return f'tasks:version:{user_id}'
+
+
+# A fresh counter starts from the clock so a lost (evicted) version can never
+# come back with a number that old cached responses were stored under
+def new_version():
+    return int(time.time() * 1000)
+
+
+def get_user_version(user_id):
+    cache = task_cache()
+    version = cache.get(version_key(user_id))
+    if version is None:
+        version = new_version()
+        if not cache.add(version_key(user_id), version, timeout=None):
+            version = cache.get(version_key(user_id), version)
+    return version
+
+
+def bump_user_version(user_id):
+    cache = task_cache()
+    try:
+        return cache.incr(version_key(user_id))
+    except ValueError:
+        cache.set(version_key(user_id), new_version(), timeout=None)
+
+
+# Every write path calls this once its changes are in the transaction
+def invalidate_user_tasks(user):
+    if user is not None and user.pk is not None:
+        user_id = user.pk
+        transaction.on_commit(lambda: user_tasks_changed(user_id), using=shard_db())
+
+
+def user_tasks_changed(user_id):
+    bump_user_version(user_id)
+    pin_to_primary(user_id)
+
+
+def pin_key(user_id):
+    return f'tasks:primary:{user_id}'
+
+
+# After a write the user reads their own tasks from the primary database for
+# a while, until the replica has caught up (see tasks/routers.py)
+def pin_to_primary(user_id):
+    task_cache().set(pin_key(user_id), True, settings.TASK_DB_PIN_SECONDS)
+
+
+def pinned_to_primary(user_id):
+    return task_cache().get(pin_key(user_id), False)
+
+
+def response_etag(request, version):
+    key = '|'.join([
+        str(request.user.pk),
+        str(version),
+        request.method,
+        request.get_full_path(),
+        request.META.get('HTTP_ACCEPT', ''),
+    ])
+    return '"%s"' % hashlib.sha1(key.encode()).hexdigest()
+
+
+def store_response(etag, response):
+    task_cache().set(
+        f'tasks:response:{etag}',
+        (response.status_code, response['Content-Type'], response.content),
+        settings.TASK_CACHE_TIMEOUT,
+    )
+
+
+def load_response(etag):
+    cached = task_cache().get(f'tasks:response:{etag}')
+    if cached is None:
+        return None
+    status, content_type, content = cached
+    return HttpResponse(content, status=status, content_type=content_type)
+
+
+# Serve a GET from the cache, or a 304 when the client already holds the
+# current version, without touching the task tables. `render` produces the
+# response on a miss, it is stored once rendered.
+def cached_response(request, render):
+    if request.method != 'GET' or not request.user.is_authenticated:
+        return render()
+
+    etag = response_etag(request, get_user_version(request.user.pk))
+
+    # Compression weakens the ETag on the way out (W/"..."), still the same content
+    client_etags = [tag.removeprefix('W/') for tag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))]
+    if etag in client_etags:
+        response = HttpResponseNotModified()
+    else:
+        response = load_response(etag)
+
+    if response is None:
+        response = render()
+        if response.status_code != 200 or response.streaming:
+            return response
+        if hasattr(response, 'add_post_render_callback'):
+            response.add_post_render_callback(lambda rendered: store_response(etag, rendered))
+        else:
+            store_response(etag, response)
+
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, no-cache'
+    patch_vary_headers(response, ('Accept', 'Cookie'))
+    return response
@@ -0,0 +1,38 @@
+from django.db import transaction
+from django.db.models import Count, F, Q
+
+from tasks.jobs import enqueue_on_commit
+from tasks.models import Task, TaskCounter
+from tasks.shards import shard_db
+
+
+# Recount a user's live tasks, creating the counter row when missing
+def recount_task_counters(user):
+    counts = Task.objects.filter(user=user).aggregate(
+        total=Count('id'),
+        completed=Count('id', filter=Q(completed=True)),
+    )
+    counter, _ = TaskCounter.objects.update_or_create(user=user, defaults=counts)
+    return counter
+
+
+def get_task_counters(user):
+    try:
+        return TaskCounter.objects.get(user=user)
+    except TaskCounter.DoesNotExist:
+        return recount_task_counters(user)
+
+
+# Apply a delta in the caller's transaction, so the counters commit with the write
+def adjust_task_counters(user, total=0, completed=0):
+    if user is None or not (total or completed):
+        return
+
+    with transaction.atomic(using=shard_db(), savepoint=False):
+        updated = TaskCounter.objects.filter(user=user).update(
+            total=F('total') + total,
+            completed=F('completed') + completed,
+        )
+        if not updated:
+            # Readers recount a missing row themselves, the write doesn't wait
+            enqueue_on_commit('recount_task_counters', {'user_id': user.pk}, key=f'recount_task_counters:{user.pk}')
@@ -0,0 +1,23 @@
+from django.conf import settings
+from django.db import connections
+
+
+# Connection setup and checks, connected to signals in TasksConfig.ready()
+
+def apply_sqlite_pragmas(sender, connection, **kwargs):
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        for pragma, value in settings.TASK_SQLITE_PRAGMAS.items():
+            cursor.execute(f'PRAGMA {pragma} = {value}')
+
+
+# Django 4.0 has no CONN_HEALTH_CHECKS. Persistent connections are only
+# closed after an error or CONN_MAX_AGE, so one dropped by the server would
+# fail the next request: check them when a request starts and drop the dead.
+def check_persistent_connections(**kwargs):
+    if not settings.TASK_DB_HEALTH_CHECKS:
+        return
+    for connection in connections.all():
+        if connection.connection is not None and not connection.in_atomic_block and not connection.is_usable():
+            connection.close()
@@ -0,0 +1,250 @@
+import asyncio
+import itertools
+import json
+import logging
+import threading
+import time
+import uuid
+from collections import defaultdict, deque
+from datetime import timedelta
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import DatabaseError, connection, transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from tasks.models import TaskEvent
+from tasks.serializers import TaskSerializer
+from tasks.shards import shard_db
+
+logger = logging.getLogger(__name__)
+
+# Task change feed. TaskService publishes an event for every task it creates,
+# updates or deletes once the write commits. The backend hands it to the
+# broker of every worker, which fans it out to the user's open event streams
+# (see tasks/streams.py) and keeps recent events for Last-Event-ID resume.
+#
+# Event ids are "<epoch>-<sequence>". The epoch changes whenever the sequence
+# restarts, a stream resuming from another epoch is told to reset instead.
+# LocalEventBackend serves a single process, DatabaseEventBackend any number.
+
+EVENT_TYPES = ('task.created', 'task.updated', 'task.status', 'task.deleted', 'tasks.reordered')
+
+
+class Event():
+
+    def __init__(self, epoch, sequence, user_id, event_type, data):
+        self.epoch = epoch
+        self.sequence = sequence
+        self.user_id = user_id
+        self.type = event_type
+        self.data = data
+
+    @property
+    def id(self):
+        return f'{self.epoch}-{self.sequence}'
+
+    def encode(self):
+        data = json.dumps(self.data, cls=DjangoJSONEncoder, separators=(',', ':'))
+        return f'id: {self.id}\nevent: {self.type}\ndata: {data}\n\n'.encode()
+
+
+def parse_event_id(event_id):
+    epoch, _, sequence = (event_id or '').rpartition('-')
+    try:
+        return epoch, int(sequence)
+    except ValueError:
+        return None, None
+
+
+# One open stream. Events are put from whichever thread commits the write and
+# consumed on the stream's event loop.
+class Subscription():
+
+    def __init__(self, user_id, loop, size):
+        self.user_id = user_id
+        self.loop = loop
+        self.size = size
+        self.events = deque()
+        self.overflowed = False
+        self.wakeup = asyncio.Event()
+
+    # Called with the broker lock held
+    def put(self, event):
+        if len(self.events) >= self.size:
+            # A slow client: stop buffering, the stream closes and resumes
+            self.overflowed = True
+        else:
+            self.events.append(event)
+        self.loop.call_soon_threadsafe(self.wakeup.set)
+
+    def drain(self):
+        self.wakeup.clear()
+        events = []
+        while self.events:
+            events.append(self.events.popleft())
+        return events
+
+
+class EventBroker():
+
+    def __init__(self, replay_size, queue_size):
+        self.lock = threading.Lock()
+        self.subscriptions = defaultdict(set)
+        self.recent = deque(maxlen=replay_size)
+        self.queue_size = queue_size
+
+    def deliver(self, event):
+        with self.lock:
+            self.recent.append(event)
+            for subscription in self.subscriptions.get(event.user_id, ()):
+                subscription.put(event)
+
+    # Returns the subscription and the user's events after last_event_id, or
+    # None for the events when they are no longer all in the replay buffer
+    def subscribe(self, user_id, loop, last_event_id=None):
+        with self.lock:
+            subscription = Subscription(user_id, loop, self.queue_size)
+            self.subscriptions[user_id].add(subscription)
+            missed = self.replay(user_id, last_event_id) if last_event_id else []
+        return subscription, missed
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscriptions = self.subscriptions.get(subscription.user_id)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self.subscriptions[subscription.user_id]
+
+    def replay(self, user_id, last_event_id):
+        epoch, sequence = parse_event_id(last_event_id)
+        # Nothing published since this worker started, the id is from an earlier one
+        if not self.recent:
+            return None
+        if epoch != self.recent[-1].epoch or sequence > self.recent[-1].sequence:
+            return None
+        # Events between the last one seen and the oldest kept are gone
+        if self.recent[0].epoch == epoch and self.recent[0].sequence > sequence + 1:
+            return None
+        return [
+            event for event in self.recent
+            if event.user_id == user_id and event.epoch == epoch and event.sequence > sequence
+        ]
+
+
+broker = EventBroker(settings.TASK_EVENTS_REPLAY_SIZE, settings.TASK_EVENTS_QUEUE_SIZE)
+
+
+# Transport between the workers. publish() is called after commit and must
+# get the event to broker.deliver() in every worker, ids in publish order.
+# start() is called (off the event loop) before a stream subscribes.
+class EventBackend():
+
+    def publish(self, user_id, event_type, data):
+        raise NotImplementedError
+
+    def start(self):
+        pass
+
+
+# Single process: deliver straight to this worker's broker. Each process has
+# its own epoch, so settings refuse it with more than one web worker.
+class LocalEventBackend(EventBackend):
+
+    def __init__(self):
+        self.epoch = uuid.uuid4().hex[:12]
+        self.sequence = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def publish(self, user_id, event_type, data):
+        with self.lock:
+            broker.deliver(Event(self.epoch, next(self.sequence), user_id, event_type, data))
+
+
+# Several processes: events go through the TaskEvent table, whose ids are the
+# shared sequence. Every process serving streams polls the table from one
+# thread and delivers what it finds to its own broker, so a stream sees the
+# writes of every worker and resumes from an id on any of them. Old rows are
+# pruned after TASK_EVENTS_KEEP seconds.
+class DatabaseEventBackend(EventBackend):
+    epoch = 'db'
+    batch_size = 500
+    # An id skipped by the rows after it may belong to an insert still
+    # committing: wait this long for it before moving past
+    gap_wait = timedelta(seconds=2)
+    prune_interval = 60
+
+    def __init__(self, target=None):
+        self.broker = target or broker
+        self.poll_interval = settings.TASK_EVENTS_POLL_INTERVAL
+        self.last_id = None
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def publish(self, user_id, event_type, data):
+        TaskEvent.objects.create(user_id=user_id, type=event_type, data=data)
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.load()
+            self.thread = threading.Thread(target=self.run, name='task-events', daemon=True)
+            self.thread.start()
+
+    # The replay buffer gets the latest events, for streams resuming right after a restart
+    def load(self):
+        rows = list(TaskEvent.objects.order_by('-id')[:settings.TASK_EVENTS_REPLAY_SIZE])
+        self.last_id = rows[-1].id - 1 if rows else 0
+        self.deliver(reversed(rows), wait_for_gaps=False)
+
+    def poll(self):
+        rows = TaskEvent.objects.filter(id__gt=self.last_id).order_by('id')[:self.batch_size]
+        return self.deliver(rows)
+
+    def deliver(self, rows, wait_for_gaps=True):
+        delivered = 0
+        for row in rows:
+            if wait_for_gaps and row.id != self.last_id + 1 and timezone.now() - row.created_date < self.gap_wait:
+                break
+            self.broker.deliver(Event(self.epoch, row.id, row.user_id, row.type, row.data))
+            self.last_id = row.id
+            delivered += 1
+        return delivered
+
+    def prune(self):
+        cutoff = timezone.now() - timedelta(seconds=settings.TASK_EVENTS_KEEP)
+        return TaskEvent.objects.filter(created_date__lt=cutoff).delete()[0]
+
+    def run(self):
+        last_prune = 0
+        while True:
+            try:
+                if time.monotonic() - last_prune >= self.prune_interval:
+                    self.prune()
+                    last_prune = time.monotonic()
+                if self.poll() == self.batch_size:
+                    continue
+            except DatabaseError:
+                # Reconnects on the next poll
+                logger.exception('Could not read the task events')
+                connection.close()
+            time.sleep(self.poll_interval)
+
+
+@lru_cache(maxsize=None)
+def get_event_backend():
+    return import_string(settings.TASK_EVENTS_BACKEND)()
+
+
+# Serialized now, published once the surrounding transaction commits
+def publish_on_commit(user_id, event_type, data):
+    transaction.on_commit(lambda: get_event_backend().publish(user_id, event_type, data), using=shard_db())
+
+
+def publish_task_event(task, event_type, **extra):
+    data = {'id': task.id} if event_type == 'task.deleted' else TaskSerializer(task).data
+    publish_on_commit(task.user_id, event_type, {**data, **extra})
@@ -0,0 +1,84 @@
+import csv
+import json
+
+from django.http import StreamingHttpResponse
+
+from tasks.serializers import TaskHistorySerializer, TaskSerializer
+from tasks.shards import shard_db
+
+EXPORT_CHUNK_SIZE = 2000
+# Lines written per NDJSON chunk, small enough for the first bytes to go out early
+EXPORT_FLUSH_LINES = 200
+
+CONTENT_TYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+# Flat CSV columns for each serializer's representation
+CSV_COLUMNS = {
+    TaskSerializer: {
+        'id': lambda item: item['id'],
+        'title': lambda item: item['title'],
+        'description': lambda item: item['description'],
+        'priority': lambda item: item['priority'],
+        'completed': lambda item: item['completed'],
+        'status': lambda item: item['status'],
+        'user': lambda item: item['user']['username'] if item['user'] else '',
+    },
+    TaskHistorySerializer: {
+        'id': lambda item: item['id'],
+        'task': lambda item: item['task']['id'],
+        'task_title': lambda item: item['task']['title'],
+        'old_status': lambda item: item['old_status'],
+        'new_status': lambda item: item['new_status'],
+        'updated_date': lambda item: item['updated_date'],
+    },
+}
+
+
+# Stream the rows of a queryset with a server side cursor, each row is turned
+# into the serializer representation as it arrives, so memory stays flat
+def iter_items(queryset, serializer_class):
+    rows = queryset.values(*serializer_class.values_fields).iterator(chunk_size=EXPORT_CHUNK_SIZE)
+    for row in rows:
+        yield serializer_class.from_values(row)
+
+
+def iter_ndjson(items):
+    lines = []
+    for item in items:
+        lines.append(json.dumps(item, ensure_ascii=False, separators=(',', ':')))
+        if len(lines) >= EXPORT_FLUSH_LINES:
+            yield '\n'.join(lines) + '\n'
+            lines = []
+    if lines:
+        yield '\n'.join(lines) + '\n'
+
+
+# csv.writer wants a file, hand back each written line instead
+class Echo:
+
+    def write(self, value):
+        return value
+
+
+def iter_csv(items, columns):
+    writer = csv.writer(Echo())
+    yield writer.writerow(columns.keys())
+    for item in items:
+        yield writer.writerow([value(item) for value in columns.values()])
+
+
+# The rows are read as the response streams out, after the view and its
+# shard context (see tasks/shards.py) are gone: pin the queryset to the shard now
+def export_response(queryset, serializer_class, export_format, filename):
+    items = iter_items(queryset.using(shard_db()), serializer_class)
+    if export_format == 'csv':
+        content = iter_csv(items, CSV_COLUMNS[serializer_class])
+    else:
+        content = iter_ndjson(items)
+
+    response = StreamingHttpResponse(content, content_type=CONTENT_TYPES[export_format])
+    response['Content-Disposition'] = f'attachment; filename="{filename}.{export_format}"'
+    return response
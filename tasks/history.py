@@ -0,0 +1,99 @@
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import transaction
+
+from tasks.jobs import enqueue
+from tasks.models import TaskHistory
+from tasks.rollups import add_to_rollups
+from tasks.shards import shard_db, use_shard
+
+
+# Write-behind for TaskHistory. Inside a buffered_history() block history rows
+# are only collected, and written with one bulk_create once the transaction
+# commits, so the request's write transaction (and its locks) never waits on
+# history inserts. A rollback discards the rows along with the on_commit hook.
+# Outside a block, or with TASK_HISTORY_WRITE_BEHIND off, rows are saved
+# immediately as before. Either way the status rollups (tasks/rollups.py) are
+# updated in the same transaction as the rows.
+#
+# With TASK_HISTORY_WRITE_BEHIND = 'job' the collected rows are queued instead
+# and written by a background worker (see tasks/background.py), taking the
+# inserts and rollup updates out of the request entirely.
+
+HISTORY_BATCH_SIZE = 500
+
+_buffers = threading.local()
+
+
+def current_buffer():
+    stack = getattr(_buffers, 'stack', None)
+    return stack[-1] if stack else None
+
+
+def record_task_history(task, old_status, new_status):
+    history = TaskHistory(task=task, old_status=old_status, new_status=new_status)
+    # As it was at the transition, the task may change again before the write
+    history.pending_since = task.pending_since
+    rows = current_buffer()
+    if rows is None:
+        write_history([history])
+    else:
+        rows.append(history)
+    return history
+
+
+# `using` pins the shard for writes that run after the request, from on_commit
+def write_history(rows, using=None):
+    using = using or shard_db()
+    with use_shard(using), transaction.atomic(using=using):
+        TaskHistory.objects.bulk_create(rows, batch_size=HISTORY_BATCH_SIZE)
+        add_to_rollups(rows)
+
+
+# The write is hooked when the block starts, ahead of the hooks registered
+# inside it: the cache invalidation (tasks/cache.py) runs once the rows are in.
+# Outside a transaction there is nothing to defer to, rows are saved as they come.
+@contextmanager
+def buffered_history(using=None):
+    using = using or shard_db()
+    if not settings.TASK_HISTORY_WRITE_BEHIND or not transaction.get_connection(using).in_atomic_block:
+        yield
+        return
+
+    if not hasattr(_buffers, 'stack'):
+        _buffers.stack = []
+    rows = []
+    _buffers.stack.append(rows)
+    # Nested blocks hook separately, which keeps their rows tied to their own savepoint
+    transaction.on_commit(lambda: flush_history(rows, using), using=using)
+    try:
+        yield
+    except BaseException:
+        # Nothing of a failed block is written, even when the transaction goes on
+        rows.clear()
+        raise
+    finally:
+        _buffers.stack.pop()
+
+
+def flush_history(rows, using):
+    if rows and settings.TASK_HISTORY_WRITE_BEHIND == 'job':
+        enqueue('write_task_history', {'rows': history_payload(rows)})
+    elif rows:
+        write_history(rows, using=using)
+
+
+def history_payload(rows):
+    return [
+        {
+            'task_id': history.task_id,
+            'user_id': history.task.user_id,
+            'old_status': history.old_status,
+            'new_status': history.new_status,
+            'updated_date': history.updated_date.isoformat(),
+            'pending_since': history.pending_since and history.pending_since.isoformat(),
+        }
+        for history in rows
+    ]
@@ -0,0 +1,248 @@
+import logging
+import os
+import socket
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DatabaseError, IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from tasks.models import Job
+from tasks.shards import shard_db
+
+logger = logging.getLogger(__name__)
+
+# Background jobs, queued in the Job table and run by `manage.py run_workers`,
+# no broker needed. Work is registered with @job and queued with enqueue(), or
+# enqueue_on_commit() to queue it only once the caller's transaction commits.
+#
+# A worker claims the first queued job by (priority, run_after, id) with a
+# conditional UPDATE, so concurrent workers never run the same job, and holds
+# it for TASK_JOBS_LEASE seconds (renewed while it runs). A failed job is
+# retried after an exponential backoff until it runs out of attempts; a job
+# whose worker died is retried once its lease runs out. Jobs can therefore
+# run more than once: handlers must be idempotent, or registered atomic=True
+# so their writes commit together with the job being marked done.
+#
+# Jobs sharing a key coalesce while queued: enqueueing a key that is already
+# waiting returns the waiting job. A running job doesn't count, it may have
+# read its data before the new change.
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# Queued jobs a worker tries to claim before giving up for this round
+CLAIM_CANDIDATES = 5
+
+
+class JobDefinition():
+
+    def __init__(self, func, priority, max_attempts, atomic):
+        self.func = func
+        self.priority = priority
+        self.max_attempts = max_attempts
+        self.atomic = atomic
+
+
+registry = {}
+
+
+def job(name=None, priority=100, max_attempts=None, atomic=False):
+    def register(func):
+        registry[name or func.__name__] = JobDefinition(
+            func, priority, max_attempts or settings.TASK_JOBS_MAX_ATTEMPTS, atomic,
+        )
+        return func
+    return register
+
+
+def enqueue(name, payload=None, key=None, priority=None, delay=0):
+    try:
+        definition = registry[name]
+    except KeyError:
+        raise ValueError(f'Unknown job {name!r}')
+
+    job = Job(
+        name=name,
+        key=key,
+        payload=payload or {},
+        priority=definition.priority if priority is None else priority,
+        max_attempts=definition.max_attempts,
+        run_after=timezone.now() + timedelta(seconds=delay),
+    )
+    if key is None:
+        job.save(force_insert=True)
+        return job
+    try:
+        with transaction.atomic():
+            job.save(force_insert=True)
+    except IntegrityError:
+        # Already waiting, the queued job will do
+        waiting = Job.objects.filter(key=key, state=QUEUED).first()
+        if waiting is not None:
+            return waiting
+        # Claimed in the meantime
+        return enqueue(name, payload, key, priority, delay)
+    return job
+
+
+# Hooked to the transaction of the current shard by default, the job itself is queued on 'default'
+def enqueue_on_commit(name, payload=None, using=None, **options):
+    transaction.on_commit(lambda: enqueue(name, payload, **options), using=using or shard_db())
+
+
+def backoff(attempts):
+    return min(settings.TASK_JOBS_BACKOFF * 2 ** (attempts - 1), settings.TASK_JOBS_MAX_BACKOFF)
+
+
+# Workers of one process share the prefix
+def worker_prefix():
+    return f'{socket.gethostname()}:{os.getpid()}:'
+
+
+def worker_name(index=0):
+    return f'{worker_prefix()}{index}'
+
+
+def claim_job(worker, names=None):
+    now = timezone.now()
+    claimable = Job.objects.filter(state=QUEUED, run_after__lte=now)
+    if names:
+        claimable = claimable.filter(name__in=names)
+
+    candidates = claimable.order_by('priority', 'run_after', 'id').values_list('id', flat=True)
+    for job_id in candidates[:CLAIM_CANDIDATES]:
+        # Only one worker sees the job still queued
+        claimed = Job.objects.filter(id=job_id, state=QUEUED).update(
+            state=RUNNING,
+            locked_by=worker,
+            locked_until=now + timedelta(seconds=settings.TASK_JOBS_LEASE),
+            attempts=F('attempts') + 1,
+        )
+        if claimed:
+            return Job.objects.get(id=job_id)
+    return None
+
+
+# Moves the job on, unless its lease ran out and another worker took it over
+def finish_job(job, state, **fields):
+    fields.update(state=state, locked_until=None)
+    if state in (DONE, FAILED):
+        fields['finished_date'] = timezone.now()
+    try:
+        with transaction.atomic():
+            return Job.objects.filter(id=job.id, state=RUNNING, locked_by=job.locked_by).update(**fields)
+    except IntegrityError:
+        # Retrying, but the same work was queued again since: leave it to that job
+        return Job.objects.filter(id=job.id, state=RUNNING, locked_by=job.locked_by).update(
+            state=FAILED, locked_until=None, finished_date=timezone.now(),
+            last_error=fields.get('last_error', '') + '\nSuperseded by a newer job with the same key.',
+        )
+
+
+def run_job(job):
+    definition = registry.get(job.name)
+    try:
+        if definition is None:
+            raise LookupError(f'Unknown job {job.name!r}')
+        if definition.atomic:
+            with transaction.atomic():
+                # Marked done with the handler's writes, so it never runs twice.
+                # Writing first also makes SQLite take the write lock up front.
+                finish_job(job, DONE)
+                definition.func(**job.payload)
+        else:
+            definition.func(**job.payload)
+            finish_job(job, DONE)
+    except Exception:
+        error = traceback.format_exc()
+        if job.attempts < job.max_attempts:
+            delay = backoff(job.attempts)
+            logger.warning('Job %s failed (attempt %s/%s), retrying in %ss', job, job.attempts, job.max_attempts, delay, exc_info=True)
+            finish_job(job, QUEUED, run_after=timezone.now() + timedelta(seconds=delay), locked_by='', last_error=error)
+        else:
+            logger.error('Job %s failed (attempt %s/%s), giving up', job, job.attempts, job.max_attempts, exc_info=True)
+            finish_job(job, FAILED, last_error=error)
+        return False
+    return True
+
+
+def run_next_job(worker, names=None):
+    job = claim_job(worker, names)
+    if job is not None:
+        run_job(job)
+    return job
+
+
+# Keeps the jobs of one worker process claimed while they run
+def renew_leases(worker_prefix):
+    return Job.objects.filter(state=RUNNING, locked_by__startswith=worker_prefix).update(
+        locked_until=timezone.now() + timedelta(seconds=settings.TASK_JOBS_LEASE),
+    )
+
+
+# Jobs left running by a worker that died: retried, or failed when out of attempts
+def requeue_expired():
+    requeued = 0
+    expired = Job.objects.filter(state=RUNNING, locked_until__lt=timezone.now())
+    for job in expired.only('id', 'name', 'key', 'attempts', 'max_attempts', 'locked_by'):
+        if job.attempts < job.max_attempts:
+            requeued += finish_job(job, QUEUED, locked_by='', last_error='Lease expired.')
+        else:
+            finish_job(job, FAILED, last_error='Lease expired.')
+    return requeued
+
+
+# Queues each scheduled job once per period, however many workers are running
+def enqueue_scheduled(schedule=None, now=None):
+    schedule = settings.TASK_JOBS_SCHEDULE if schedule is None else schedule
+    now = now or timezone.now()
+    queued = []
+    for name, (period, payload) in schedule.items():
+        key = f'schedule:{name}:{int(now.timestamp() // period)}'
+        if not Job.objects.filter(key=key).exists():
+            queued.append(enqueue(name, payload, key=key))
+    return queued
+
+
+def purge_finished():
+    cutoff = timezone.now() - timedelta(seconds=settings.TASK_JOBS_KEEP_DONE)
+    deleted, _ = Job.objects.filter(state=DONE, finished_date__lt=cutoff).delete()
+    return deleted
+
+
+class Worker():
+
+    def __init__(self, name, names=None, poll_interval=1.0):
+        self.name = name
+        self.names = names
+        self.poll_interval = poll_interval
+        self.processed = 0
+
+    # Until the queue has nothing ready to run
+    def drain(self):
+        while True:
+            try:
+                if run_next_job(self.name, self.names) is None:
+                    return
+            except DatabaseError:
+                logger.exception('Worker %s could not reach the queue', self.name)
+                return
+            self.processed += 1
+
+    def run(self, stop):
+        while not stop.is_set():
+            try:
+                job = run_next_job(self.name, self.names)
+            except DatabaseError:
+                # A locked or unreachable database, try again on the next poll
+                logger.exception('Worker %s could not reach the queue', self.name)
+                job = None
+            if job is None:
+                stop.wait(self.poll_interval)
+            else:
+                self.processed += 1
@@ -0,0 +1,89 @@
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from tasks.cache import invalidate_user_tasks
+from tasks.models import (ArchivedTask, ArchivedTaskHistory, Task, TaskHistory,
+                          TaskHistorySummary)
+from tasks.shards import each_shard
+
+ARCHIVED_FIELDS = ('id', 'title', 'description', 'completed', 'created_date', 'priority', 'status', 'user_id')
+
+
+class Command(BaseCommand):
+    help = 'Move soft-deleted tasks and their history out of the hot tables into the archive'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=0, help='Only archive tasks deleted more than this many days ago')
+        parser.add_argument('--batch-size', type=int, default=500, help='Tasks archived per transaction')
+        parser.add_argument('--limit', type=int, help='Stop after archiving this many tasks')
+
+    def handle(self, *args, **options):
+        # A soft delete stamps created_date (the task's last change)
+        cutoff = timezone.now() - timedelta(days=options['days'])
+        deleted_tasks = Task.all_objects.filter(deleted=True, created_date__lte=cutoff)
+
+        archived = history = 0
+        for alias in each_shard():
+            while options['limit'] is None or archived < options['limit']:
+                batch_size = options['batch_size']
+                if options['limit'] is not None:
+                    batch_size = min(batch_size, options['limit'] - archived)
+
+                task_ids = list(deleted_tasks.order_by('id').values_list('id', flat=True)[:batch_size])
+                if not task_ids:
+                    break
+
+                history += self.archive(task_ids, alias)
+                archived += len(task_ids)
+                self.stdout.write(f'{archived} task(s), {history} history row(s) archived')
+
+        self.stdout.write(self.style.SUCCESS(f'Archived {archived} task(s) and {history} history row(s)'))
+
+    # One short transaction per batch: copy, then delete from the hot tables
+    def archive(self, task_ids, alias):
+        with transaction.atomic(using=alias):
+            # Locks the rows on backends that support it, re-checks they are still deleted
+            tasks = list(
+                Task.all_objects.select_for_update().filter(id__in=task_ids, deleted=True).values(*ARCHIVED_FIELDS)
+            )
+            task_ids = [task['id'] for task in tasks]
+
+            summaries = {
+                summary['task_id']: summary
+                for summary in TaskHistorySummary.objects.filter(task_id__in=task_ids).values(
+                    'task_id', 'transitions', 'status_counts', 'last_status', 'first_date', 'last_date'
+                )
+            }
+            ArchivedTask.objects.bulk_create([
+                ArchivedTask(history_summary=self.summary_data(summaries.get(task['id'])), **task) for task in tasks
+            ])
+
+            rows = TaskHistory.objects.filter(task_id__in=task_ids).values(
+                'id', 'task_id', 'old_status', 'new_status', 'updated_date'
+            )
+            history = ArchivedTaskHistory.objects.bulk_create(
+                (ArchivedTaskHistory(**row) for row in rows.iterator()), batch_size=1000
+            )
+
+            TaskHistory.objects.filter(task_id__in=task_ids).delete()
+            TaskHistorySummary.objects.filter(task_id__in=task_ids).delete()
+            Task.all_objects.filter(id__in=task_ids).delete()
+
+            # Their history moved to the archive API
+            for user in User.objects.filter(pk__in={task['user_id'] for task in tasks}):
+                invalidate_user_tasks(user)
+
+        return len(history)
+
+    def summary_data(self, summary):
+        if summary is None:
+            return None
+        summary.pop('task_id')
+        for field in ('first_date', 'last_date'):
+            if summary[field] is not None:
+                summary[field] = summary[field].isoformat()
+        return summary
@@ -0,0 +1,100 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import DateTimeField, OuterRef, Subquery, Value
+
+from tasks.models import (ArchivedTaskHistory, Task, TaskHistory,
+                          TaskHistorySummary, TaskStatusRollup)
+from tasks.rollups import (COMPLETED, PENDING, RollupTotals,
+                           completion_seconds)
+from tasks.shards import each_shard, group_by_shard, use_shard
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the daily status rollups from the task history'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', action='append', dest='usernames', help='Only rebuild these users (repeatable)')
+        parser.add_argument('--batch-size', type=int, default=100, help='Users rebuilt per transaction')
+
+    def handle(self, *args, **options):
+        users = User.objects.order_by('id')
+        if options['usernames']:
+            users = users.filter(username__in=options['usernames'])
+            missing = set(options['usernames']) - set(users.values_list('username', flat=True))
+            if missing:
+                raise CommandError(f"Unknown user(s): {', '.join(sorted(missing))}")
+
+        user_ids = list(users.values_list('id', flat=True)) if options['usernames'] else None
+        pending = sum(self.backfill_pending_since(user_ids) for _ in each_shard())
+        self.stdout.write(f'{pending} pending task(s) given their pending_since')
+
+        rebuilt = rows = 0
+        last_id = 0
+        while True:
+            user_ids = list(users.filter(id__gt=last_id).values_list('id', flat=True)[:options['batch_size']])
+            if not user_ids:
+                break
+
+            for alias, shard_user_ids in group_by_shard(user_ids).items():
+                with use_shard(alias):
+                    rows += self.rebuild(shard_user_ids, alias)
+            rebuilt += len(user_ids)
+            last_id = user_ids[-1]
+            self.stdout.write(f'{rebuilt} user(s), {rows} rollup row(s) rebuilt')
+
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {rows} rollup row(s) for {rebuilt} user(s)'))
+
+    # Tasks created before pending_since existed: the last time their history entered PENDING
+    def backfill_pending_since(self, user_ids=None):
+        entered = TaskHistory.objects.filter(task=OuterRef('pk'), new_status=PENDING).order_by('-updated_date')
+        tasks = Task.all_objects.filter(status=PENDING, pending_since__isnull=True)
+        if user_ids is not None:
+            tasks = tasks.filter(user_id__in=user_ids)
+        return tasks.update(
+            pending_since=Subquery(entered.values('updated_date')[:1])
+        )
+
+    # Replaces the users' rollups in one transaction. Writes made meanwhile by
+    # other processes can be counted twice or missed: run it while they are quiet.
+    def rebuild(self, user_ids, alias):
+        totals = RollupTotals()
+        with transaction.atomic(using=alias):
+            history = TaskHistory.objects.filter(task__user_id__in=user_ids)
+            self.add_history(totals, history.values_list(
+                'task_id', 'task__user_id', 'old_status', 'new_status', 'updated_date', 'task__pending_since'
+            ))
+            archived = ArchivedTaskHistory.objects.filter(task__user_id__in=user_ids)
+            self.add_history(totals, archived.values_list(
+                'task_id', 'task__user_id', 'old_status', 'new_status', 'updated_date', Value(None, output_field=DateTimeField())
+            ))
+
+            # History folded by `compact_history` only kept its counts, dated by its last transition
+            summaries = TaskHistorySummary.objects.filter(task__user_id__in=user_ids, last_date__isnull=False)
+            for user_id, status_counts, last_date in summaries.values_list('task__user_id', 'status_counts', 'last_date').iterator():
+                for status, count in status_counts.items():
+                    for _ in range(count):
+                        totals.add(user_id, last_date, status)
+
+            TaskStatusRollup.objects.filter(user_id__in=user_ids).delete()
+            rollups = TaskStatusRollup.objects.bulk_create(totals.rollups(), batch_size=500)
+        return len(rollups)
+
+    # Completions are timed from the task's previous entry into PENDING in the
+    # history. Its creation is not in it: before the first one, fall back to the
+    # task's own pending_since.
+    def add_history(self, totals, rows):
+        task_id = pending_since = None
+        for row_task_id, user_id, old_status, status, updated_date, task_pending_since in (
+            rows.order_by('task_id', 'updated_date', 'id').iterator(chunk_size=2000)
+        ):
+            if row_task_id != task_id:
+                task_id, pending_since = row_task_id, task_pending_since
+            if old_status == status:
+                # Not a transition, see tasks/rollups.py
+                continue
+
+            seconds = completion_seconds(pending_since, updated_date) if status == COMPLETED else None
+            totals.add(user_id, updated_date, status, seconds)
+            if status == PENDING:
+                pending_since = updated_date
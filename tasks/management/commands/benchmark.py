@@ -0,0 +1,313 @@
+import json
+import platform
+import random
+import time
+from datetime import timedelta
+from itertools import count
+
+import django
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import (CaptureQueriesContext, setup_test_environment,
+                               teardown_test_environment)
+from django.utils import timezone
+
+from tasks.cache import task_cache
+from tasks.models import Task, TaskHistory
+from tasks.sync import encode_sync_token
+
+PASSWORD = 'benchmark-password'
+
+
+# One measured route. `path` and `data` are callables taking the fixture
+# returned by `setup`, which runs untimed before every request.
+class Endpoint:
+
+    def __init__(self, name, method, path, data=None, status=200, setup=None, client='user', json=False):
+        self.name = name
+        self.method = method
+        self.path = path
+        self.data = data
+        self.status = status
+        self.setup = setup
+        self.client = client
+        self.json = json
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(max(int(round(fraction * len(values))) - 1, 0), len(values) - 1)]
+
+
+class Command(BaseCommand):
+    help = 'Benchmark every route of the task manager against seeded data, optionally against a baseline'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10, help='Synthetic users seeded')
+        parser.add_argument('--tasks', type=int, default=1000, help='Synthetic tasks seeded, spread across the users')
+        parser.add_argument('--history', type=int, default=5, help='History rows seeded per task with history')
+        parser.add_argument('--requests', type=int, default=100, help='Measured requests per endpoint')
+        parser.add_argument('--warmup', type=int, default=5, help='Unmeasured requests per endpoint')
+        parser.add_argument('--endpoints', help='Comma separated substrings, only run matching endpoints')
+        parser.add_argument('--warm-cache', action='store_true', help='Keep the task read cache between requests')
+        parser.add_argument('--seed', type=int, default=0, help='Random seed for data and request parameters')
+        parser.add_argument('--output', help='Write the results to this JSON file')
+        parser.add_argument('--baseline', help='Compare against the results of an earlier --output run')
+        parser.add_argument('--threshold', type=float, default=20.0,
+                            help='Percent p95 latency or throughput change flagged as a regression')
+
+    def handle(self, *args, **options):
+        self.random = random.Random(options['seed'])
+        self.options = options
+
+        baseline = None
+        if options['baseline']:
+            with open(options['baseline'], encoding='utf-8') as stream:
+                baseline = json.load(stream)
+
+        # Never touch the configured database, benchmark against a throwaway copy
+        setup_test_environment()
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            started = time.perf_counter()
+            self.seed(options['users'], options['tasks'], options['history'])
+            self.stdout.write(f"Seeded {options['tasks']} task(s) for {options['users']} user(s) in {time.perf_counter() - started:.1f}s")
+
+            results = {}
+            for endpoint in self.endpoints():
+                if options['endpoints'] and not any(part in endpoint.name for part in options['endpoints'].split(',')):
+                    continue
+                results[endpoint.name] = self.measure(endpoint, options['requests'], options['warmup'])
+                self.stdout.write(self.format_result(endpoint.name, results[endpoint.name]))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        report = {
+            'meta': {
+                'date': timezone.now().isoformat(),
+                'django': django.get_version(),
+                'python': platform.python_version(),
+                'database': connection.vendor,
+                **{key: options[key] for key in ('users', 'tasks', 'history', 'requests', 'warm_cache', 'seed')},
+            },
+            'endpoints': results,
+        }
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as stream:
+                json.dump(report, stream, indent=2)
+            self.stdout.write(f"Results written to {options['output']}")
+
+        if baseline is not None:
+            regressions = self.compare(baseline, report, options['threshold'])
+            if regressions:
+                raise CommandError(f'{regressions} regression(s) beyond {options["threshold"]:g}%')
+            self.stdout.write(self.style.SUCCESS('No regressions against the baseline'))
+
+    def seed(self, users, tasks, history):
+        words = 'alpha bravo charlie delta echo foxtrot golf hotel india juliet kilo lima mike report invoice'.split()
+        self.users = [User.objects.create_user(f'bench-{i}', password=PASSWORD) for i in range(max(users, 1))]
+        self.user = self.users[0]
+        per_user = max(tasks // len(self.users), 1)
+
+        def build():
+            for user in self.users:
+                for i in range(per_user):
+                    yield Task(
+                        title=' '.join(self.random.sample(words, 3)).upper(),
+                        description=' '.join(self.random.sample(words, 6)),
+                        priority=i + 1,
+                        completed=i % 3 == 0,
+                        status='COMPLETED' if i % 3 == 0 else 'PENDING',
+                        user=user,
+                    )
+
+        batch = []
+        for task in build():
+            batch.append(task)
+            if len(batch) == 5000:
+                Task.objects.bulk_create(batch)
+                batch = []
+        Task.objects.bulk_create(batch)
+
+        self.task_ids = list(Task.objects.filter(user=self.user).values_list('id', flat=True))
+        self.history_task_id = self.task_ids[0]
+
+        # Every tenth task has a history
+        with_history = Task.objects.filter(id__in=self.task_ids[::10]).values_list('id', flat=True)
+        TaskHistory.objects.bulk_create(
+            (
+                TaskHistory(task_id=task_id, old_status='PENDING', new_status='IN_PROGRESS')
+                for task_id in with_history
+                for _ in range(history)
+            ),
+            batch_size=5000,
+        )
+
+        self.clients = {'user': Client(), 'anonymous': Client()}
+        self.clients['user'].force_login(self.user)
+        self.new_ids = count(1)
+
+    def random_task(self):
+        return self.random.choice(self.task_ids)
+
+    def random_priority(self):
+        return self.random.randint(1, len(self.task_ids))
+
+    def throwaway_task(self):
+        return Task.objects.create(
+            title='BENCHMARK THROWAWAY', description='deleted by the benchmark', priority=0, user=self.user
+        ).id
+
+    # Changes of the last minute, what a client syncing regularly asks for
+    def sync_token(self):
+        return encode_sync_token(self.user, [(timezone.now() - timedelta(minutes=1)).isoformat(), 0])
+
+    def task_form(self, fixture=None):
+        return {
+            'title': f'Benchmark task {next(self.new_ids)}',
+            'description': 'benchmark',
+            'priority': self.random_priority(),
+            'status': 'PENDING',
+            'completed': '',
+        }
+
+    def task_json(self, fixture=None):
+        data = self.task_form()
+        data['completed'] = False
+        return data
+
+    def login_client(self):
+        self.clients['logout'] = Client()
+        self.clients['logout'].force_login(self.user)
+
+    def endpoints(self):
+        task_path = lambda template: lambda fixture: template.format(fixture if fixture is not None else self.random_task())
+        offset_path = lambda base: lambda fixture: f'{base}?offset={self.random.randrange(max(len(self.task_ids) - 5, 1))}'
+
+        return [
+            Endpoint('home', 'get', lambda fixture: '/', status=302),
+            Endpoint('signup form', 'get', lambda fixture: '/user/signup', client='anonymous'),
+            Endpoint('login form', 'get', lambda fixture: '/user/login', client='anonymous'),
+            Endpoint('login', 'post', lambda fixture: '/user/login', client='anonymous', status=302,
+                     data=lambda fixture: {'username': self.user.username, 'password': PASSWORD}),
+            Endpoint('logout', 'post', lambda fixture: '/user/logout', client='logout', setup=self.login_client, status=302),
+            Endpoint('admin', 'get', lambda fixture: '/admin/', status=302),
+            Endpoint('html list', 'get', lambda fixture: '/tasks'),
+            Endpoint('html completed list', 'get', lambda fixture: '/completed-tasks'),
+            Endpoint('html pending list', 'get', lambda fixture: '/pending-tasks'),
+            Endpoint('html detail', 'get', task_path('/detail-task/{}')),
+            Endpoint('html create form', 'get', lambda fixture: '/create-task'),
+            Endpoint('html create', 'post', lambda fixture: '/create-task', data=self.task_form, status=302),
+            Endpoint('html update form', 'get', task_path('/update-task/{}')),
+            Endpoint('html update', 'post', task_path('/update-task/{}'), data=self.task_form, status=302),
+            Endpoint('html delete form', 'get', task_path('/delete-task/{}')),
+            Endpoint('html delete', 'post', task_path('/delete-task/{}'), setup=self.throwaway_task, status=302),
+            Endpoint('api list', 'get', offset_path('/api/v1/tasks/')),
+            Endpoint('api list keyset', 'get', lambda fixture: '/api/v1/tasks/?cursor='),
+            Endpoint('api list sparse', 'get', lambda fixture: '/api/v1/tasks/?cursor=&limit=20&fields=id,title,status,priority'),
+            Endpoint('api list filtered', 'get', lambda fixture: '/api/v1/tasks/?completed=false&status=PENDING'),
+            Endpoint('api search', 'get', lambda fixture: f"/api/v1/tasks/?search={self.random.choice(['rep', 'invoice', 'alpha br'])}"),
+            Endpoint('api detail', 'get', task_path('/api/v1/tasks/{}/')),
+            Endpoint('api create', 'post', lambda fixture: '/api/v1/tasks/', data=self.task_json, json=True, status=201),
+            Endpoint('api update', 'put', task_path('/api/v1/tasks/{}/'), data=self.task_json, json=True),
+            Endpoint('api delete', 'delete', task_path('/api/v1/tasks/{}/'), setup=self.throwaway_task, status=204),
+            Endpoint('api batch', 'post', lambda fixture: '/api/v1/tasks/batch/', json=True,
+                     data=lambda fixture: {'create': [self.task_json() for _ in range(10)]}),
+            Endpoint('api sync', 'get', lambda fixture: '/api/v1/tasks/sync/?limit=100'),
+            Endpoint('api sync delta', 'get', lambda fixture: f'/api/v1/tasks/sync/?token={fixture}', setup=self.sync_token),
+            Endpoint('api export ndjson', 'get', lambda fixture: '/api/v1/tasks/export/ndjson/'),
+            Endpoint('api export csv', 'get', lambda fixture: '/api/v1/tasks/export/csv/'),
+            Endpoint('api history', 'get', lambda fixture: f'/api/v1/task/{self.history_task_id}/history/'),
+            Endpoint('api history export', 'get', lambda fixture: f'/api/v1/task/{self.history_task_id}/history/export/ndjson/'),
+            Endpoint('api analytics summary', 'get', lambda fixture: '/api/v1/analytics/rollups/summary/'),
+            Endpoint('api archive', 'get', lambda fixture: '/api/v1/archive/tasks/'),
+            Endpoint('async list', 'get', offset_path('/api/v1/async/tasks/')),
+            Endpoint('async detail', 'get', task_path('/api/v1/async/tasks/{}/')),
+            Endpoint('async history', 'get', lambda fixture: f'/api/v1/async/task/{self.history_task_id}/history/'),
+        ]
+
+    def request(self, endpoint):
+        fixture = endpoint.setup() if endpoint.setup else None
+        if not self.options['warm_cache']:
+            task_cache().clear()
+
+        client = self.clients[endpoint.client]
+        kwargs = {}
+        if endpoint.data is not None:
+            kwargs['data'] = endpoint.data(fixture)
+            if endpoint.json:
+                kwargs['content_type'] = 'application/json'
+        path = endpoint.path(fixture)
+
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            response = getattr(client, endpoint.method)(path, **kwargs)
+            if response.streaming:
+                size = sum(len(chunk) for chunk in response.streaming_content)
+            else:
+                size = len(response.content)
+            elapsed = time.perf_counter() - started
+
+        return elapsed, len(queries), response.status_code == endpoint.status, size
+
+    def measure(self, endpoint, requests, warmup):
+        for _ in range(warmup):
+            self.request(endpoint)
+
+        timings, queries, failures, sizes = [], [], 0, []
+        for _ in range(requests):
+            elapsed, query_count, ok, size = self.request(endpoint)
+            timings.append(elapsed * 1000)
+            queries.append(query_count)
+            sizes.append(size)
+            failures += not ok
+
+        return {
+            'requests': requests,
+            'failures': failures,
+            'p50_ms': round(percentile(timings, 0.50), 3),
+            'p95_ms': round(percentile(timings, 0.95), 3),
+            'p99_ms': round(percentile(timings, 0.99), 3),
+            'throughput_rps': round(requests / (sum(timings) / 1000), 1),
+            'queries': round(sum(queries) / requests, 2),
+            'queries_max': max(queries),
+            'bytes': round(sum(sizes) / requests),
+        }
+
+    def format_result(self, name, result):
+        return '{:<24} p50 {:>8.2f} ms  p95 {:>8.2f} ms  p99 {:>8.2f} ms  {:>7.0f} req/s  {:>5.1f} queries  {}'.format(
+            name, result['p50_ms'], result['p95_ms'], result['p99_ms'], result['throughput_rps'], result['queries'],
+            self.style.ERROR(f"{result['failures']} failed") if result['failures'] else 'ok',
+        )
+
+    # Latency and throughput beyond the threshold, or any extra query or failure, is a regression
+    def compare(self, baseline, report, threshold):
+        if baseline['meta'].get('tasks') != report['meta']['tasks']:
+            self.stdout.write(self.style.WARNING(
+                f"Baseline was seeded with {baseline['meta'].get('tasks')} task(s), this run with {report['meta']['tasks']}"
+            ))
+
+        regressions = 0
+        for name, result in report['endpoints'].items():
+            before = baseline['endpoints'].get(name)
+            if before is None:
+                continue
+
+            problems = []
+            if result['p95_ms'] > before['p95_ms'] * (1 + threshold / 100):
+                problems.append(f"p95 {before['p95_ms']:.2f} -> {result['p95_ms']:.2f} ms")
+            if result['throughput_rps'] < before['throughput_rps'] * (1 - threshold / 100):
+                problems.append(f"throughput {before['throughput_rps']:.0f} -> {result['throughput_rps']:.0f} req/s")
+            if result['failures'] > before['failures']:
+                problems.append(f"failures {before['failures']} -> {result['failures']}")
+            if result['queries'] > before['queries']:
+                problems.append(f"queries {before['queries']:g} -> {result['queries']:g}")
+
+            if problems:
+                regressions += 1
+                self.stdout.write(self.style.ERROR(f"REGRESSION {name}: {', '.join(problems)}"))
+        return regressions
@@ -0,0 +1,55 @@
+import random
+import statistics
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from tasks.models import Task
+from tasks.ranking import cascade_priority
+
+
+class Command(BaseCommand):
+    help = 'Measure priority cascading write latency as the number of open tasks grows'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='100,1000,10000,100000', help='Comma separated open task counts')
+        parser.add_argument('--writes', type=int, default=200, help='Cascading writes measured per size')
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options['sizes'].split(',')]
+
+        # Never touch the configured database, benchmark against a throwaway copy
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            for size in sizes:
+                self.stdout.write(self.run_size(size, options['writes']))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def run_size(self, size, writes):
+        user = User.objects.create(username=f'bench-priority-{size}')
+
+        # Every other slot is taken, so collisions shift short runs as they do in practice
+        Task.objects.bulk_create(
+            (Task(title=f'BENCHMARK TASK {i}', description='', priority=i * 2, user=user) for i in range(size)),
+            batch_size=1000,
+        )
+
+        timings = []
+        for _ in range(writes):
+            priority = random.randrange(size * 2)
+            start = time.perf_counter()
+            cascade_priority(user, priority)
+            timings.append((time.perf_counter() - start) * 1000)
+            Task.objects.create(title='BENCHMARK INSERT', description='', priority=priority, user=user)
+
+        timings.sort()
+        return '{:>8} tasks: mean {:.3f} ms  p50 {:.3f} ms  p95 {:.3f} ms'.format(
+            size,
+            statistics.mean(timings),
+            timings[len(timings) // 2],
+            timings[int(len(timings) * 0.95) - 1],
+        )
@@ -0,0 +1,72 @@
+import gzip
+import statistics
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+from rest_framework.renderers import JSONRenderer
+
+from tasks.models import Task
+from tasks.renderers import FastJSONRenderer, MessagePackRenderer, orjson
+from tasks.serializers import TaskSerializer
+
+SPARSE_FIELDS = ['id', 'title', 'status', 'priority']
+
+
+class Command(BaseCommand):
+    help = 'Compare payload size and serialization time of the API renderers, full and sparse task lists'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tasks', type=int, default=1000, help='Tasks in the rendered list')
+        parser.add_argument('--repeat', type=int, default=50, help='Timed runs per combination')
+
+    def handle(self, *args, **options):
+        # Never touch the configured database, benchmark against a throwaway copy
+        setup_test_environment()
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            user = User.objects.create_user('bench-renderers')
+            Task.objects.bulk_create([
+                Task(
+                    user=user, priority=number, title=f'Benchmark task {number:06}',
+                    description=f'Rendered by the renderer benchmark, task number {number}',
+                    status=('PENDING', 'IN_PROGRESS', 'COMPLETED')[number % 3], completed=number % 3 == 2,
+                )
+                for number in range(options['tasks'])
+            ])
+
+            renderers = [('drf json', JSONRenderer()), ('orjson', FastJSONRenderer() if orjson else None),
+                         ('msgpack', MessagePackRenderer() if MessagePackRenderer.available else None)]
+            for name, renderer in renderers:
+                if renderer is None:
+                    self.stdout.write(f'{name:<10} not installed, skipped')
+            renderers = [(name, renderer) for name, renderer in renderers if renderer is not None]
+
+            for label, fields in (('full', None), ('sparse', SPARSE_FIELDS)):
+                rows = list(Task.objects.filter(user=user).order_by('priority').values(*TaskSerializer.columns_for(fields)))
+                build = lambda: [TaskSerializer.from_values(row, fields=fields) for row in rows]
+                build_time = self.time(build, options['repeat'])
+                data = build()
+
+                for name, renderer in renderers:
+                    render_time = self.time(lambda: renderer.render(data), options['repeat'])
+                    content = renderer.render(data)
+                    self.stdout.write(
+                        '{:<7} {:<10} build {:>7.2f} ms  render {:>7.2f} ms  {:>9} bytes  {:>8} gzipped'.format(
+                            label, name, build_time, render_time, len(content), len(gzip.compress(content, 6)),
+                        )
+                    )
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+    def time(self, function, repeat):
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            function()
+            timings.append((time.perf_counter() - started) * 1000)
+        return statistics.median(timings)
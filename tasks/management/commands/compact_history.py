@@ -0,0 +1,99 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, F, Max, Min, Q
+from django.utils import timezone
+
+from tasks.cache import invalidate_user_tasks
+from tasks.models import Task, TaskHistory, TaskHistorySummary
+from tasks.shards import each_shard
+
+
+class Command(BaseCommand):
+    help = 'Fold task history older than the retention window into per-task summaries'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.TASK_HISTORY_RETENTION_DAYS,
+                            help='Keep history rows newer than this many days')
+        parser.add_argument('--batch-size', type=int, default=500, help='Tasks compacted per transaction')
+        parser.add_argument('--dry-run', action='store_true', help='Only count what would be compacted')
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options['days'])
+        old_history = TaskHistory.objects.filter(updated_date__lt=cutoff)
+
+        if options['dry_run']:
+            for alias in each_shard():
+                counts = old_history.aggregate(rows=Count('id'), tasks=Count('task', distinct=True))
+                self.stdout.write(f"{alias}: {counts['rows']} history row(s) of {counts['tasks']} task(s) older than {cutoff:%Y-%m-%d}")
+            return
+
+        compacted_tasks = compacted_rows = 0
+        for alias in each_shard():
+            last_task_id = 0
+            while True:
+                task_ids = list(
+                    old_history.filter(task_id__gt=last_task_id)
+                    .order_by('task_id')
+                    .values_list('task_id', flat=True)
+                    .distinct()[:options['batch_size']]
+                )
+                if not task_ids:
+                    break
+
+                compacted_rows += self.compact(task_ids, cutoff, alias)
+                compacted_tasks += len(task_ids)
+                last_task_id = task_ids[-1]
+                self.stdout.write(f'{compacted_tasks} task(s), {compacted_rows} row(s) compacted')
+
+        self.stdout.write(self.style.SUCCESS(f'Compacted {compacted_rows} history row(s) of {compacted_tasks} task(s)'))
+
+    # One short transaction per batch of tasks, the summaries commit with the
+    # delete. Rows that keep the status (an import's first row) date the summary
+    # but are not counted as transitions, see tasks/rollups.py.
+    def compact(self, task_ids, cutoff, alias):
+        with transaction.atomic(using=alias):
+            rows = (
+                TaskHistory.objects.filter(task_id__in=task_ids, updated_date__lt=cutoff)
+                .values('task_id', 'new_status')
+                .annotate(
+                    count=Count('id', filter=~Q(old_status=F('new_status'))),
+                    first_date=Min('updated_date'),
+                    last_date=Max('updated_date'),
+                )
+                .order_by()
+            )
+            summaries = TaskHistorySummary.objects.select_for_update().in_bulk(task_ids, field_name='task_id')
+
+            changed = {}
+            for row in rows:
+                summary = changed.get(row['task_id']) or summaries.get(row['task_id'])
+                if summary is None:
+                    summary = TaskHistorySummary(task_id=row['task_id'])
+                changed[row['task_id']] = summary
+
+                if row['count']:
+                    summary.transitions += row['count']
+                    summary.status_counts[row['new_status']] = summary.status_counts.get(row['new_status'], 0) + row['count']
+                if summary.first_date is None or row['first_date'] < summary.first_date:
+                    summary.first_date = row['first_date']
+                if summary.last_date is None or row['last_date'] >= summary.last_date:
+                    summary.last_date = row['last_date']
+                    summary.last_status = row['new_status']
+
+            TaskHistorySummary.objects.bulk_create([summary for summary in changed.values() if summary.pk is None])
+            TaskHistorySummary.objects.bulk_update(
+                [summary for summary in changed.values() if summary.pk is not None],
+                ['transitions', 'status_counts', 'last_status', 'first_date', 'last_date'],
+            )
+
+            deleted, _ = TaskHistory.objects.filter(task_id__in=task_ids, updated_date__lt=cutoff).delete()
+
+            user_ids = set(Task.all_objects.filter(id__in=task_ids).values_list('user_id', flat=True))
+            for user in User.objects.filter(pk__in=user_ids):
+                invalidate_user_tasks(user)
+
+        return deleted
@@ -0,0 +1,191 @@
+import csv
+import json
+import sys
+import time
+from pathlib import Path
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from rest_framework.exceptions import ValidationError
+
+from tasks.cache import invalidate_user_tasks
+from tasks.counters import adjust_task_counters
+from tasks.history import buffered_history, record_task_history
+from tasks.models import Task, TaskImport
+from tasks.ranking import active_tasks
+from tasks.rollups import mark_pending
+from tasks.serializers import TaskSerializer
+from tasks.shards import shard_for_user, use_shard, use_shard_for
+
+
+# Next free priority lookups over a user's taken slots. Each taken slot points
+# past itself and lookups compress the chains they walk, so placing many tasks
+# into a crowded range stays close to constant time per task.
+class FreeSlots:
+
+    def __init__(self, taken):
+        self.next = {priority: priority + 1 for priority in taken}
+
+    def take(self, priority):
+        path = []
+        while priority in self.next:
+            path.append(priority)
+            priority = self.next[priority]
+        for slot in path:
+            self.next[slot] = priority + 1
+        self.next[priority] = priority + 1
+        return priority
+
+
+# NDJSON lines are parsed one by one in build_task, so a bad line is rejected
+# like an invalid record. Blank lines keep their number: positions are line
+# numbers, in the errors and in the saved progress.
+def read_ndjson(stream):
+    for line in stream:
+        yield line if line.strip() else None
+
+
+class Command(BaseCommand):
+    help = 'Bulk import tasks from NDJSON or CSV, resumable after a crash'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="Input file, or '-' for stdin")
+        parser.add_argument('--format', choices=['ndjson', 'csv'], help='Input format (default: from the file extension)')
+        parser.add_argument('--user', help="Owner for rows without a 'user' column")
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--with-history', action='store_true', help='Write an initial TaskHistory row per task')
+        parser.add_argument('--source', help='Name the progress is saved under (default: the resolved path)')
+        parser.add_argument('--restart', action='store_true', help='Ignore saved progress and start from the top')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        input_format = options['format'] or ('csv' if path.endswith('.csv') else 'ndjson')
+        source = options['source'] or (None if path == '-' else str(Path(path).resolve()))
+
+        self.batch_size = options['batch_size']
+        self.with_history = options['with_history']
+        self.serializer = TaskSerializer()
+        self.users = {}
+        self.free_slots = {}
+        self.default_user = self.get_user(options['user']) if options['user'] else None
+
+        self.progress = None
+        if source:
+            self.progress, _ = TaskImport.objects.get_or_create(source=source)
+            if options['restart']:
+                self.progress.position = self.progress.imported = 0
+                self.progress.save()
+            elif self.progress.position:
+                self.stdout.write(f'Resuming {source} after record {self.progress.position}')
+        skip = self.progress.position if self.progress else 0
+
+        stream = sys.stdin if path == '-' else open(path, newline='', encoding='utf-8')
+        with stream:
+            records = csv.DictReader(stream) if input_format == 'csv' else read_ndjson(stream)
+            self.import_records(records, skip)
+
+    def get_user(self, username):
+        if username not in self.users:
+            try:
+                self.users[username] = User.objects.get(username=username)
+            except User.DoesNotExist:
+                raise CommandError(f'Unknown user: {username}')
+        return self.users[username]
+
+    # Priorities of a user's open tasks, loaded once and kept up to date in memory
+    def get_free_slots(self, user):
+        if user.pk not in self.free_slots:
+            with use_shard_for(user):
+                self.free_slots[user.pk] = FreeSlots(list(active_tasks(user).values_list('priority', flat=True)))
+        return self.free_slots[user.pk]
+
+    def import_records(self, records, skip):
+        batch, position, imported, rejected = [], 0, 0, 0
+        started = time.monotonic()
+
+        for position, record in enumerate(records, start=1):
+            if position <= skip or record is None:
+                continue
+
+            task = self.build_task(position, record)
+            if task is None:
+                rejected += 1
+            else:
+                batch.append(task)
+
+            if len(batch) >= self.batch_size:
+                imported += self.flush(batch, position)
+                batch = []
+                self.report(imported, rejected, started)
+
+        imported += self.flush(batch, position)
+        self.report(imported, rejected, started)
+        self.stdout.write(self.style.SUCCESS(f'Imported {imported} task(s), rejected {rejected}'))
+
+    def build_task(self, position, record):
+        if isinstance(record, str):
+            try:
+                record = json.loads(record)
+            except ValueError as error:
+                self.stderr.write(f'Record {position}: invalid JSON: {error}')
+                return None
+            if not isinstance(record, dict):
+                self.stderr.write(f'Record {position}: expected a JSON object')
+                return None
+
+        # CSV has no nulls, treat empty cells as missing
+        record = {key: value for key, value in record.items() if value != ''}
+        username = record.get('user') or None
+        if username is None and self.default_user is None:
+            self.stderr.write(f'Record {position}: no user given and no --user default')
+            return None
+
+        # Same validation rules as the API, one serializer reused for every record
+        try:
+            validated_data = self.serializer.run_validation(record)
+        except ValidationError as error:
+            self.stderr.write(f'Record {position}: {error.detail}')
+            return None
+
+        user = self.get_user(username) if username else self.default_user
+        task = Task(user=user, **validated_data)
+        mark_pending(task)
+
+        # Collisions move the imported task to the next free slot, existing tasks stay put
+        if not task.completed:
+            task.priority = self.get_free_slots(user).take(task.priority)
+        return task
+
+    # With several shards, each one's rows commit just before the progress: a
+    # crash in between can import them twice
+    def flush(self, batch, position):
+        shards = {}
+        for user in {task.user for task in batch}:
+            shards.setdefault(shard_for_user(user), []).append(user)
+
+        with transaction.atomic():
+            for alias, users in shards.items():
+                with use_shard(alias), transaction.atomic(using=alias), buffered_history(using=alias):
+                    tasks = [task for task in batch if task.user in users]
+                    Task.objects.bulk_create(tasks, batch_size=self.batch_size)
+                    if self.with_history:
+                        for task in tasks:
+                            record_task_history(task, task.status, task.status)
+
+                    for user in users:
+                        user_tasks = [task for task in tasks if task.user == user]
+                        adjust_task_counters(user, total=len(user_tasks), completed=sum(task.completed for task in user_tasks))
+                        invalidate_user_tasks(user)
+
+            # Progress commits with the rows on 'default'
+            if self.progress:
+                self.progress.position = position
+                self.progress.imported += len(batch)
+                self.progress.save()
+
+        return len(batch)
+
+    def report(self, imported, rejected, started):
+        elapsed = max(time.monotonic() - started, 1e-9)
+        self.stdout.write(f'{imported} imported, {rejected} rejected, {imported / elapsed:.0f} tasks/s')
@@ -0,0 +1,116 @@
+import asyncio
+import statistics
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.asgi import get_asgi_application
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client
+
+from tasks.models import Task, TaskHistory
+
+
+class Command(BaseCommand):
+    help = 'Drive the ASGI application in-process with many concurrent connections'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', default='10,100,500,1000', help='Comma separated concurrent connection counts')
+        parser.add_argument('--tasks', type=int, default=200, help='Tasks seeded for the test user')
+        parser.add_argument('--paths', default='/api/v1/tasks/,/api/v1/async/tasks/,/api/v1/async/task/1/history/')
+
+    def handle(self, *args, **options):
+        # Never touch the configured database, load test against a throwaway copy
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            cookie = self.seed(options['tasks'])
+            application = get_asgi_application()
+            for path in options['paths'].split(','):
+                for concurrency in [int(value) for value in options['concurrency'].split(',')]:
+                    result = asyncio.run(self.run_level(application, path, concurrency, cookie))
+                    self.stdout.write(self.format_result(path, concurrency, result))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def seed(self, count):
+        user = User.objects.create_user('loadtest')
+        tasks = Task.objects.bulk_create(
+            Task(title=f'LOAD TEST TASK {i}', description='load test', priority=i, user=user) for i in range(count)
+        )
+        TaskHistory.objects.bulk_create(
+            TaskHistory(task=tasks[0], old_status='PENDING', new_status='IN_PROGRESS') for _ in range(20)
+        )
+
+        client = Client()
+        client.force_login(user)
+        return client.cookies[settings.SESSION_COOKIE_NAME].value
+
+    # One connection per coroutine, all opened at once
+    async def run_level(self, application, path, concurrency, cookie):
+        in_flight = peak = 0
+
+        async def connection_task():
+            nonlocal in_flight, peak
+            in_flight += 1
+            peak = max(peak, in_flight)
+            started = time.perf_counter()
+            status = await self.request(application, path, cookie)
+            in_flight -= 1
+            return status, time.perf_counter() - started
+
+        started = time.perf_counter()
+        results = await asyncio.gather(*(connection_task() for _ in range(concurrency)))
+        return results, time.perf_counter() - started, peak
+
+    async def request(self, application, path, cookie):
+        scope = {
+            'type': 'http',
+            'asgi': {'version': '3.0'},
+            'http_version': '1.1',
+            'method': 'GET',
+            'scheme': 'http',
+            'path': path,
+            'raw_path': path.encode(),
+            'query_string': b'',
+            'root_path': '',
+            'headers': [
+                (b'host', b'localhost'),
+                (b'cookie', f'{settings.SESSION_COOKIE_NAME}={cookie}'.encode()),
+            ],
+            'client': ('127.0.0.1', 0),
+            'server': ('localhost', 80),
+        }
+        request_sent = False
+        status = None
+
+        async def receive():
+            nonlocal request_sent
+            if not request_sent:
+                request_sent = True
+                return {'type': 'http.request', 'body': b'', 'more_body': False}
+            # Keep the connection open until the response is done
+            await asyncio.Future()
+
+        async def send(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+
+        await application(scope, receive, send)
+        return status
+
+    def format_result(self, path, concurrency, result):
+        results, elapsed, peak = result
+        latencies = sorted(latency * 1000 for _, latency in results)
+        failures = sum(1 for status, _ in results if status != 200)
+        return '{:<40} {:>5} conns  peak {:>5} open  {:>7.0f} req/s  p50 {:>8.1f} ms  p99 {:>8.1f} ms  {} failed'.format(
+            path,
+            concurrency,
+            peak,
+            len(results) / elapsed,
+            statistics.median(latencies),
+            latencies[max(int(len(latencies) * 0.99) - 1, 0)],
+            failures,
+        )
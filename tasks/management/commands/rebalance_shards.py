@@ -0,0 +1,212 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Count
+from django.utils import timezone
+
+from tasks.cache import user_tasks_changed
+from tasks.models import (ArchivedTask, ArchivedTaskHistory, Task, TaskCounter, TaskHistory, TaskHistorySummary,
+                          TaskStatusRollup, UserShard)
+from tasks.shards import FROZEN, MOVING, get_placement, mirror_user
+
+# Moves a user between shards while they keep working:
+#
+#   1. copy everything to the target, in short batches, while writes go on
+#   2. copy again what changed meanwhile (a task's created_date is its last
+#      change, history and archive rows only ever appear or disappear)
+#   3. freeze the user: new requests can read but not write, and those in
+#      flight get TASK_SHARD_FREEZE_SECONDS to finish
+#   4. copy the last changes, drop what was deleted meanwhile, and switch the
+#      user over to the target
+#   5. delete the user's rows from the source
+#
+# A move that fails leaves the user on the source and can simply be rerun.
+
+
+class Command(BaseCommand):
+    help = 'Move users, with their tasks and history, to another shard'
+
+    def add_arguments(self, parser):
+        parser.add_argument('usernames', nargs='*', help='Users to move')
+        parser.add_argument('--to', dest='target', help='Shard to move them to')
+        parser.add_argument('--from', dest='source', help='Move users off this shard instead of naming them')
+        parser.add_argument('--limit', type=int, default=1, help='Users moved off the --from shard')
+        parser.add_argument('--batch-size', type=int, default=500, help='Rows copied per transaction')
+        parser.add_argument('--status', action='store_true', help='Only show users and tasks per shard')
+
+    def handle(self, *args, **options):
+        if options['status']:
+            return self.status()
+
+        target = options['target']
+        if target not in settings.TASK_SHARDS:
+            raise CommandError(f"--to must be one of: {', '.join(settings.TASK_SHARDS)}")
+        self.batch_size = options['batch_size']
+
+        if options['source']:
+            users = self.users_on(options['source'], options['limit'])
+        else:
+            users = list(User.objects.filter(username__in=options['usernames']).order_by('pk'))
+            missing = set(options['usernames']) - {user.username for user in users}
+            if missing:
+                raise CommandError(f"Unknown users: {', '.join(sorted(missing))}")
+        if not users:
+            raise CommandError('No users to move')
+
+        for user in users:
+            self.move(user, target)
+
+    def status(self):
+        placed = dict(UserShard.objects.values('shard').annotate(users=Count('id')).values_list('shard', 'users'))
+        # Users without a row are on 'default'
+        placed['default'] = placed.get('default', 0) + User.objects.filter(task_shard__isnull=True).count()
+        for alias in settings.TASK_SHARDS:
+            tasks = Task.all_objects.using(alias).count()
+            self.stdout.write(f'{alias}: {placed.get(alias, 0)} user(s), {tasks} task(s)')
+
+    def users_on(self, alias, limit):
+        if alias not in settings.TASK_SHARDS:
+            raise CommandError(f"--from must be one of: {', '.join(settings.TASK_SHARDS)}")
+        users = User.objects.order_by('pk')
+        if alias == 'default':
+            users = users.exclude(task_shard__shard__in=[shard for shard in settings.TASK_SHARDS if shard != 'default'])
+        else:
+            users = users.filter(task_shard__shard=alias)
+        return list(users[:limit])
+
+    def move(self, user, target):
+        placement = get_placement(user.pk)
+        source = placement.shard
+        if source == target:
+            self.stdout.write(f'{user.username} is already on {target}')
+            return
+
+        mirror_user(user, target)
+        self.set_state(user, state=MOVING, target=target)
+        # Writes are stamped before they commit, look back as far as sync does
+        grace = timedelta(seconds=settings.TASK_SYNC_GRACE_SECONDS)
+        try:
+            started = timezone.now()
+            copied = self.copy(user, source, target)
+            self.stdout.write(f'{user.username}: {copied} row(s) copied to {target}')
+
+            caught_up = timezone.now()
+            copied = self.copy(user, source, target, since=started - grace)
+
+            self.set_state(user, state=FROZEN, target=target)
+            time.sleep(settings.TASK_SHARD_FREEZE_SECONDS)
+            copied += self.copy(user, source, target, since=caught_up - grace, final=True)
+            self.stdout.write(f'{user.username}: {copied} changed row(s) caught up')
+
+            self.set_state(user, shard=target)
+        except BaseException:
+            self.set_state(user, shard=source)
+            self.delete_rows(user, target)
+            raise
+        user_tasks_changed(user.pk)
+
+        deleted = self.delete_rows(user, source)
+        self.stdout.write(self.style.SUCCESS(f'{user.username}: moved from {source} to {target}, {deleted} row(s) removed from {source}'))
+
+    def set_state(self, user, shard=None, state='', target=''):
+        defaults = {'state': state, 'target': target}
+        if shard is not None:
+            defaults['shard'] = shard
+        elif not UserShard.objects.filter(user=user).exists():
+            # Users from before sharding get their row now
+            defaults['shard'] = 'default'
+        UserShard.objects.update_or_create(user=user, defaults=defaults)
+
+    # Returns the number of rows written to the target
+    def copy(self, user, source, target, since=None, final=False):
+        tasks = Task.all_objects.using(source).filter(user_id=user.pk)
+        history = TaskHistory.objects.using(source).filter(task__user_id=user.pk)
+        archived = ArchivedTask.objects.using(source).filter(user_id=user.pk)
+        archived_history = ArchivedTaskHistory.objects.using(source).filter(task__user_id=user.pk)
+
+        copied = self.write_rows(Task, tasks.filter(created_date__gte=since) if since else tasks, target, update=True)
+        copied += self.write_rows(TaskHistory, history, target)
+        copied += self.write_rows(ArchivedTask, archived, target)
+        copied += self.write_rows(ArchivedTaskHistory, archived_history, target)
+
+        if final:
+            # Archived and compacted meanwhile
+            self.delete_missing(ArchivedTaskHistory, archived_history, target)
+            self.delete_missing(ArchivedTask, archived, target)
+            self.delete_missing(TaskHistory, history, target)
+            self.delete_missing(Task, tasks, target)
+
+        # A handful of rows per user, replaced whole
+        with transaction.atomic(using=target):
+            for model, rows in (
+                (TaskHistorySummary, TaskHistorySummary.objects.using(source).filter(task__user_id=user.pk)),
+                (TaskCounter, TaskCounter.objects.using(source).filter(user_id=user.pk)),
+                (TaskStatusRollup, TaskStatusRollup.objects.using(source).filter(user_id=user.pk)),
+            ):
+                rows.using(target).delete()
+                copied += len(model.objects.using(target).bulk_create([model(**row) for row in rows.values()]))
+        return copied
+
+    # Rows missing from the target, and with update=True rows already there,
+    # in primary key order and one transaction per batch
+    def write_rows(self, model, rows, target, update=False):
+        manager = model._base_manager.using(target)
+        fields = [field.name for field in model._meta.concrete_fields if not field.primary_key]
+        auto_fields = [
+            field.name for field in model._meta.concrete_fields
+            if getattr(field, 'auto_now', False) or getattr(field, 'auto_now_add', False)
+        ]
+
+        written = 0
+        last_pk = None
+        while True:
+            batch = rows.order_by('pk')
+            if last_pk is not None:
+                batch = batch.filter(pk__gt=last_pk)
+            objects = [model(**row) for row in batch.values()[:self.batch_size]]
+            if not objects:
+                return written
+            last_pk = objects[-1].pk
+
+            existing = set(manager.filter(pk__in=[obj.pk for obj in objects]).values_list('pk', flat=True))
+            created = [obj for obj in objects if obj.pk not in existing]
+            changed = objects if update else []
+            with transaction.atomic(using=target):
+                manager.bulk_create(created)
+                # bulk_update leaves auto_now alone, which puts back the dates bulk_create stamped
+                if changed:
+                    manager.bulk_update(changed, fields)
+                elif created and auto_fields:
+                    manager.bulk_update(created, auto_fields)
+            written += len(created) + len(changed)
+
+    # `rows` is a queryset on the source, the same filters select the user's rows on the target
+    def delete_missing(self, model, rows, target):
+        kept = set(rows.values_list('pk', flat=True))
+        gone = [pk for pk in rows.using(target).values_list('pk', flat=True) if pk not in kept]
+        for start in range(0, len(gone), self.batch_size):
+            with transaction.atomic(using=target):
+                model._base_manager.using(target).filter(pk__in=gone[start:start + self.batch_size]).delete()
+
+    def delete_rows(self, user, alias):
+        deleted = 0
+        tasks = Task.all_objects.using(alias).filter(user_id=user.pk)
+        archived = ArchivedTask.objects.using(alias).filter(user_id=user.pk)
+        for rows in (tasks, archived):
+            while True:
+                ids = list(rows.order_by('pk').values_list('pk', flat=True)[:self.batch_size])
+                if not ids:
+                    break
+                with transaction.atomic(using=alias):
+                    # History and summaries go along
+                    deleted += rows.filter(pk__in=ids).delete()[0]
+        with transaction.atomic(using=alias):
+            deleted += TaskCounter.objects.using(alias).filter(user_id=user.pk).delete()[0]
+            deleted += TaskStatusRollup.objects.using(alias).filter(user_id=user.pk).delete()[0]
+            if alias != 'default':
+                User.objects.using(alias).filter(pk=user.pk).delete()
+        return deleted
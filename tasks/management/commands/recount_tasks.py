@@ -0,0 +1,39 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from tasks.cache import invalidate_user_tasks
+from tasks.counters import recount_task_counters
+from tasks.models import TaskCounter
+from tasks.shards import use_shard_for
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the per-user task counters from the task table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('usernames', nargs='*', help='Only repair these users (default: everyone)')
+        parser.add_argument('--check', action='store_true', help='Report drifted counters without fixing them')
+
+    def handle(self, *args, **options):
+        users = User.objects.order_by('pk')
+        if options['usernames']:
+            users = users.filter(username__in=options['usernames'])
+            missing = set(options['usernames']) - set(users.values_list('username', flat=True))
+            if missing:
+                raise CommandError(f"Unknown users: {', '.join(sorted(missing))}")
+
+        drifted = 0
+        for user in users.iterator():
+            # One short transaction per user keeps locks brief on large installs
+            with use_shard_for(user) as db, transaction.atomic(using=db):
+                before = TaskCounter.objects.filter(user=user).values_list('total', 'completed').first()
+                counter = recount_task_counters(user)
+                if before != (counter.total, counter.completed):
+                    drifted += 1
+                    invalidate_user_tasks(user)
+                    self.stdout.write(f'{user.username}: {before} -> ({counter.total}, {counter.completed})')
+                if options['check']:
+                    transaction.set_rollback(True)
+
+        self.stdout.write(self.style.SUCCESS(f'{drifted} drifted counter(s) ' + ('found' if options['check'] else 'repaired')))
@@ -0,0 +1,114 @@
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from tasks.jobs import (Worker, enqueue_scheduled, purge_finished, registry, renew_leases, requeue_expired,
+                        worker_name, worker_prefix)
+
+# Housekeeping runs at most this often, in the main thread of each process
+HOUSEKEEPING_INTERVAL = 30
+
+
+class Command(BaseCommand):
+    help = 'Run background jobs from the database queue'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=settings.TASK_JOBS_THREADS, help='Worker threads per process')
+        parser.add_argument('--processes', type=int, default=1, help='Worker processes, each with --threads threads')
+        parser.add_argument('--jobs', help='Comma separated job names to run (default: all)')
+        parser.add_argument('--poll-interval', type=float, default=settings.TASK_JOBS_POLL_INTERVAL,
+                            help='Seconds an idle worker waits before looking for jobs again')
+        parser.add_argument('--once', action='store_true', help='Run the jobs ready now, then exit')
+        parser.add_argument('--no-schedule', action='store_true', help="Don't queue the TASK_JOBS_SCHEDULE jobs")
+
+    def handle(self, *args, **options):
+        names = options['jobs'].split(',') if options['jobs'] else None
+        unknown = set(names or []) - set(registry)
+        if unknown:
+            raise CommandError(f"Unknown jobs: {', '.join(sorted(unknown))}")
+        if options['threads'] < 1 or options['processes'] < 1:
+            raise CommandError('--threads and --processes must be at least 1')
+
+        if options['processes'] > 1:
+            return self.run_processes(options)
+
+        if options['once']:
+            requeue_expired()
+            if not options['no_schedule']:
+                enqueue_scheduled()
+            processed = self.run_threads(names, options, once=True)
+            self.stdout.write(self.style.SUCCESS(f'Ran {processed} job(s)'))
+            return
+
+        stop = threading.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *args: stop.set())
+        self.stdout.write(f"Running {options['threads']} worker thread(s)")
+        processed = self.run_threads(names, options, stop=stop)
+        self.stdout.write(self.style.SUCCESS(f'Stopped after {processed} job(s)'))
+
+    def run_threads(self, names, options, once=False, stop=None):
+        workers = [Worker(worker_name(index), names, options['poll_interval']) for index in range(options['threads'])]
+        if once and len(workers) == 1:
+            # No thread needed, which keeps the caller's connection (and transaction)
+            workers[0].drain()
+            return workers[0].processed
+
+        threads = [
+            threading.Thread(target=self.run_worker, args=(worker, once, stop), daemon=True)
+            for worker in workers
+        ]
+        for thread in threads:
+            thread.start()
+
+        if not once:
+            last_housekeeping = 0
+            while not stop.wait(options['poll_interval']):
+                if time.monotonic() - last_housekeeping >= HOUSEKEEPING_INTERVAL:
+                    self.housekeeping(options)
+                    last_housekeeping = time.monotonic()
+        # A stopping worker finishes its current job first
+        for thread in threads:
+            thread.join()
+        return sum(worker.processed for worker in workers)
+
+    def run_worker(self, worker, once, stop):
+        try:
+            if once:
+                worker.drain()
+            else:
+                worker.run(stop)
+        finally:
+            connection.close()
+
+    def housekeeping(self, options):
+        renew_leases(worker_prefix())
+        requeue_expired()
+        if not options['no_schedule']:
+            enqueue_scheduled()
+        purge_finished()
+
+    # Every process runs its own threads and housekeeping, the queue keeps them apart
+    def run_processes(self, options):
+        command = [sys.executable, '-m', 'django', 'run_workers', '--threads', str(options['threads']),
+                   '--poll-interval', str(options['poll_interval'])]
+        if options['jobs']:
+            command += ['--jobs', options['jobs']]
+        if options['once']:
+            command.append('--once')
+        if options['no_schedule']:
+            command.append('--no-schedule')
+
+        children = [subprocess.Popen(command) for _ in range(options['processes'])]
+        forward = lambda signum, frame: [child.send_signal(signum) for child in children]
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, forward)
+        failed = [child for child in children if child.wait() != 0]
+        if failed:
+            raise CommandError(f'{len(failed)} worker process(es) failed')
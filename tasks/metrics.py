@@ -0,0 +1,259 @@
+import atexit
+import contextvars
+import functools
+import hmac
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+
+
+# Per-request timings and per-route histograms.
+#
+# RequestMetricsMiddleware (tasks/middleware.py) opens a RequestTimings for
+# every request in a context variable. Query time is added by an execute
+# wrapper installed on every database connection, serializer and template
+# render time by timed() sections. Context variables follow the request into
+# sync_to_async threads, so the async views are measured as well.
+#
+# Each worker process aggregates its histograms in memory and dumps them to
+# its own file in TASK_METRICS_DIR, at most once per TASK_METRICS_FLUSH_INTERVAL
+# seconds. /metrics merges every worker's file into one Prometheus exposition.
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Server-Timing metric names and descriptions
+SECTIONS = {
+    'db': 'Database',
+    'serialize': 'Serializers',
+    'render': 'Rendering',
+}
+
+
+class RequestTimings:
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.durations = dict.fromkeys(SECTIONS, 0.0)
+        self.queries = 0
+        self.depth = dict.fromkeys(SECTIONS, 0)
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def server_timing(self):
+        metrics = [f'{name};dur={self.durations[name] * 1000:.2f};desc="{description}"' for name, description in SECTIONS.items()]
+        metrics.insert(1, f'queries;desc="{self.queries} queries"')
+        metrics.append(f'total;dur={self.elapsed() * 1000:.2f}')
+        return ', '.join(metrics)
+
+
+current_timings = contextvars.ContextVar('current_timings', default=None)
+
+
+# Time a section of the current request. Nested sections of the same name (a
+# serializer nesting another one) are only counted once.
+@contextmanager
+def timed(name):
+    timings = current_timings.get()
+    if timings is None or timings.depth[name]:
+        yield
+        return
+
+    timings.depth[name] += 1
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.durations[name] += time.perf_counter() - started
+        timings.depth[name] -= 1
+
+
+def timed_function(name):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with timed(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# Execute wrapper for every connection, see TasksConfig.ready()
+def record_query(execute, sql, params, many, context):
+    timings = current_timings.get()
+    if timings is None:
+        return execute(sql, params, many, context)
+
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        timings.durations['db'] += time.perf_counter() - started
+        timings.queries += 1
+
+
+def install_query_timer(sender, connection, **kwargs):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+class MetricsRegistry:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.routes = {}
+        self.statuses = {}
+        self.last_flush = 0.0
+
+    def observe(self, method, route, status, timings):
+        duration = timings.elapsed()
+        with self.lock:
+            series = self.routes.setdefault(f'{method} {route}', {
+                'buckets': [0] * len(DURATION_BUCKETS),
+                'count': 0,
+                'sum': 0.0,
+                'queries': 0,
+                **{name: 0.0 for name in SECTIONS},
+            })
+            for index, bound in enumerate(DURATION_BUCKETS):
+                if duration <= bound:
+                    series['buckets'][index] += 1
+            series['count'] += 1
+            series['sum'] += duration
+            series['queries'] += timings.queries
+            for name in SECTIONS:
+                series[name] += timings.durations[name]
+
+            key = f'{method} {status} {route}'
+            self.statuses[key] = self.statuses.get(key, 0) + 1
+
+        if time.monotonic() - self.last_flush >= settings.TASK_METRICS_FLUSH_INTERVAL:
+            self.flush()
+
+    def snapshot(self):
+        with self.lock:
+            return json.loads(json.dumps({'routes': self.routes, 'statuses': self.statuses}))
+
+    # Written to a temporary file first, readers never see a partial dump. A
+    # thread finding another one flushing skips, the next request catches up.
+    def flush(self):
+        if not self.flush_lock.acquire(blocking=False):
+            return
+        try:
+            self.last_flush = time.monotonic()
+            directory = Path(settings.TASK_METRICS_DIR)
+            directory.mkdir(parents=True, exist_ok=True)
+
+            path = directory / f'metrics-{os.getpid()}.json'
+            temporary = path.with_suffix('.tmp')
+            temporary.write_text(json.dumps(self.snapshot()))
+            os.replace(temporary, path)
+        finally:
+            self.flush_lock.release()
+
+
+registry = MetricsRegistry()
+
+
+@atexit.register
+def flush_on_exit():
+    if registry.routes:
+        registry.flush()
+
+
+# Sum every worker's dump, this process's live counters replace its own file
+def merged_snapshots():
+    merged = {'routes': {}, 'statuses': {}}
+    own_file = f'metrics-{os.getpid()}.json'
+
+    snapshots = [registry.snapshot()]
+    for path in Path(settings.TASK_METRICS_DIR).glob('metrics-*.json'):
+        if path.name != own_file:
+            try:
+                snapshots.append(json.loads(path.read_text()))
+            except (OSError, ValueError):
+                continue
+
+    for snapshot in snapshots:
+        for key, series in snapshot['routes'].items():
+            total = merged['routes'].setdefault(key, {
+                'buckets': [0] * len(DURATION_BUCKETS), 'count': 0, 'sum': 0.0, 'queries': 0,
+                **{name: 0.0 for name in SECTIONS},
+            })
+            total['buckets'] = [a + b for a, b in zip(total['buckets'], series['buckets'])]
+            for field in ('count', 'sum', 'queries', *SECTIONS):
+                total[field] += series[field]
+        for key, value in snapshot['statuses'].items():
+            merged['statuses'][key] = merged['statuses'].get(key, 0) + value
+    return merged
+
+
+def label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def labels(**values):
+    return '{' + ','.join(f'{name}="{label_value(value)}"' for name, value in values.items()) + '}'
+
+
+def exposition(snapshot):
+    lines = [
+        '# HELP task_manager_request_duration_seconds Request duration per route.',
+        '# TYPE task_manager_request_duration_seconds histogram',
+    ]
+    for key, series in sorted(snapshot['routes'].items()):
+        method, route = key.split(' ', 1)
+        for bound, count in zip(DURATION_BUCKETS, series['buckets']):
+            lines.append(f'task_manager_request_duration_seconds_bucket{labels(method=method, route=route, le=bound)} {count}')
+        lines.append(f'task_manager_request_duration_seconds_bucket{labels(method=method, route=route, le="+Inf")} {series["count"]}')
+        lines.append(f'task_manager_request_duration_seconds_sum{labels(method=method, route=route)} {series["sum"]:.6f}')
+        lines.append(f'task_manager_request_duration_seconds_count{labels(method=method, route=route)} {series["count"]}')
+
+    lines += [
+        '# HELP task_manager_request_queries_total Database queries per route.',
+        '# TYPE task_manager_request_queries_total counter',
+    ]
+    for key, series in sorted(snapshot['routes'].items()):
+        method, route = key.split(' ', 1)
+        lines.append(f'task_manager_request_queries_total{labels(method=method, route=route)} {series["queries"]}')
+
+    for name, description in SECTIONS.items():
+        lines += [
+            f'# HELP task_manager_request_{name}_seconds_total {description} time per route.',
+            f'# TYPE task_manager_request_{name}_seconds_total counter',
+        ]
+        for key, series in sorted(snapshot['routes'].items()):
+            method, route = key.split(' ', 1)
+            lines.append(f'task_manager_request_{name}_seconds_total{labels(method=method, route=route)} {series[name]:.6f}')
+
+    lines += [
+        '# HELP task_manager_requests_total Responses per route and status code.',
+        '# TYPE task_manager_requests_total counter',
+    ]
+    for key, value in sorted(snapshot['statuses'].items()):
+        method, status, route = key.split(' ', 2)
+        lines.append(f'task_manager_requests_total{labels(method=method, route=route, status=status)} {value}')
+
+    return '\n'.join(lines) + '\n'
+
+
+# The exposition lists every route and status, keep it from anonymous users
+def can_read_metrics(request):
+    if request.user.is_staff:
+        return True
+    token = settings.TASK_METRICS_TOKEN
+    sent = request.headers.get('Authorization', '').encode()
+    return bool(token) and hmac.compare_digest(sent, f'Bearer {token}'.encode())
+
+
+def metrics_view(request):
+    if not can_read_metrics(request):
+        return HttpResponseForbidden()
+    return HttpResponse(exposition(merged_snapshots()), content_type='text/plain; version=0.0.4; charset=utf-8')
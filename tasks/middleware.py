@@ -0,0 +1,111 @@
+import asyncio
+
+from django.http import HttpResponse
+from django.middleware.gzip import GZipMiddleware
+
+from tasks.metrics import RequestTimings, current_timings, registry, timed
+from tasks.shards import ShardMoving, current_request
+
+
+# Routes not matched by any URL pattern share one series
+UNMATCHED_ROUTE = '<unmatched>'
+
+
+# Records query count, database, serializer and render time of every request,
+# reports them in a Server-Timing header and feeds the /metrics histograms.
+# Works in both handler modes, so async views stay async under ASGI.
+class RequestMetricsMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # Mark the instance as a coroutine function, as MiddlewareMixin does
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+
+        timings = RequestTimings()
+        token = current_timings.set(timings)
+        try:
+            response = self.get_response(request)
+        finally:
+            current_timings.reset(token)
+        return self.finish(request, response, timings)
+
+    async def __acall__(self, request):
+        timings = RequestTimings()
+        token = current_timings.set(timings)
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_timings.reset(token)
+        return self.finish(request, response, timings)
+
+    # Template and DRF responses render after the view returns
+    def process_template_response(self, request, response):
+        render = response.render
+
+        def timed_render():
+            with timed('render'):
+                return render()
+
+        response.render = timed_render
+        return response
+
+    def finish(self, request, response, timings):
+        response['Server-Timing'] = timings.server_timing()
+        match = request.resolver_match
+        route = match.route if match is not None else UNMATCHED_ROUTE
+        registry.observe(request.method, route, response.status_code, timings)
+        return response
+
+
+# Gzip for the API and other non-HTML responses. HTML pages carry the CSRF
+# token next to reflected input, compressing them would open them to BREACH.
+class CompressionMiddleware(GZipMiddleware):
+
+    def process_response(self, request, response):
+        if response.get('Content-Type', '').startswith('text/html'):
+            return response
+        return super().process_response(request, response)
+
+
+# Routes the task models of a request to its user's shard, see tasks/shards.py.
+# The user is resolved on the first task query, after DRF authentication.
+class ShardMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+
+        token = current_request.set(request)
+        try:
+            return self.get_response(request)
+        finally:
+            current_request.reset(token)
+
+    async def __acall__(self, request):
+        token = current_request.set(request)
+        try:
+            return await self.get_response(request)
+        finally:
+            current_request.reset(token)
+
+    # DRF answers ShardMoving itself, the HTML views get a plain 503
+    def process_exception(self, request, exception):
+        if isinstance(exception, ShardMoving):
+            response = HttpResponse(exception.detail, status=exception.status_code, content_type='text/plain')
+            response['Retry-After'] = str(exception.wait)
+            return response
+        return None
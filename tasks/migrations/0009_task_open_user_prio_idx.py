@@ -0,0 +1,19 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tasks', '0008_alter_taskhistory_task_and_more'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='task',
+            index=models.Index(
+                condition=models.Q(('completed', False), ('deleted', False)),
+                fields=['user', 'priority'],
+                name='task_open_user_prio_idx',
+            ),
+        ),
+    ]
@@ -0,0 +1,35 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tasks', '0009_task_open_user_prio_idx'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='task',
+            index=models.Index(fields=['user', 'deleted', 'completed', 'priority'], name='task_user_del_comp_prio_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='task',
+            index=models.Index(
+                condition=models.Q(('deleted', False)),
+                fields=['user', 'priority'],
+                name='task_live_user_prio_idx',
+            ),
+        ),
+        migrations.AddIndex(
+            model_name='task',
+            index=models.Index(
+                condition=models.Q(('completed', True), ('deleted', False)),
+                fields=['user', 'priority'],
+                name='task_done_user_prio_idx',
+            ),
+        ),
+        migrations.AddIndex(
+            model_name='taskhistory',
+            index=models.Index(fields=['task', 'updated_date'], name='taskhistory_task_date_idx'),
+        ),
+    ]
@@ -0,0 +1,92 @@
+from django.db import migrations, models
+import django.db.models.deletion
+import tasks.models
+
+# Full-text search shadow structures, see tasks/search.py. SQLite gets an FTS5
+# table kept in sync by triggers (so every write path, including bulk and
+# queryset updates, is covered), PostgreSQL a GIN expression index.
+
+SQLITE_FORWARD = [
+    """
+    CREATE VIRTUAL TABLE tasks_task_fts USING fts5(
+        title, description, owner, prefix='2 3', tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    # bm25 column weights for `rank`: title, description, owner
+    """
+    INSERT INTO tasks_task_fts (tasks_task_fts, rank) VALUES ('rank', 'bm25(10.0, 1.0, 0.0)')
+    """,
+    """
+    CREATE TRIGGER tasks_task_fts_insert AFTER INSERT ON tasks_task WHEN NOT new.deleted BEGIN
+        INSERT INTO tasks_task_fts (rowid, title, description, owner)
+        VALUES (new.id, new.title, new.description, 'u' || new.user_id);
+    END
+    """,
+    """
+    CREATE TRIGGER tasks_task_fts_update AFTER UPDATE OF title, description, user_id, deleted ON tasks_task BEGIN
+        DELETE FROM tasks_task_fts WHERE rowid = old.id;
+        INSERT INTO tasks_task_fts (rowid, title, description, owner)
+        SELECT new.id, new.title, new.description, 'u' || new.user_id WHERE NOT new.deleted;
+    END
+    """,
+    """
+    CREATE TRIGGER tasks_task_fts_delete AFTER DELETE ON tasks_task BEGIN
+        DELETE FROM tasks_task_fts WHERE rowid = old.id;
+    END
+    """,
+    """
+    INSERT INTO tasks_task_fts (rowid, title, description, owner)
+    SELECT id, title, description, 'u' || user_id FROM tasks_task WHERE NOT deleted
+    """,
+]
+
+SQLITE_BACKWARD = [
+    'DROP TRIGGER IF EXISTS tasks_task_fts_insert',
+    'DROP TRIGGER IF EXISTS tasks_task_fts_update',
+    'DROP TRIGGER IF EXISTS tasks_task_fts_delete',
+    'DROP TABLE IF EXISTS tasks_task_fts',
+]
+
+POSTGRESQL_FORWARD = [
+    """
+    CREATE INDEX tasks_task_search_idx ON tasks_task
+    USING GIN (to_tsvector('simple', title || ' ' || description)) WHERE NOT deleted
+    """,
+]
+
+POSTGRESQL_BACKWARD = [
+    'DROP INDEX IF EXISTS tasks_task_search_idx',
+]
+
+
+def run(statements):
+    def operation(apps, schema_editor):
+        for statement in statements.get(schema_editor.connection.vendor, []):
+            schema_editor.execute(statement)
+    return operation
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tasks', '0012_taskimport'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            run({'sqlite': SQLITE_FORWARD, 'postgresql': POSTGRESQL_FORWARD}),
+            run({'sqlite': SQLITE_BACKWARD, 'postgresql': POSTGRESQL_BACKWARD}),
+        ),
+        migrations.CreateModel(
+            name='TaskSearchEntry',
+            fields=[
+                ('task', models.OneToOneField(db_column='rowid', on_delete=django.db.models.deletion.DO_NOTHING, primary_key=True, related_name='search_entry', serialize=False, to='tasks.task')),
+                ('document', tasks.models.SearchDocumentField(db_column='tasks_task_fts')),
+                ('rank', models.FloatField()),
+            ],
+            options={
+                'db_table': 'tasks_task_fts',
+                'managed': False,
+            },
+        ),
+    ]
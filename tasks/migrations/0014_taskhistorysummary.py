@@ -0,0 +1,26 @@
+# Generated by Django 4.0.1 on 2026-10-17 11:35
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tasks', '0013_task_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TaskHistorySummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('transitions', models.PositiveIntegerField(default=0)),
+                ('status_counts', models.JSONField(default=dict)),
+                ('last_status', models.CharField(choices=[('PENDING', 'PENDING'), ('IN_PROGRESS', 'IN_PROGRESS'), ('COMPLETED', 'COMPLETED'), ('CANCELLED', 'CANCELLED')], default='PENDING', max_length=100)),
+                ('first_date', models.DateTimeField(null=True)),
+                ('last_date', models.DateTimeField(null=True)),
+                ('task', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='history_summary', to='tasks.task')),
+            ],
+        ),
+    ]
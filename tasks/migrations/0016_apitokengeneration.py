@@ -0,0 +1,24 @@
+# Generated by Django 4.0.1 on 2026-10-17 11:42
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('tasks', '0015_archive'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ApiTokenGeneration',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('generation', models.PositiveIntegerField(default=0)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='api_token_generation', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.0.1 on 2026-10-17 11:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tasks', '0016_apitokengeneration'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='archivedtask',
+            index=models.Index(fields=['user', 'created_date'], name='archivedtask_user_changed_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='task',
+            index=models.Index(fields=['user', 'created_date', 'id'], name='task_user_changed_idx'),
+        ),
+    ]
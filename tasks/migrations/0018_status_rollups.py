@@ -0,0 +1,70 @@
+# Generated by Django 4.0.1 on 2026-10-17 11:53
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+# SQLite rebuilds tasks_task to add pending_since, which drops the triggers
+# keeping tasks_task_fts in sync (see 0013). The rebuild keeps the ids, so the
+# search table itself is still right: only the triggers need putting back.
+# Later migrations changing tasks_task on SQLite have to do the same.
+
+SQLITE_SEARCH_TRIGGERS = [
+    """
+    CREATE TRIGGER IF NOT EXISTS tasks_task_fts_insert AFTER INSERT ON tasks_task WHEN NOT new.deleted BEGIN
+        INSERT INTO tasks_task_fts (rowid, title, description, owner)
+        VALUES (new.id, new.title, new.description, 'u' || new.user_id);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS tasks_task_fts_update AFTER UPDATE OF title, description, user_id, deleted ON tasks_task BEGIN
+        DELETE FROM tasks_task_fts WHERE rowid = old.id;
+        INSERT INTO tasks_task_fts (rowid, title, description, owner)
+        SELECT new.id, new.title, new.description, 'u' || new.user_id WHERE NOT new.deleted;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS tasks_task_fts_delete AFTER DELETE ON tasks_task BEGIN
+        DELETE FROM tasks_task_fts WHERE rowid = old.id;
+    END
+    """,
+]
+
+
+def restore_search_triggers(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        for statement in SQLITE_SEARCH_TRIGGERS:
+            schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('tasks', '0017_sync_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='task',
+            name='pending_since',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(restore_search_triggers, restore_search_triggers),
+        migrations.CreateModel(
+            name='TaskStatusRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('status', models.CharField(choices=[('PENDING', 'PENDING'), ('IN_PROGRESS', 'IN_PROGRESS'), ('COMPLETED', 'COMPLETED'), ('CANCELLED', 'CANCELLED')], max_length=100)),
+                ('transitions', models.PositiveIntegerField(default=0)),
+                ('timed_completions', models.PositiveIntegerField(default=0)),
+                ('completion_seconds', models.FloatField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='status_rollups', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='taskstatusrollup',
+            constraint=models.UniqueConstraint(fields=('user', 'day', 'status'), name='taskstatusrollup_user_day_status'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.0.1 on 2026-10-17 12:06
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('tasks', '0019_jobs'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserShard',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shard', models.CharField(default='default', max_length=100)),
+                ('state', models.CharField(blank=True, default='', max_length=20)),
+                ('target', models.CharField(blank=True, default='', max_length=100)),
+                ('updated_date', models.DateTimeField(auto_now=True)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='task_shard', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='usershard',
+            index=models.Index(fields=['shard'], name='usershard_shard_idx'),
+        ),
+    ]
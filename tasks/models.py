@@ -1,5 +1,7 @@
 
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
+from django.utils import timezone
 
 from django.contrib.auth.models import User
 
@@ -11,6 +13,14 @@ STATUS_CHOICES = (
     ("CANCELLED", "CANCELLED"),
 )
 
+# Soft-deleted tasks are invisible through Task.objects, they wait in the
+# table until `archive_tasks` moves them out. Task.all_objects sees every row.
+class LiveTaskManager(models.Manager):
+
+    def get_queryset(self):
+        return super().get_queryset().filter(deleted=False)
+
+
 class Task(models.Model):
     title = models.CharField(max_length=100)
     description = models.TextField()
@@ -20,10 +30,52 @@ class Task(models.Model):
     priority = models.PositiveIntegerField(default=0)
     status = models.CharField(max_length=100, choices=STATUS_CHOICES, default=STATUS_CHOICES[0][0])
     user = models.ForeignKey(User , on_delete=models.CASCADE , null=True,blank=True)
+    # When the task last entered PENDING, for the completion times in the rollups
+    pending_since = models.DateTimeField(null=True, blank=True)
+
+    objects = LiveTaskManager()
+    all_objects = models.Manager()
+
+    class Meta:
+        # Related lookups (a history row's task) still reach deleted tasks
+        base_manager_name = 'all_objects'
+        indexes = [
+            # Every list filters a user's tasks on deleted (and completed) ordered by priority
+            models.Index(fields=['user', 'deleted', 'completed', 'priority'], name='task_user_del_comp_prio_idx'),
+            # Smaller partial indexes for backends that support them
+            models.Index(
+                fields=['user', 'priority'],
+                condition=models.Q(deleted=False),
+                name='task_live_user_prio_idx',
+            ),
+            models.Index(
+                fields=['user', 'priority'],
+                condition=models.Q(deleted=False, completed=True),
+                name='task_done_user_prio_idx',
+            ),
+            # Priority cascading looks up a user's open tasks by exact priority
+            models.Index(
+                fields=['user', 'priority'],
+                condition=models.Q(deleted=False, completed=False),
+                name='task_open_user_prio_idx',
+            ),
+            # Delta sync walks a user's changes, tombstones included, see tasks/sync.py
+            models.Index(fields=['user', 'created_date', 'id'], name='task_user_changed_idx'),
+        ]
+
+    # Keep the values as loaded, so a write can tell what changed without refetching
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
+    def loaded_value(self, field):
+        return getattr(self, '_loaded_values', {}).get(field, getattr(self, field))
 
     def __str__(self):
         return self.title
-    
+
     def pretty_date(self):
         return self.created_date.strftime("%a %d %b")
 
@@ -32,4 +84,190 @@ class TaskHistory(models.Model):
     task = models.ForeignKey(Task, related_name='tasks', on_delete=models.CASCADE)
     old_status = models.CharField(max_length=100, choices=STATUS_CHOICES, default=None)
     new_status = models.CharField(max_length=100, choices=STATUS_CHOICES, default=STATUS_CHOICES[0][0])
-    updated_date = models.DateTimeField(auto_now=True)
\ No newline at end of file
+    # Stamped when the transition is recorded, not when the row is written
+    # (history may be written later by a background job)
+    updated_date = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['task', 'updated_date'], name='taskhistory_task_date_idx'),
+        ]
+
+
+# History compacted by `compact_history`: counts per new status and the date
+# range of the rows folded in
+class TaskHistorySummary(models.Model):
+    task = models.OneToOneField(Task, related_name='history_summary', on_delete=models.CASCADE)
+    transitions = models.PositiveIntegerField(default=0)
+    status_counts = models.JSONField(default=dict)
+    last_status = models.CharField(max_length=100, choices=STATUS_CHOICES, default=STATUS_CHOICES[0][0])
+    first_date = models.DateTimeField(null=True)
+    last_date = models.DateTimeField(null=True)
+
+
+# Daily per-user status transitions, maintained with the history writes (see
+# tasks/rollups.py). Completions also add up the time since the task entered
+# PENDING, when that is known.
+class TaskStatusRollup(models.Model):
+    user = models.ForeignKey(User, related_name='status_rollups', on_delete=models.CASCADE)
+    day = models.DateField()
+    status = models.CharField(max_length=100, choices=STATUS_CHOICES)
+    transitions = models.PositiveIntegerField(default=0)
+    timed_completions = models.PositiveIntegerField(default=0)
+    completion_seconds = models.FloatField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'day', 'status'], name='taskstatusrollup_user_day_status'),
+        ]
+
+
+# Soft-deleted tasks moved out of tasks_task by `archive_tasks`, keeping their ids
+class ArchivedTask(models.Model):
+    id = models.BigIntegerField(primary_key=True)
+    title = models.CharField(max_length=100)
+    description = models.TextField()
+    completed = models.BooleanField(default=False)
+    created_date = models.DateTimeField()
+    priority = models.PositiveIntegerField(default=0)
+    status = models.CharField(max_length=100, choices=STATUS_CHOICES, default=STATUS_CHOICES[0][0])
+    user = models.ForeignKey(User, related_name='archived_tasks', on_delete=models.CASCADE, null=True, blank=True)
+    # The task's TaskHistorySummary, when its history had been compacted
+    history_summary = models.JSONField(null=True, blank=True)
+    archived_date = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            # Delta sync checks for tombstones archived after a sync token
+            models.Index(fields=['user', 'created_date'], name='archivedtask_user_changed_idx'),
+        ]
+
+
+class ArchivedTaskHistory(models.Model):
+    id = models.BigIntegerField(primary_key=True)
+    task = models.ForeignKey(ArchivedTask, related_name='history', on_delete=models.CASCADE)
+    old_status = models.CharField(max_length=100, choices=STATUS_CHOICES, default=None)
+    new_status = models.CharField(max_length=100, choices=STATUS_CHOICES, default=STATUS_CHOICES[0][0])
+    updated_date = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['task', 'updated_date'], name='archivedhistory_task_date_idx'),
+        ]
+
+
+# Denormalized per-user task counts for the list pages
+class TaskCounter(models.Model):
+    user = models.OneToOneField(User, related_name='task_counter', on_delete=models.CASCADE)
+    total = models.IntegerField(default=0)
+    completed = models.IntegerField(default=0)
+
+    @property
+    def pending(self):
+        return self.total - self.completed
+
+
+
+# Progress of a resumable `import_tasks` run, one row per input source
+class TaskImport(models.Model):
+    source = models.CharField(max_length=255, unique=True)
+    position = models.PositiveBigIntegerField(default=0)
+    imported = models.PositiveBigIntegerField(default=0)
+    updated_date = models.DateTimeField(auto_now=True)
+
+
+# Bumping a user's generation revokes every API token issued to them
+class ApiTokenGeneration(models.Model):
+    user = models.OneToOneField(User, related_name='api_token_generation', on_delete=models.CASCADE)
+    generation = models.PositiveIntegerField(default=0)
+
+
+# Which database holds a user's tasks, see tasks/shards.py. Users without a
+# row are on 'default'.
+class UserShard(models.Model):
+    user = models.OneToOneField(User, related_name='task_shard', on_delete=models.CASCADE)
+    shard = models.CharField(max_length=100, default='default')
+    # Set by `rebalance_shards` while the user moves to `target`
+    state = models.CharField(max_length=20, blank=True, default='')
+    target = models.CharField(max_length=100, blank=True, default='')
+    updated_date = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['shard'], name='usershard_shard_idx'),
+        ]
+
+
+JOB_STATES = (
+    ("queued", "queued"),
+    ("running", "running"),
+    ("done", "done"),
+    ("failed", "failed"),
+)
+
+# Background job, see tasks/jobs.py. Lower priorities run first.
+class Job(models.Model):
+    name = models.CharField(max_length=100)
+    # At most one queued job per key, enqueueing another one is a no-op
+    key = models.CharField(max_length=255, null=True, blank=True)
+    payload = models.JSONField(default=dict)
+    priority = models.SmallIntegerField(default=100)
+    state = models.CharField(max_length=20, choices=JOB_STATES, default=JOB_STATES[0][0])
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=5)
+    run_after = models.DateTimeField(default=timezone.now)
+    # The worker running the job and until when, a job whose lease ran out is retried
+    locked_by = models.CharField(max_length=255, blank=True, default='')
+    locked_until = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True, default='')
+    created_date = models.DateTimeField(auto_now_add=True)
+    finished_date = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # Workers claim the first queued job by priority
+            models.Index(fields=['state', 'priority', 'run_after', 'id'], name='job_queue_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['key'], condition=models.Q(state='queued'), name='job_queued_key'),
+        ]
+
+    def __str__(self):
+        return f'{self.name} #{self.pk} ({self.state})'
+
+
+# Change feed event shared by the workers of DatabaseEventBackend, see
+# tasks/events.py. The id is the event's sequence number.
+class TaskEvent(models.Model):
+    user_id = models.BigIntegerField()
+    type = models.CharField(max_length=32)
+    data = models.JSONField(encoder=DjangoJSONEncoder)
+    created_date = models.DateTimeField(default=timezone.now, db_index=True)
+
+
+# The hidden column FTS5 tables expose under their own name, only usable in a MATCH
+class SearchDocumentField(models.TextField):
+    pass
+
+
+@SearchDocumentField.register_lookup
+class Match(models.Lookup):
+    lookup_name = 'match'
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        return f'{lhs} MATCH {rhs}', lhs_params + rhs_params
+
+
+# Row of the SQLite FTS5 search table kept in sync by triggers, see tasks/search.py
+class TaskSearchEntry(models.Model):
+    task = models.OneToOneField(
+        Task, related_name='search_entry', primary_key=True, db_column='rowid', on_delete=models.DO_NOTHING
+    )
+    document = SearchDocumentField(db_column='tasks_task_fts')
+    rank = models.FloatField()
+
+    class Meta:
+        managed = False
+        db_table = 'tasks_task_fts'
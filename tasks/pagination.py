@@ -0,0 +1,169 @@
+import base64
+import binascii
+import json
+import math
+from collections import OrderedDict
+
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, _positive_int
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+# Cursors are opaque to clients: base64 encoded [position, reverse, page number]
+def encode_cursor(position, reverse=False, number=1):
+    payload = json.dumps([position, reverse, number], separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        position, reverse, number = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (TypeError, ValueError, binascii.Error):
+        raise ValueError('Invalid cursor')
+    if not isinstance(position, list) or not isinstance(number, int):
+        raise ValueError('Invalid cursor')
+    return position, bool(reverse), number
+
+
+def item_position(item, fields):
+    position = []
+    for field in fields:
+        value = item[field] if isinstance(item, dict) else getattr(item, field)
+        position.append(value.isoformat() if hasattr(value, 'isoformat') else value)
+    return position
+
+
+# Rows strictly after `position` in the given ordering. The leading range
+# condition lets the database seek straight into a composite index.
+def after_position(fields, position, descending=False):
+    lookup = 'lt' if descending else 'gt'
+    rows_after = Q()
+    for index, field in enumerate(fields):
+        tie = Q(**{f'{previous}': position[i] for i, previous in enumerate(fields[:index])})
+        rows_after |= tie & Q(**{f'{field}__{lookup}': position[index]})
+    return Q(**{f'{fields[0]}__{lookup}e': position[0]}) & rows_after
+
+
+class KeysetPage:
+
+    def __init__(self, object_list, fields, number, has_next, has_previous, num_pages=None):
+        self.object_list = object_list
+        self.fields = fields
+        self.number = number
+        self.num_pages = num_pages
+        self._has_next = has_next
+        self._has_previous = has_previous
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_other_pages(self):
+        return self._has_next or self._has_previous
+
+    @property
+    def next_cursor(self):
+        if self._has_next and self.object_list:
+            return encode_cursor(item_position(self.object_list[-1], self.fields), False, self.number + 1)
+
+    @property
+    def previous_cursor(self):
+        if self._has_previous and self.object_list:
+            return encode_cursor(item_position(self.object_list[0], self.fields), True, self.number - 1)
+
+
+# Seek pagination over `ordering` (all ascending or all descending, ending in a
+# unique field). Every page costs one indexed range query, however deep it is.
+def paginate_keyset(queryset, ordering, cursor, page_size, count=None):
+    descending = ordering[0].startswith('-')
+    fields = [field.lstrip('-') for field in ordering]
+    num_pages = max(1, math.ceil(count / page_size)) if count is not None else None
+
+    if not cursor:
+        rows = list(queryset.order_by(*ordering)[:page_size + 1])
+        return KeysetPage(rows[:page_size], fields, 1, len(rows) > page_size, False, num_pages)
+
+    position, reverse, number = decode_cursor(cursor)
+    if len(position) != len(fields):
+        raise ValueError('Invalid cursor')
+
+    if not reverse:
+        rows = list(queryset.filter(after_position(fields, position, descending)).order_by(*ordering)[:page_size + 1])
+        return KeysetPage(rows[:page_size], fields, number, len(rows) > page_size, True, num_pages)
+
+    # Walk backwards from the cursor, then restore the natural order
+    reverse_ordering = [field[1:] if field.startswith('-') else f'-{field}' for field in ordering]
+    rows = list(queryset.filter(after_position(fields, position, not descending)).order_by(*reverse_ordering)[:page_size + 1])
+    has_previous = len(rows) > page_size
+    rows = rows[:page_size][::-1]
+    return KeysetPage(rows, fields, number if has_previous else 1, True, has_previous, num_pages)
+
+
+# Adds a keyset mode to a DRF pagination class, used when `?cursor=` is present
+class KeysetModeMixin:
+    cursor_query_param = 'cursor'
+    keyset_ordering = ('id',)
+    keyset_limit_query_param = 'limit'
+    keyset_default_limit = 20
+    keyset_max_limit = 100
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.keyset_page = None
+        if self.cursor_query_param not in request.query_params:
+            return super().paginate_queryset(queryset, request, view)
+
+        self.request = request
+        try:
+            self.keyset_page = paginate_keyset(
+                queryset,
+                self.keyset_ordering,
+                request.query_params[self.cursor_query_param],
+                self.get_keyset_limit(request),
+            )
+        except ValueError:
+            raise NotFound(self.invalid_cursor_message)
+        return list(self.keyset_page)
+
+    def get_keyset_limit(self, request):
+        try:
+            return _positive_int(
+                request.query_params[self.keyset_limit_query_param],
+                strict=True,
+                cutoff=self.keyset_max_limit,
+            )
+        except (KeyError, ValueError):
+            return self.keyset_default_limit
+
+    def get_keyset_link(self, cursor):
+        if cursor is None:
+            return None
+        url = remove_query_param(self.request.build_absolute_uri(), 'offset')
+        return replace_query_param(url, self.cursor_query_param, cursor)
+
+    def get_paginated_response(self, data):
+        if self.keyset_page is None:
+            return super().get_paginated_response(data)
+
+        return Response(OrderedDict([
+            ('next', self.get_keyset_link(self.keyset_page.next_cursor)),
+            ('previous', self.get_keyset_link(self.keyset_page.previous_cursor)),
+            ('results', data),
+        ]))
+
+
+# Leaves a list unpaginated unless the client asks for keyset pages
+class OptionalPagination(BasePagination):
+
+    def paginate_queryset(self, queryset, request, view=None):
+        return None
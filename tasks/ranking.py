@@ -0,0 +1,93 @@
+from django.db import transaction
+from django.db.models import Exists, F, OuterRef
+from django.utils import timezone
+
+from tasks.models import Task
+from tasks.shards import shard_db
+
+
+# Active tasks take part in priority cascading
+def active_tasks(user, task_id=None):
+    return Task.objects.filter(completed=False, user=user).exclude(pk=task_id)
+
+
+# Make room for a task at `priority` by shifting only the contiguous run of
+# occupied priorities starting there. The common case (free slot) costs a
+# single indexed EXISTS lookup and touches no rows.
+def cascade_priority(user, priority, task_id=None):
+    priority = int(priority)
+    tasks = active_tasks(user, task_id)
+
+    # No savepoint of its own when nested in a caller's transaction
+    with transaction.atomic(using=shard_db(), savepoint=False):
+        if not tasks.filter(priority=priority).exists():
+            return 0
+
+        # The run ends at the first occupied priority with a free successor
+        successor = tasks.filter(priority=OuterRef('priority') + 1)
+        run_end = (
+            tasks.filter(priority__gte=priority)
+            .annotate(has_successor=Exists(successor))
+            .filter(has_successor=False)
+            .order_by('priority')
+            .values_list('priority', flat=True)
+            .first()
+        )
+
+        # Queryset updates skip auto_now, stamp the last change by hand
+        return tasks.filter(priority__gte=priority, priority__lte=run_end).update(
+            priority=F('priority') + 1, created_date=timezone.now()
+        )
+
+
+# Place several tasks in one pass, for batch writes. Requested priorities keep
+# their slot (duplicates within the batch take the next free one) and existing
+# tasks are walked once in priority order, only as far as the runs being
+# shifted reach. Returns the assigned priorities in request order. Tasks the
+# caller holds in `loaded` get the priority they are moved to.
+def cascade_priorities(user, priorities, exclude=(), loaded=()):
+    if not priorities:
+        return []
+
+    assigned = [None] * len(priorities)
+    previous = None
+    for index in sorted(range(len(priorities)), key=lambda i: int(priorities[i])):
+        priority = int(priorities[index])
+        if previous is not None and priority <= previous:
+            priority = previous + 1
+        assigned[index] = previous = priority
+
+    taken = set(assigned)
+    highest = max(assigned)
+    changed = []
+    now = timezone.now()
+    loaded = {task.id: task for task in loaded}
+
+    with transaction.atomic(using=shard_db(), savepoint=False):
+        tasks = (
+            active_tasks(user)
+            .exclude(pk__in=exclude)
+            .filter(priority__gte=min(assigned))
+            .order_by('priority', 'id')
+            .values_list('id', 'priority')
+        )
+
+        floor = None
+        for task_id, priority in tasks.iterator():
+            new_priority = priority if floor is None else max(priority, floor)
+            while new_priority in taken:
+                new_priority += 1
+
+            # Past the last placed task with nothing left to push along
+            if new_priority == priority and priority > highest:
+                break
+
+            if new_priority != priority:
+                changed.append(Task(id=task_id, priority=new_priority, created_date=now))
+                if task_id in loaded:
+                    loaded[task_id].priority = new_priority
+            floor = new_priority + 1
+
+        Task.objects.bulk_update(changed, ['priority', 'created_date'], batch_size=500)
+
+    return assigned
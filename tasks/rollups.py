@@ -0,0 +1,89 @@
+from collections import defaultdict
+
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from tasks.models import TaskStatusRollup
+from tasks.shards import shard_db
+
+# Status analytics. Every history row is also counted in TaskStatusRollup,
+# one row per user, day and status entered, so the analytics read a few rows
+# per day instead of scanning TaskHistory. record_task_history() feeds the
+# rollups along with the history rows, `backfill_rollups` rebuilds them.
+# Rows that keep the status (the initial rows of `import_tasks --with-history`)
+# are not transitions and stay out of the rollups.
+
+COMPLETED = 'COMPLETED'
+PENDING = 'PENDING'
+
+
+# Call before saving a task whose status may have changed
+def mark_pending(task, old_status=None, now=None):
+    if task.status == PENDING and old_status != PENDING:
+        task.pending_since = now or timezone.now()
+
+
+def completion_seconds(pending_since, completed_date):
+    if pending_since is None or completed_date < pending_since:
+        return None
+    return (completed_date - pending_since).total_seconds()
+
+
+class RollupTotals():
+
+    def __init__(self):
+        self.rows = defaultdict(lambda: [0, 0, 0.0])
+
+    def add(self, user_id, when, status, seconds=None):
+        row = self.rows[(user_id, timezone.localdate(when), status)]
+        row[0] += 1
+        if status == COMPLETED and seconds is not None:
+            row[1] += 1
+            row[2] += seconds
+
+    def rollups(self):
+        return [
+            TaskStatusRollup(
+                user_id=user_id, day=day, status=status, transitions=transitions,
+                timed_completions=timed, completion_seconds=seconds,
+            )
+            for (user_id, day, status), (transitions, timed, seconds) in self.rows.items()
+        ]
+
+    # Added onto the stored rollups, one statement per row (two for a new one)
+    def save(self):
+        with transaction.atomic(using=shard_db()):
+            for (user_id, day, status), (transitions, timed, seconds) in self.rows.items():
+                rollups = TaskStatusRollup.objects.filter(user_id=user_id, day=day, status=status)
+                increments = {
+                    'transitions': F('transitions') + transitions,
+                    'timed_completions': F('timed_completions') + timed,
+                    'completion_seconds': F('completion_seconds') + seconds,
+                }
+                if rollups.update(**increments):
+                    continue
+                try:
+                    with transaction.atomic(using=shard_db()):
+                        TaskStatusRollup.objects.create(
+                            user_id=user_id, day=day, status=status, transitions=transitions,
+                            timed_completions=timed, completion_seconds=seconds,
+                        )
+                except IntegrityError:
+                    # Created concurrently since the update
+                    rollups.update(**increments)
+
+
+# History rows as written by tasks/history.py, with the task they belong to
+def add_to_rollups(history_rows):
+    totals = RollupTotals()
+    for history in history_rows:
+        if history.task.user_id is None or history.old_status == history.new_status:
+            continue
+        totals.add(
+            history.task.user_id,
+            history.updated_date,
+            history.new_status,
+            completion_seconds(getattr(history, 'pending_since', None), history.updated_date),
+        )
+    totals.save()
@@ -0,0 +1,72 @@
+import contextvars
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from tasks.cache import pinned_to_primary
+from tasks.models import UserShard
+from tasks.shards import (check_writable, context_placement, instance_placement, is_sharded, is_sharded_model)
+
+
+# Read/write split. Reads inside a replica_reads() block go to the replica
+# alias, everything else (and every write) to the primary. Views opt in for
+# the reads that tolerate a little lag: the task lists and history.
+
+read_from_replica = contextvars.ContextVar('read_from_replica', default=False)
+
+
+@contextmanager
+def replica_reads(user=None):
+    use_replica = settings.TASK_DB_REPLICA_ALIAS is not None and not (
+        user is not None and user.is_authenticated and pinned_to_primary(user.pk)
+    )
+    token = read_from_replica.set(use_replica)
+    try:
+        yield
+    finally:
+        read_from_replica.reset(token)
+
+
+# Sends the task models to the user's shard (see tasks/shards.py), leaves
+# everything else, and reads from a user on 'default', to ReplicaRouter
+class ShardRouter:
+
+    def db_for_read(self, model, **hints):
+        return self.route(model, hints.get('instance'), writing=False)
+
+    def db_for_write(self, model, **hints):
+        return self.route(model, hints.get('instance'), writing=True)
+
+    def route(self, model, instance, writing):
+        if not is_sharded():
+            return None
+        if model is UserShard:
+            # The shard map is read fresh from the primary
+            return 'default'
+        if not is_sharded_model(model):
+            return None
+
+        placement = context_placement()
+        if writing and placement is not None:
+            check_writable(placement)
+        if instance is not None and is_sharded_model(instance) and instance._state.db:
+            return instance._state.db
+
+        placement = placement or instance_placement(instance)
+        if placement is None or placement.shard == 'default':
+            return 'default' if writing else None
+        return placement.shard
+
+
+class ReplicaRouter:
+
+    def db_for_read(self, model, **hints):
+        if read_from_replica.get():
+            return settings.TASK_DB_REPLICA_ALIAS
+        return 'default'
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
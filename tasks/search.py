@@ -0,0 +1,58 @@
+import re
+
+from django.db import connections
+from django.db.models import BooleanField, F, Q
+from django.db.models.expressions import RawSQL
+
+# Ranked prefix search over task titles and descriptions.
+#
+# SQLite joins the tasks_task_fts FTS5 table (see migration 0013), ranked by
+# its bm25 `rank`. Each row carries an `owner` token, so the user restriction
+# is part of the MATCH and only that user's postings are intersected. PostgreSQL uses the GIN
+# expression index, other backends fall back to unranked icontains.
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+MAX_TERMS = 8
+
+POSTGRESQL_DOCUMENT = "to_tsvector('simple', tasks_task.title || ' ' || tasks_task.description)"
+
+
+def search_terms(query):
+    return TOKEN_RE.findall(query.lower())[:MAX_TERMS]
+
+
+def search_tasks(queryset, query, user):
+    terms = search_terms(query)
+    if not terms:
+        return queryset.none()
+
+    vendor = connections[queryset.db].vendor
+    if vendor == 'sqlite':
+        return sqlite_search(queryset, terms, user)
+    if vendor == 'postgresql':
+        return postgresql_search(queryset, terms)
+
+    matches = Q()
+    for term in terms:
+        matches &= Q(title__icontains=term) | Q(description__icontains=term)
+    return queryset.filter(matches)
+
+
+def sqlite_search(queryset, terms, user):
+    # Terms are \w+ tokens, quoting them keeps FTS5 operators out of user input
+    prefixes = ' AND '.join(f'"{term}"*' for term in terms)
+    expression = f'owner : "u{user.pk}" AND {{title description}} : ({prefixes})'
+
+    return queryset.filter(search_entry__document__match=expression).annotate(
+        search_rank=F('search_entry__rank'),
+    ).order_by('search_rank', 'id')
+
+
+def postgresql_search(queryset, terms):
+    tsquery = ' & '.join(f'{term}:*' for term in terms)
+    return queryset.filter(
+        RawSQL(f"{POSTGRESQL_DOCUMENT} @@ to_tsquery('simple', %s)", [tsquery], output_field=BooleanField()),
+    ).annotate(
+        search_rank=RawSQL(f"ts_rank({POSTGRESQL_DOCUMENT}, to_tsquery('simple', %s))", [tsquery]),
+    ).order_by('-search_rank', 'id')
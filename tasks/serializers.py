@@ -1,10 +1,42 @@
 from django.contrib.auth.models import User
+from rest_framework.exceptions import ValidationError
+from rest_framework.permissions import SAFE_METHODS
 from rest_framework.serializers import ModelSerializer
 
-from tasks.models import Task, TaskHistory
+from tasks.metrics import timed_function
+from tasks.models import (ArchivedTask, ArchivedTaskHistory, Task, TaskHistory,
+                          TaskStatusRollup)
 from rest_framework import serializers
 
 
+# Sparse fieldsets: ?fields=id,title on reads keeps only those fields.
+# `field_columns` maps each field to the .values() columns it is built from,
+# so list views can select just those.
+class SparseFieldsMixin():
+
+    @classmethod
+    def requested_fields(cls, request):
+        value = request.query_params.get('fields') if request is not None else None
+        if not value or request.method not in SAFE_METHODS:
+            return None
+        requested = {field.strip() for field in value.split(',') if field.strip()}
+        unknown = requested - set(cls.Meta.fields)
+        if unknown:
+            raise ValidationError({'fields': [f"Unknown field(s): {', '.join(sorted(unknown))}."]})
+        return [field for field in cls.Meta.fields if field in requested]
+
+    @classmethod
+    def columns_for(cls, fields=None):
+        return tuple(dict.fromkeys(column for field in fields or cls.Meta.fields for column in cls.field_columns[field]))
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        fields = self.requested_fields(self.context.get('request'))
+        if fields is not None:
+            for field in set(self.fields) - set(fields):
+                self.fields.pop(field)
+
+
 # User serializer
 class UserSerializer(ModelSerializer):
 
@@ -13,24 +45,133 @@ class UserSerializer(ModelSerializer):
         fields = ['username']
     
 # Task serializer
-class TaskSerializer(ModelSerializer):
+class TaskSerializer(SparseFieldsMixin, ModelSerializer):
     user = UserSerializer(read_only=True)
     title = serializers.CharField(min_length=10)
 
+    # Relations the serialized fields read, for views to eager load
+    select_related_fields = ('user',)
+    field_columns = {
+        'id': ('id',),
+        'title': ('title',),
+        'description': ('description',),
+        'priority': ('priority',),
+        'completed': ('completed',),
+        'status': ('status',),
+        'user': ('user__username',),
+    }
+    # Columns needed by from_values()
+    values_fields = ('id', 'title', 'description', 'priority', 'completed', 'status', 'user__username')
+
     class Meta:
         model = Task
         fields = ['id', 'title', 'description', 'priority', 'completed', 'status', 'user']
 
+    @timed_function('serialize')
     def to_representation(self, instance):
         data = super().to_representation(instance)
         data['title'] = data['title'].upper()
         return data
 
+    # Read path building the same representation straight from a .values() row
+    @staticmethod
+    @timed_function('serialize')
+    def from_values(row, prefix='', fields=None):
+        if fields is not None:
+            return {field: TaskSerializer.field_values[field](row, prefix) for field in fields}
+
+        username = row[prefix + 'user__username']
+        return {
+            'id': row[prefix + 'id'],
+            'title': row[prefix + 'title'].upper(),
+            'description': row[prefix + 'description'],
+            'priority': row[prefix + 'priority'],
+            'completed': row[prefix + 'completed'],
+            'status': row[prefix + 'status'],
+            'user': {'username': username} if username is not None else None,
+        }
+
+    # Per field builders of from_values(), for sparse fieldsets
+    field_values = {
+        'id': lambda row, prefix: row[prefix + 'id'],
+        'title': lambda row, prefix: row[prefix + 'title'].upper(),
+        'description': lambda row, prefix: row[prefix + 'description'],
+        'priority': lambda row, prefix: row[prefix + 'priority'],
+        'completed': lambda row, prefix: row[prefix + 'completed'],
+        'status': lambda row, prefix: row[prefix + 'status'],
+        'user': lambda row, prefix: (
+            {'username': row[prefix + 'user__username']} if row[prefix + 'user__username'] is not None else None
+        ),
+    }
+
 # Task History serializer 
-class TaskHistorySerializer(ModelSerializer):
+class TaskHistorySerializer(SparseFieldsMixin, ModelSerializer):
     task = TaskSerializer(read_only=True)
     updated_date = serializers.DateTimeField(format='%I:%M %p %d %B %Y')
 
+    select_related_fields = ('task__user',)
+    field_columns = {
+        'task': tuple(f'task__{field}' for field in TaskSerializer.values_fields),
+        'new_status': ('new_status',),
+        'old_status': ('old_status',),
+        'updated_date': ('updated_date',),
+        'id': ('id',),
+    }
+    values_fields = ('id', 'new_status', 'old_status', 'updated_date') + field_columns['task']
+
     class Meta:
         model = TaskHistory
         fields = ['task', 'new_status', 'old_status', 'updated_date', 'id']
+
+    @timed_function('serialize')
+    def to_representation(self, instance):
+        return super().to_representation(instance)
+
+    @classmethod
+    @timed_function('serialize')
+    def from_values(cls, row, fields=None):
+        data = {}
+        if fields is None or 'task' in fields:
+            data['task'] = TaskSerializer.from_values(row, prefix='task__')
+        if fields is None or 'new_status' in fields:
+            data['new_status'] = row['new_status']
+        if fields is None or 'old_status' in fields:
+            data['old_status'] = row['old_status']
+        if fields is None or 'updated_date' in fields:
+            data['updated_date'] = cls._declared_fields['updated_date'].to_representation(row['updated_date'])
+        if fields is None or 'id' in fields:
+            data['id'] = row['id']
+        return data
+
+
+# Daily status rollup serializer (read only)
+class TaskStatusRollupSerializer(ModelSerializer):
+
+    class Meta:
+        model = TaskStatusRollup
+        fields = ['day', 'status', 'transitions', 'timed_completions', 'completion_seconds']
+        read_only_fields = fields
+
+
+# Archived task serializers (read only)
+class ArchivedTaskHistorySerializer(ModelSerializer):
+    updated_date = serializers.DateTimeField(format='%I:%M %p %d %B %Y')
+
+    class Meta:
+        model = ArchivedTaskHistory
+        fields = ['id', 'new_status', 'old_status', 'updated_date']
+
+
+class ArchivedTaskSerializer(ModelSerializer):
+    user = UserSerializer(read_only=True)
+
+    class Meta:
+        model = ArchivedTask
+        fields = ['id', 'title', 'description', 'priority', 'completed', 'status', 'user',
+                  'created_date', 'archived_date', 'history_summary']
+        read_only_fields = fields
+
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        data['title'] = data['title'].upper()
+        return data
@@ -0,0 +1,174 @@
+from contextlib import contextmanager
+
+from django.db import transaction
+from django.utils import timezone
+
+from tasks.cache import invalidate_user_tasks
+from tasks.counters import adjust_task_counters
+from tasks.events import publish_on_commit, publish_task_event
+from tasks.history import buffered_history, record_task_history
+from tasks.models import Task
+from tasks.ranking import cascade_priorities, cascade_priority
+from tasks.rollups import mark_pending
+from tasks.shards import use_shard_for
+
+# Task writes shared by the HTML views and the API. Each operation runs in a
+# single transaction: priority cascading, the write itself, history, counters,
+# cache invalidation and change feed events (see tasks/events.py) commit (or
+# roll back) together.
+#
+# Query budget per operation, transaction control statements not counted and
+# enforced by TaskServiceQueryBudgetTests:
+#
+#   create  3  priority slot lookup, INSERT task, UPDATE counters
+#   update  5  priority slot lookup, UPDATE task, UPDATE counters,
+#              INSERT history, UPDATE status rollup
+#   delete  4  UPDATE task, UPDATE counters, INSERT history, UPDATE status rollup
+#
+# Counters are only written when they change, history and rollups only when
+# the status does. A taken priority slot adds 2 queries to shift the run along,
+# a missing counter row a queued recount job and a user's first rollup row of
+# the day an INSERT. With TASK_HISTORY_WRITE_BEHIND = 'job' the history INSERT
+# and rollup UPDATE become a single job INSERT. The caller loads the task, once.
+QUERY_BUDGET = {
+    'create': 3,
+    'update': 5,
+    'delete': 4,
+}
+
+BATCH_UPDATE_FIELDS = ['title', 'description', 'priority', 'completed', 'status', 'pending_since', 'created_date']
+
+
+class TaskService():
+
+    def __init__(self, user):
+        self.user = user
+
+    # The transaction, on the user's shard
+    @contextmanager
+    def writing(self):
+        with use_shard_for(self.user) as db, transaction.atomic(using=db), buffered_history(using=db):
+            yield
+
+    def create(self, data):
+        with self.writing():
+            if 'priority' in data:
+                self.make_room(data['priority'])
+
+            task = Task(user=self.user, **data)
+            mark_pending(task)
+            task.save(force_insert=True)
+            publish_task_event(task, 'task.created')
+
+            adjust_task_counters(self.user, total=1, completed=int(task.completed))
+            invalidate_user_tasks(self.user)
+
+        return task
+
+    # `task` as loaded by the caller, form validation may already have applied `data` to it
+    def update(self, task, data):
+        old_status = task.loaded_value('status')
+        old_completed = task.loaded_value('completed')
+        # Callers only pass the user's own tasks, saves a lookup when serializing the event
+        task.user = self.user
+
+        with self.writing():
+            if 'priority' in data:
+                self.make_room(data['priority'], task.id)
+
+            for field, value in data.items():
+                setattr(task, field, value)
+            mark_pending(task, old_status)
+            task.save()
+
+            if old_status != task.status:
+                record_task_history(task, old_status, task.status)
+                publish_task_event(task, 'task.status', old_status=old_status)
+            else:
+                publish_task_event(task, 'task.updated')
+            adjust_task_counters(self.user, completed=int(task.completed) - int(old_completed))
+            invalidate_user_tasks(self.user)
+
+        return task
+
+    # Tasks shifted along by cascading are announced as one reorder, not one by one
+    def make_room(self, priority, task_id=None):
+        if cascade_priority(self.user, priority, task_id):
+            publish_on_commit(self.user.pk, 'tasks.reordered', {})
+
+    # Soft delete, returns the number of tasks deleted (0 when already gone)
+    def delete(self, task):
+        with self.writing():
+            deleted = Task.objects.filter(pk=task.id, user=self.user).update(deleted=True, created_date=timezone.now())
+
+            if deleted and task.status != 'CANCELLED':
+                record_task_history(task, task.status, 'CANCELLED')
+            if deleted:
+                publish_task_event(task, 'task.deleted')
+            adjust_task_counters(self.user, total=-deleted, completed=-deleted * int(task.completed))
+            invalidate_user_tasks(self.user)
+
+        return deleted
+
+    # Validated batch writes: creates are field dicts, updates (task, fields) pairs
+    # with the tasks locked by the caller, deletes tasks. Run inside the caller's
+    # transaction, which also holds those locks.
+    def batch(self, creates, updates, deletes):
+        now = timezone.now()
+        completed_delta = 0
+
+        with self.writing():
+            # One cascading pass for every priority the batch places. Updated
+            # tasks keeping their priority are pushed along like any other.
+            placed = list(creates) + [data for _, data in updates if 'priority' in data]
+            priorities = cascade_priorities(
+                self.user,
+                [data.get('priority', 0) for data in placed],
+                exclude=[task.id for task, data in updates if 'priority' in data] + [task.id for task in deletes],
+                loaded=[task for task, data in updates if 'priority' not in data],
+            )
+            for data, priority in zip(placed, priorities):
+                data['priority'] = priority
+            if placed:
+                publish_on_commit(self.user.pk, 'tasks.reordered', {})
+
+            created = [Task(user=self.user, **data) for data in creates]
+            for task in created:
+                mark_pending(task, now=now)
+            Task.objects.bulk_create(created)
+            completed_delta += sum(task.completed for task in created)
+            for task in created:
+                publish_task_event(task, 'task.created')
+
+            updated = []
+            for task, data in updates:
+                old_status, old_completed = task.status, task.completed
+                for field, value in data.items():
+                    setattr(task, field, value)
+                mark_pending(task, old_status, now)
+                task.created_date = now
+
+                if old_status != task.status:
+                    record_task_history(task, old_status, task.status)
+                    publish_task_event(task, 'task.status', old_status=old_status)
+                else:
+                    publish_task_event(task, 'task.updated')
+                completed_delta += int(task.completed) - int(old_completed)
+                updated.append(task)
+
+            Task.objects.bulk_update(updated, BATCH_UPDATE_FIELDS, batch_size=500)
+
+            # Soft-delete everything in a single UPDATE
+            for task in deletes:
+                if task.status != 'CANCELLED':
+                    record_task_history(task, task.status, 'CANCELLED')
+                publish_task_event(task, 'task.deleted')
+                completed_delta -= int(task.completed)
+            Task.objects.filter(pk__in=[task.id for task in deletes], user=self.user).update(
+                deleted=True, created_date=now
+            )
+
+            adjust_task_counters(self.user, total=len(created) - len(deletes), completed=completed_delta)
+            invalidate_user_tasks(self.user)
+
+        return created, updated
@@ -0,0 +1,225 @@
+import contextvars
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import connections
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+from tasks.models import UserShard
+
+# Horizontal sharding by user. Each user's tasks, history, counters, rollups
+# and archive live on one of the TASK_SHARDS databases, recorded in the
+# UserShard map on 'default' (users without a row are on 'default', where
+# everything lived before sharding). Everything else, users included, stays
+# on 'default'.
+#
+# ShardRouter (tasks/routers.py) sends the task models, in order: to the
+# database an instance was loaded from, to the shard entered with use_shard()
+# or use_shard_for(), to the shard of the current request's user (set up by
+# ShardMiddleware, DRF's authenticated user included), and last to the shard
+# of an unsaved instance's user. Transactions and on_commit hooks have to use
+# that alias too: see shard_db().
+#
+# Shards hand out ids from separate ranges (TASK_SHARD_ID_SPAN apart), so
+# ids stay unique across shards and a user keeps them when `rebalance_shards`
+# moves them. A shard also holds a copy of each of its users' User row, for
+# the foreign keys.
+
+FROZEN = 'frozen'
+MOVING = 'moving'
+
+# Models stored on the shards, by model name in the tasks app
+SHARDED_MODELS = {
+    'task', 'taskhistory', 'taskhistorysummary', 'taskstatusrollup', 'taskcounter',
+    'archivedtask', 'archivedtaskhistory', 'tasksearchentry',
+}
+
+current_placement = contextvars.ContextVar('current_placement', default=None)
+current_request = contextvars.ContextVar('current_request', default=None)
+
+
+# Raised for writes while `rebalance_shards` finishes moving the user
+class ShardMoving(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'Your tasks are being moved, try again in a few seconds.'
+    default_code = 'shard_moving'
+
+    def __init__(self, detail=None, code=None):
+        super().__init__(detail, code)
+        self.wait = settings.TASK_SHARD_FREEZE_SECONDS
+
+
+def is_sharded():
+    return len(settings.TASK_SHARDS) > 1
+
+
+def is_sharded_model(model):
+    return model._meta.app_label == 'tasks' and model._meta.model_name in SHARDED_MODELS
+
+
+# New users are spread over the shards by id
+def place_user(user_id):
+    return settings.TASK_SHARDS[user_id % len(settings.TASK_SHARDS)]
+
+
+# The user's UserShard row, unsaved for users on 'default' without one
+def get_placement(user_id):
+    placement = UserShard.objects.filter(user_id=user_id).first()
+    return placement or UserShard(user_id=user_id, shard='default')
+
+
+# Looked up once per user object, so once per request
+def user_placement(user):
+    placement = getattr(user, '_task_shard', None)
+    if placement is None:
+        placement = get_placement(user.pk)
+        user._task_shard = placement
+    return placement
+
+
+def shard_for_user(user):
+    if not is_sharded():
+        return 'default'
+    return user_placement(user).shard
+
+
+# {alias: user ids} for a batch of users, in one query
+def group_by_shard(user_ids):
+    shards = dict(UserShard.objects.filter(user_id__in=user_ids).values_list('user_id', 'shard'))
+    groups = {}
+    for user_id in user_ids:
+        groups.setdefault(shards.get(user_id, 'default') if is_sharded() else 'default', []).append(user_id)
+    return groups
+
+
+# The placement that applies to queries made now, None outside any
+def context_placement():
+    placement = current_placement.get()
+    if placement is not None:
+        return placement
+    request = current_request.get()
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        return user_placement(user)
+    return None
+
+
+# Where a query starting from this instance goes, without a query when possible
+def instance_placement(instance):
+    if instance is None:
+        return None
+    if isinstance(instance, User):
+        return user_placement(instance)
+    user_id = getattr(instance, 'user_id', None)
+    if user_id is None:
+        # History rows and summaries, through their task
+        task = instance._state.fields_cache.get('task')
+        if task is not None and task._state.db:
+            return UserShard(shard=task._state.db)
+        user_id = getattr(task, 'user_id', None)
+    return get_placement(user_id) if user_id is not None else None
+
+
+# The alias to open transactions on (and hook on_commit to) for the task models
+def shard_db():
+    if not is_sharded():
+        return 'default'
+    placement = context_placement()
+    return placement.shard if placement is not None else 'default'
+
+
+@contextmanager
+def use_shard(alias):
+    token = current_placement.set(UserShard(shard=alias))
+    try:
+        yield alias
+    finally:
+        current_placement.reset(token)
+
+
+@contextmanager
+def use_shard_for(user):
+    if not is_sharded():
+        yield 'default'
+        return
+    placement = user_placement(user)
+    token = current_placement.set(placement)
+    try:
+        yield placement.shard
+    finally:
+        current_placement.reset(token)
+
+
+# Maintenance over every user: the loop body runs once per shard, inside it
+def each_shard():
+    for alias in settings.TASK_SHARDS:
+        with use_shard(alias):
+            yield alias
+
+
+def check_writable(placement):
+    if placement.state == FROZEN:
+        raise ShardMoving()
+
+
+# The shard's copy of a user, for the foreign keys
+def mirror_user(user, alias):
+    if alias == 'default':
+        return
+    User.objects.using(alias).get_or_create(
+        pk=user.pk, defaults={'username': user.username, 'password': make_password(None)},
+    )
+
+
+def assign_shard(user, alias=None):
+    alias = alias or place_user(user.pk)
+    mirror_user(user, alias)
+    placement, _ = UserShard.objects.update_or_create(user=user, defaults={'shard': alias, 'state': '', 'target': ''})
+    user._task_shard = placement
+    return placement
+
+
+# post_save on User: new users go to their shard, when there is more than one
+def user_created(sender, instance, created, raw=False, using=None, **kwargs):
+    if created and not raw and is_sharded() and using == 'default':
+        assign_shard(instance)
+
+
+# post_delete on User: the task rows on another shard go with the shard's copy
+def user_deleted(sender, instance, using=None, **kwargs):
+    if not is_sharded() or using != 'default':
+        return
+    for alias in settings.TASK_SHARDS:
+        if alias != 'default':
+            User.objects.using(alias).filter(pk=instance.pk).delete()
+
+
+# post_migrate: every shard hands out ids from its own range. Settings only
+# accept SQLite and PostgreSQL shards (TASK_SHARD_ENGINES).
+def reserve_id_ranges(sender, using='default', **kwargs):
+    if using not in settings.TASK_SHARDS or sender.label != 'tasks':
+        return
+    start = settings.TASK_SHARDS.index(using) * settings.TASK_SHARD_ID_SPAN
+    if start == 0:
+        return
+
+    connection = connections[using]
+    tables = [
+        model._meta.db_table for model in sender.get_models()
+        if is_sharded_model(model) and model._meta.managed and model._meta.pk.get_internal_type() in ('AutoField', 'BigAutoField')
+    ]
+    with connection.cursor() as cursor:
+        for table in tables:
+            if connection.vendor == 'sqlite':
+                cursor.execute('UPDATE sqlite_sequence SET seq = MAX(seq, %s) WHERE name = %s', [start, table])
+                if not cursor.rowcount:
+                    cursor.execute('INSERT INTO sqlite_sequence (name, seq) VALUES (%s, %s)', [table, start])
+            else:
+                cursor.execute(
+                    'SELECT setval(pg_get_serial_sequence(%s, %s), GREATEST(%s, (SELECT COALESCE(MAX(id), 0) FROM '
+                    + connection.ops.quote_name(table) + ')))',
+                    [table, 'id', start],
+                )
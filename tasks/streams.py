@@ -0,0 +1,137 @@
+import asyncio
+import io
+import json
+from importlib import import_module
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user
+from django.core.handlers.asgi import ASGIHandler, ASGIRequest
+from rest_framework.exceptions import AuthenticationFailed
+
+from tasks.authentication import SignedTokenAuthentication
+from tasks.events import broker, get_event_backend
+
+# Server-Sent Events stream of the task change feed, see tasks/events.py.
+#
+# A plain ASGI application mounted in task_manager/asgi.py: Django 4.0 cannot
+# stream from an async view, and a stream should not hold a worker thread.
+# The database is only touched to authenticate, with a session cookie (what
+# EventSource sends) or an API token.
+
+
+# Resolves the user id once, off the event loop. Runs on the same thread as
+# Django's sync code, whose request signals look after the connection.
+@sync_to_async
+def authenticate(request):
+    try:
+        result = SignedTokenAuthentication().authenticate(request)
+    except AuthenticationFailed:
+        return None
+    if result is not None:
+        return result[0].pk
+
+    engine = import_module(settings.SESSION_ENGINE)
+    request.session = engine.SessionStore(request.COOKIES.get(settings.SESSION_COOKIE_NAME))
+    user = get_user(request)
+    return user.pk if user.is_authenticated else None
+
+
+async def send_json(send, status, data, headers=()):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'), *headers],
+    })
+    await send({'type': 'http.response.body', 'body': json.dumps(data).encode()})
+
+
+async def wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def task_events_app(scope, receive, send):
+    request = ASGIRequest(scope, io.BytesIO())
+    if request.method != 'GET':
+        return await send_json(send, 405, {'detail': f'Method "{request.method}" not allowed.'}, [(b'allow', b'GET')])
+
+    user_id = await authenticate(request)
+    if user_id is None:
+        return await send_json(send, 403, {'detail': 'Authentication credentials were not provided.'})
+
+    await sync_to_async(get_event_backend().start)()
+    # EventSource resends the last id it saw when it reconnects
+    last_event_id = request.headers.get('Last-Event-ID') or request.GET.get('last_event_id')
+    subscription, missed = broker.subscribe(user_id, asyncio.get_running_loop(), last_event_id)
+    disconnect = asyncio.ensure_future(wait_for_disconnect(receive))
+    try:
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [
+                (b'content-type', b'text/event-stream'),
+                (b'cache-control', b'no-cache'),
+                (b'x-accel-buffering', b'no'),
+            ],
+        })
+        # The events since last_event_id can't be replayed: the client reloads its tasks
+        opening = b'event: reset\ndata: {}\n\n' if missed is None else b''.join(event.encode() for event in missed)
+        await send({
+            'type': 'http.response.body',
+            'body': f'retry: {settings.TASK_EVENTS_RETRY}\n\n'.encode() + opening,
+            'more_body': True,
+        })
+
+        while not disconnect.done():
+            wakeup = asyncio.ensure_future(subscription.wakeup.wait())
+            await asyncio.wait({wakeup, disconnect}, timeout=settings.TASK_EVENTS_KEEPALIVE, return_when=asyncio.FIRST_COMPLETED)
+            wakeup.cancel()
+            if disconnect.done():
+                break
+
+            body = b''.join(event.encode() for event in subscription.drain()) or b': keepalive\n\n'
+            if subscription.overflowed:
+                # Too far behind: close, the client resumes from the last event it got
+                await send({'type': 'http.response.body', 'body': body + b'event: overflow\ndata: {}\n\n'})
+                break
+            await send({'type': 'http.response.body', 'body': body, 'more_body': True})
+    finally:
+        broker.unsubscribe(subscription)
+        disconnect.cancel()
+
+
+# Django 4.0's handler iterates a streamed response on the event loop, where
+# the lazy querysets behind the exports (see tasks/exports.py) can't run. Each
+# part is read on the request's thread instead, like the view that built it.
+class TaskASGIHandler(ASGIHandler):
+
+    async def send_response(self, response, send):
+        if not response.streaming:
+            return await super().send_response(response, send)
+
+        response_headers = [
+            (header.encode('ascii') if isinstance(header, str) else header,
+             value.encode('latin1') if isinstance(value, str) else value)
+            for header, value in response.items()
+        ]
+        for cookie in response.cookies.values():
+            response_headers.append((b'Set-Cookie', cookie.output(header='').encode('ascii').strip()))
+        await send({
+            'type': 'http.response.start',
+            'status': response.status_code,
+            'headers': response_headers,
+        })
+
+        parts = iter(response)
+        next_part = sync_to_async(next, thread_sensitive=True)
+        try:
+            while True:
+                part = await next_part(parts, None)
+                if part is None:
+                    break
+                for chunk, _ in self.chunk_bytes(part):
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body'})
+        finally:
+            await sync_to_async(response.close, thread_sensitive=True)()
@@ -0,0 +1,77 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core import signing
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from rest_framework import status
+from rest_framework.exceptions import APIException, ValidationError
+
+from tasks.models import ArchivedTask, Task
+from tasks.pagination import after_position, item_position
+
+# Delta sync. Task.created_date is auto_now and soft deletes and priority
+# cascades stamp it too, so it is the task's last change. A sync token is the
+# signed (created_date, id) position of the last change a client has seen:
+# the next sync returns the user's tasks changed after it, deleted ones as
+# tombstones, in (created_date, id) order.
+#
+# A row's timestamp is taken before its transaction commits, so a write may
+# become visible after later-stamped ones were synced. Tokens never point
+# past now - TASK_SYNC_GRACE_SECONDS, which re-sends the most recent changes
+# once instead of missing them: clients apply changes idempotently.
+
+SYNC_ORDERING = ('created_date', 'id')
+SYNC_TOKEN_SALT = 'tasks.sync-token'
+
+
+class SyncTokenExpired(APIException):
+    status_code = status.HTTP_410_GONE
+    default_detail = 'Sync token expired, sync again without a token.'
+    default_code = 'sync_token_expired'
+
+
+def encode_sync_token(user, position):
+    return signing.dumps([user.pk, *position], salt=SYNC_TOKEN_SALT, compress=True)
+
+
+def decode_sync_token(user, token):
+    try:
+        user_id, created_date, task_id = signing.loads(token, salt=SYNC_TOKEN_SALT)
+    except (signing.BadSignature, TypeError, ValueError):
+        raise ValidationError({'token': ['Invalid sync token.']})
+    if user_id != user.pk:
+        raise ValidationError({'token': ['Invalid sync token.']})
+    return [parse_datetime(created_date), task_id]
+
+
+# Returns (changed values rows, deleted ids, next token, has_more)
+def changes_since(user, token, limit, values_fields):
+    tasks = Task.all_objects.filter(user=user)
+    if token:
+        position = decode_sync_token(user, token)
+        # Tombstones archived since the token was issued are gone for good
+        if ArchivedTask.objects.filter(user=user, created_date__gt=position[0]).exists():
+            raise SyncTokenExpired()
+        tasks = tasks.filter(after_position(SYNC_ORDERING, position))
+    else:
+        # A first sync has nothing to delete
+        tasks = tasks.filter(deleted=False)
+
+    rows = list(tasks.order_by(*SYNC_ORDERING).values(*values_fields, 'created_date', 'deleted')[:limit + 1])
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    settled = timezone.now() - timedelta(seconds=settings.TASK_SYNC_GRACE_SECONDS)
+    if rows:
+        position = item_position(rows[-1], SYNC_ORDERING)
+        # A full page moves on regardless, or a burst of recent changes would repeat forever
+        if not has_more and rows[-1]['created_date'] > settled:
+            position = [settled.isoformat(), 0]
+        token = encode_sync_token(user, position)
+    elif not token:
+        token = encode_sync_token(user, [settled.isoformat(), 0])
+
+    changed = [row for row in rows if not row['deleted']]
+    deleted = [row['id'] for row in rows if row['deleted']]
+    return changed, deleted, token, has_more
@@ -1 +1,1395 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import re
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+from io import StringIO
+from pathlib import Path
+from tempfile import NamedTemporaryFile, TemporaryDirectory
+
+from unittest import mock, skipUnless
+
+from asgiref.sync import async_to_sync
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection, connections
+from django.db.models import Sum
+from django.test import AsyncClient, RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from tasks import metrics
+from tasks.api_views import TaskHistoryViewSet, TaskViewSet
+from tasks.authentication import SignedTokenAuthentication, issue_token, local_principals
+from tasks.cache import task_cache, version_key
+from tasks.counters import get_task_counters, recount_task_counters
+from tasks.events import DatabaseEventBackend, Event, EventBroker, broker
+from tasks.jobs import JobDefinition, claim_job, enqueue, registry, run_next_job
+from tasks.models import STATUS_CHOICES, Job, Task, TaskCounter, TaskHistory, TaskStatusRollup, UserShard
+from tasks.pagination import after_position, encode_cursor
+from tasks.renderers import FastJSONRenderer
+from tasks.routers import replica_reads
+from tasks.serializers import TaskHistorySerializer, TaskSerializer
+from tasks.services import QUERY_BUDGET, TaskService
+from tasks.shards import FROZEN, get_placement, shard_for_user
+from tasks.streams import task_events_app
+from tasks.sync import SYNC_ORDERING
+from tasks.views import (AuthorisedTaskManager, GenericCompleteTaskView,
+                         GenericPendingTaskView, GenericTaskView)
+
+
+# With TASK_DB_SHARDS set every test class still declares all databases, and
+# all but ShardingTests keep their users on 'default'
+unsharded = override_settings(TASK_SHARDS=['default'])
+
+
+# The request metrics of the test requests are dumped to a throwaway directory
+def setUpModule():
+    global metrics_dir, metrics_settings
+    metrics_dir = TemporaryDirectory()
+    metrics_settings = override_settings(TASK_METRICS_DIR=metrics_dir.name)
+    metrics_settings.enable()
+
+
+def tearDownModule():
+    metrics_settings.disable()
+    metrics_dir.cleanup()
+
+
+# Query plan regression tests, every hot queryset must be served by an index
+@unsharded
+class QueryPlanTests(TestCase):
+    databases = '__all__'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('planner', password='planner-password')
+        cls.task = Task.objects.create(title='QUERY PLAN TASK', description='', priority=1, user=cls.user)
+        TaskHistory.objects.create(task=cls.task, old_status='PENDING', new_status='COMPLETED')
+
+    def setUp(self):
+        if connection.vendor not in ('sqlite', 'postgresql'):
+            self.skipTest(f'No query plan checks for {connection.vendor}')
+        self.request = RequestFactory().get('/')
+        self.request.user = self.user
+
+    def assertIndexed(self, queryset):
+        if connection.vendor == 'postgresql':
+            # Tables are tiny in tests, make the planner prove an index is usable
+            with connection.cursor() as cursor:
+                cursor.execute('SET enable_seqscan = off')
+                try:
+                    plan = queryset.explain()
+                finally:
+                    cursor.execute('RESET enable_seqscan')
+            full_scan = re.compile(r'Seq Scan on (tasks_task|tasks_taskhistory)\b')
+        else:
+            plan = queryset.explain()
+            full_scan = re.compile(r'\bSCAN (tasks_task|tasks_taskhistory)\b')
+
+        self.assertIsNone(full_scan.search(plan), f'Full table scan in:\n{queryset.query}\n{plan}')
+
+    def view_queryset(self, view_class, **kwargs):
+        view = view_class()
+        view.request, view.kwargs = self.request, kwargs
+        return view.get_queryset()
+
+    def api_queryset(self, viewset_class, query=None, **kwargs):
+        viewset = viewset_class(action_map={'get': 'list'}, kwargs=kwargs, format_kwarg=None)
+        viewset.request = viewset.initialize_request(RequestFactory().get('/', query or {}))
+        viewset.request.user = self.user
+        return viewset.filter_queryset(viewset.get_queryset())
+
+    def test_authorised_task_manager(self):
+        self.assertIndexed(self.view_queryset(AuthorisedTaskManager))
+
+    def test_task_list_views(self):
+        for view_class in (GenericTaskView, GenericCompleteTaskView, GenericPendingTaskView):
+            with self.subTest(view=view_class.__name__):
+                self.assertIndexed(self.view_queryset(view_class))
+
+    def test_task_list_counts(self):
+        tasks = Task.objects.filter(deleted=False, user=self.user)
+        self.assertIndexed(tasks)
+        self.assertIndexed(tasks.filter(completed=True))
+
+    def test_task_viewset(self):
+        self.assertIndexed(self.api_queryset(TaskViewSet))
+        self.assertIndexed(self.api_queryset(TaskViewSet, {'completed': 'true', 'status': 'PENDING'}))
+
+    def test_task_search(self):
+        queryset = self.api_queryset(TaskViewSet, {'search': 'query pla', 'completed': 'false'})
+        self.assertIndexed(queryset)
+        # The search table is kept in sync by triggers, which schema changes must not lose
+        self.assertEqual(list(queryset.values_list('id', flat=True)), [self.task.id])
+
+    def test_task_search_follows_edits(self):
+        Task.objects.filter(pk=self.task.pk).update(title='RENAMED BY TRIGGER')
+        self.assertEqual(list(self.api_queryset(TaskViewSet, {'search': 'renamed'}).values_list('id', flat=True)), [self.task.id])
+        self.assertFalse(self.api_queryset(TaskViewSet, {'search': 'query pla'}).exists())
+
+    def test_task_history_viewset(self):
+        kwargs = {'task_id': str(self.task.id)}
+        self.assertIndexed(self.api_queryset(TaskHistoryViewSet, **kwargs))
+        self.assertIndexed(self.api_queryset(TaskHistoryViewSet, {'updated_date': 'week'}, **kwargs))
+
+    def test_priority_cascading(self):
+        tasks = Task.objects.filter(deleted=False, completed=False, user=self.user)
+        self.assertIndexed(tasks.filter(priority=1))
+
+    def test_task_sync(self):
+        position = [self.task.created_date, self.task.id]
+        tasks = Task.all_objects.filter(user=self.user).filter(after_position(SYNC_ORDERING, position))
+        self.assertIndexed(tasks.order_by(*SYNC_ORDERING))
+
+
+# Task counters move with every write and can be recounted after drift
+@unsharded
+class TaskCounterTests(TestCase):
+    databases = '__all__'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('counted', password='counted-password')
+        recount_task_counters(cls.user)
+
+    def assertCounters(self, total, completed):
+        counter = TaskCounter.objects.get(user=self.user)
+        self.assertEqual((counter.total, counter.completed), (total, completed))
+        # The same as counting the tasks
+        self.assertEqual(Task.objects.filter(user=self.user).count(), total)
+        self.assertEqual(Task.objects.filter(user=self.user, completed=True).count(), completed)
+
+    def test_writes(self):
+        service = TaskService(self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            first = service.create({'title': 'FIRST COUNTED TASK', 'description': 'x', 'priority': 1})
+            second = service.create({'title': 'SECOND COUNTED TASK', 'description': 'x', 'priority': 2,
+                                     'status': 'COMPLETED', 'completed': True})
+        self.assertCounters(2, 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            service.update(first, {'status': 'COMPLETED', 'completed': True})
+        self.assertCounters(2, 2)
+        with self.captureOnCommitCallbacks(execute=True):
+            service.update(second, {'title': 'SECOND RENAMED TASK', 'completed': False})
+        self.assertCounters(2, 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            service.delete(first)
+        self.assertCounters(1, 0)
+
+        client = APIClient()
+        client.force_authenticate(self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = client.post('/api/v1/tasks/batch/', {
+                'create': [{'title': 'BATCHED COUNTED TASK', 'description': 'x', 'priority': 1, 'status': 'COMPLETED', 'completed': True}],
+                'update': [{'id': second.id, 'completed': True}],
+            }, format='json')
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertCounters(2, 2)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = client.post('/api/v1/tasks/batch/', {'delete': [second.id]}, format='json')
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertCounters(1, 1)
+
+        # Only soft-deleted tasks are archived, they were uncounted already
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('archive_tasks', stdout=StringIO())
+        self.assertFalse(Task.all_objects.filter(pk__in=[first.pk, second.pk]).exists())
+        self.assertCounters(1, 1)
+
+    def test_recount(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            TaskService(self.user).create({'title': 'DRIFTED COUNTED TASK', 'description': 'x', 'priority': 1})
+        TaskCounter.objects.filter(user=self.user).update(total=5, completed=3)
+
+        stdout = StringIO()
+        call_command('recount_tasks', '--check', stdout=stdout)
+        self.assertIn('counted: (5, 3) -> (1, 0)', stdout.getvalue())
+        self.assertIn('1 drifted counter(s) found', stdout.getvalue())
+        self.assertEqual(TaskCounter.objects.get(user=self.user).total, 5)
+
+        stdout = StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('recount_tasks', 'counted', stdout=stdout)
+        self.assertIn('1 drifted counter(s) repaired', stdout.getvalue())
+        self.assertCounters(1, 0)
+
+        # The list pages show the repaired counts
+        self.client.force_login(self.user)
+        self.assertContains(self.client.get('/tasks'), '0 of 1 tasks completed')
+        call_command('recount_tasks', '--check', stdout=stdout)
+        self.assertIn('0 drifted counter(s) found', stdout.getvalue())
+
+
+# Keyset pages on (priority, id): stable under inserts, ties broken by id
+@unsharded
+class KeysetPaginationTests(TestCase):
+    databases = '__all__'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('paged', password='paged-password')
+        # Completed tasks keep their priority, several share one
+        for priority, completed in ((1, False), (2, True), (2, True), (2, True), (3, False), (4, False), (5, False)):
+            Task.objects.create(title=f'PAGED TASK {priority}', description='x', priority=priority, user=cls.user,
+                                status='COMPLETED' if completed else 'PENDING', completed=completed)
+        recount_task_counters(cls.user)
+        cls.ordered = list(Task.objects.filter(user=cls.user).order_by('priority', 'id').values_list('id', flat=True))
+
+    def setUp(self):
+        task_cache().clear()
+        self.api = APIClient()
+        self.api.force_authenticate(self.user)
+        self.client.force_login(self.user)
+
+    def api_page(self, url):
+        response = self.api.get(url)
+        self.assertEqual(response.status_code, 200, response.content)
+        data = response.json()
+        return [task['id'] for task in data['results']], data['next'], data['previous']
+
+    def test_api_pages(self):
+        pages, url = [], '/api/v1/tasks/?cursor=&limit=2'
+        while url:
+            ids, url, previous = self.api_page(url)
+            pages.append(ids)
+        self.assertEqual(sum(pages, []), self.ordered)
+        self.assertEqual([len(page) for page in pages], [2, 2, 2, 1])
+
+        # And back from the last page
+        back = []
+        while previous:
+            ids, _, previous = self.api_page(previous)
+            back.insert(0, ids)
+        self.assertEqual(back, pages[:-1])
+
+    def test_inserts_before_the_cursor(self):
+        first, next_url, _ = self.api_page('/api/v1/tasks/?cursor=&limit=2')
+        with self.captureOnCommitCallbacks(execute=True):
+            TaskService(self.user).create({'title': 'INSERTED AT THE TOP', 'description': 'x', 'priority': 1})
+        second, _, _ = self.api_page(next_url)
+        self.assertEqual(second, self.ordered[2:4])
+
+    def test_html_pages(self):
+        response = self.client.get('/tasks')
+        page = response.context['page_obj']
+        self.assertEqual(([task.id for task in page], page.number, page.num_pages), (self.ordered[:3], 1, 3))
+        self.assertContains(response, f'?cursor={page.next_cursor}')
+
+        response = self.client.get('/tasks', {'cursor': page.next_cursor})
+        page = response.context['page_obj']
+        self.assertEqual(([task.id for task in page], page.number), (self.ordered[3:6], 2))
+
+        response = self.client.get('/tasks', {'cursor': page.previous_cursor})
+        page = response.context['page_obj']
+        self.assertEqual(([task.id for task in page], page.number, page.has_previous()), (self.ordered[:3], 1, False))
+
+    def test_tampered_cursor(self):
+        cursors = ['not-a-cursor', encode_cursor([1]), encode_cursor('1'), encode_cursor([1, 2], False, 'x')]
+        for cursor in cursors:
+            with self.subTest(cursor=cursor):
+                self.assertEqual(self.api.get('/api/v1/tasks/', {'cursor': cursor}).status_code, 404)
+                self.assertEqual(self.client.get('/tasks', {'cursor': cursor}).status_code, 404)
+                self.assertEqual(self.client.get('/completed-tasks', {'cursor': cursor}).status_code, 404)
+
+
+# List endpoints build items from .values() rows, the bytes must match the serializers'
+@unsharded
+class ValuesListTests(TestCase):
+    databases = '__all__'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('lister', password='lister-password')
+        cls.tasks = [
+            Task.objects.create(title=f'Listed task {index}', description=f'Détail {index}', priority=index, user=cls.user)
+            for index in range(1, 4)
+        ]
+        TaskHistory.objects.create(task=cls.tasks[0], old_status='PENDING', new_status='IN_PROGRESS')
+        TaskHistory.objects.create(task=cls.tasks[0], old_status='IN_PROGRESS', new_status='COMPLETED')
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_task_list(self):
+        response = self.client.get('/api/v1/tasks/')
+        expected = TaskSerializer(Task.objects.filter(user=self.user).order_by('priority', 'id'), many=True).data
+        self.assertEqual(FastJSONRenderer().render(response.data['results']), FastJSONRenderer().render(expected))
+
+        for task in self.tasks:
+            detail = self.client.get(f'/api/v1/tasks/{task.pk}/')
+            self.assertEqual(FastJSONRenderer().render(detail.data), FastJSONRenderer().render(TaskSerializer(task).data))
+
+    def test_history_list(self):
+        with self.assertNumQueries(1):
+            response = self.client.get(f'/api/v1/task/{self.tasks[0].pk}/history/')
+        # In the view's (unspecified) order
+        history = TaskHistory.objects.filter(task__user=self.user, task=self.tasks[0]).select_related('task__user')
+        expected = TaskHistorySerializer(history, many=True).data
+        self.assertEqual(response.content, FastJSONRenderer().render(expected))
+
+
+# Batch writes are validated per item and applied all together, or not at all
+@unsharded
+class TaskBatchTests(TestCase):
+    databases = '__all__'
+    url = '/api/v1/tasks/batch/'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('batcher', password='batcher-password')
+        cls.first = Task.objects.create(title='FIRST BATCH TASK', description='', priority=1, user=cls.user)
+        cls.second = Task.objects.create(title='SECOND BATCH TASK', description='', priority=2, user=cls.user, status='COMPLETED', completed=True)
+        recount_task_counters(cls.user)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def post(self, data):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(self.url, data, format='json')
+
+    def test_batch(self):
+        response = self.post({
+            'create': [{'title': 'CREATED IN BATCH', 'description': 'From a batch', 'priority': 1}],
+            'update': [{'id': self.first.id, 'status': 'IN_PROGRESS'}],
+            'delete': [self.second.id],
+        })
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(response.json()['deleted'], [self.second.id])
+
+        # The created task took priority 1, the task there moved along
+        created = Task.objects.get(pk=response.json()['created'][0]['id'])
+        self.assertEqual((created.priority, Task.objects.get(pk=self.first.pk).priority), (1, 2))
+
+        # Deletes are soft, with their history and counters
+        self.assertTrue(Task.all_objects.get(pk=self.second.pk).deleted)
+        self.assertTrue(TaskHistory.objects.filter(task=self.second, old_status='COMPLETED', new_status='CANCELLED').exists())
+        self.assertTrue(TaskHistory.objects.filter(task=self.first, old_status='PENDING', new_status='IN_PROGRESS').exists())
+        counters = get_task_counters(self.user)
+        self.assertEqual((counters.total, counters.completed), (2, 0))
+
+    def test_errors_per_item_and_nothing_applied(self):
+        response = self.post({
+            'create': [{'title': 'CREATED IN BATCH', 'description': 'From a batch', 'priority': 1}, {'title': 'short'}],
+            'update': [{'id': self.first.id, 'status': 'DONE'}, {'id': [1]}, {'id': self.second.id, 'priority': 3}],
+            'delete': [self.second.id, {'id': 1}, True, 0],
+        })
+        self.assertEqual(response.status_code, 400)
+        errors = response.json()
+        self.assertEqual(errors['create'][0], {})
+        self.assertIn('title', errors['create'][1])
+        self.assertEqual(list(errors['update'][0]), ['status'])
+        self.assertEqual(errors['update'][1], {'id': ['A valid integer is required.']})
+        self.assertEqual(errors['update'][2], {'id': ['Task appears more than once in the batch.']})
+        self.assertEqual(errors['delete'], [
+            {},
+            {'id': ['A valid integer is required.']},
+            {'id': ['A valid integer is required.']},
+            {'id': ['Task not found.']},
+        ])
+
+        self.assertEqual(Task.objects.filter(user=self.user).count(), 2)
+        self.assertFalse(TaskHistory.objects.exists())
+
+    def test_body_must_be_an_object(self):
+        for body in ([self.first.id], 'delete', 1):
+            with self.subTest(body=body):
+                self.assertEqual(self.post(body).status_code, 400)
+
+
+# Reads are cached per user version and answer conditional GETs, writes move the version on
+@unsharded
+class CachedReadTests(TestCase):
+    databases = '__all__'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('cacher', password='cacher-password')
+        cls.task = Task.objects.create(title='CACHED READ TASK', description='', priority=1, user=cls.user)
+
+    def setUp(self):
+        # Ids come back between tests, versions must not
+        task_cache().clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_conditional_get(self):
+        for url in ('/api/v1/tasks/', f'/api/v1/tasks/{self.task.pk}/', f'/api/v1/task/{self.task.pk}/history/'):
+            with self.subTest(url=url):
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                etag = response['ETag']
+
+                with self.assertNumQueries(0):
+                    self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+                    cached = self.client.get(url)
+                self.assertEqual((cached.content, cached['ETag']), (response.content, etag))
+
+    def test_writes_invalidate(self):
+        urls = ('/api/v1/tasks/', f'/api/v1/task/{self.task.pk}/history/')
+        etags = {url: self.client.get(url)['ETag'] for url in urls}
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.patch(f'/api/v1/tasks/{self.task.pk}/', {'status': 'COMPLETED'}, format='json')
+        self.assertEqual(response.status_code, 200)
+
+        for url in urls:
+            with self.subTest(url=url):
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=etags[url])
+                self.assertEqual(response.status_code, 200)
+                self.assertNotEqual(response['ETag'], etags[url])
+                self.assertIn(b'COMPLETED', response.content)
+
+        # Another user's write leaves this user's responses alone
+        other = User.objects.create_user('other-cacher', password='cacher-password')
+        with self.captureOnCommitCallbacks(execute=True):
+            TaskService(other).create({'title': 'SOMEONE ELSES TASK', 'description': '', 'priority': 1})
+        etag = self.client.get(urls[0])['ETag']
+        self.assertEqual(self.client.get(urls[0], HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+    # A read between the version bump and the history write would cache stale history under the new version
+    def test_history_written_before_invalidation(self):
+        seen = []
+        changed = lambda user_id: seen.append(TaskHistory.objects.filter(task=self.task).count())
+        with mock.patch('tasks.cache.user_tasks_changed', changed), self.captureOnCommitCallbacks(execute=True):
+            TaskService(self.user).update(self.task, {'status': 'IN_PROGRESS'})
+        self.assertEqual(seen, [1])
+
+
+# Exports stream under the ASGI entry point too. The handler reads the body on
+# its own thread, which only sees committed rows.
+@unsharded
+class AsgiExportTests(TransactionTestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.user = User.objects.create_user('exporter', password='exporter-password')
+        self.task = Task.objects.create(title='EXPORTED OVER ASGI', description='Streamed', priority=1, user=self.user)
+
+    def request(self, path):
+        from task_manager.asgi import application
+
+        scope = {
+            'type': 'http', 'method': 'GET', 'path': path, 'query_string': b'',
+            'headers': [(b'host', b'testserver'), (b'authorization', f'Token {issue_token(self.user)}'.encode())],
+        }
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request'}
+
+        async def send(message):
+            messages.append(message)
+
+        async_to_sync(application)(scope, receive, send)
+        return messages
+
+    def test_export(self):
+        for export_format in ('ndjson', 'csv'):
+            with self.subTest(export_format=export_format):
+                messages = self.request(f'/api/v1/tasks/export/{export_format}/')
+                self.assertEqual(messages[0]['status'], 200)
+                # Closed with a final body message
+                self.assertFalse(messages[-1].get('more_body', False))
+                body = b''.join(message.get('body', b'') for message in messages[1:]).decode()
+                self.assertIn('EXPORTED OVER ASGI', body)
+
+
+# Bulk imports reject bad records and lines one by one, and resume after the last batch
+@unsharded
+class ImportTasksTests(TestCase):
+    databases = '__all__'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('importer', password='importer-password')
+
+    def test_bad_lines_rejected(self):
+        lines = [
+            json.dumps({'title': 'FIRST IMPORTED TASK', 'description': 'x', 'priority': 1}),
+            '{"title": "TRUNCATED',
+            '',
+            '[1]',
+            '"x"',
+            json.dumps({'title': 'short', 'description': 'x'}),
+            json.dumps({'title': 'SECOND IMPORTED TASK', 'description': 'x', 'priority': 1}),
+        ]
+        with NamedTemporaryFile('w', suffix='.ndjson') as source:
+            source.write('\n'.join(lines) + '\n')
+            source.flush()
+            stdout, stderr = StringIO(), StringIO()
+            with self.captureOnCommitCallbacks(execute=True):
+                call_command('import_tasks', source.name, '--user', 'importer', stdout=stdout, stderr=stderr)
+            self.assertIn('Imported 2 task(s), rejected 4', stdout.getvalue())
+            # Numbered by line
+            errors = stderr.getvalue()
+            self.assertIn('Record 2: invalid JSON', errors)
+            self.assertIn('Record 4: expected a JSON object', errors)
+            self.assertIn('Record 5: expected a JSON object', errors)
+            self.assertIn('Record 6: ', errors)
+            self.assertEqual(list(Task.objects.filter(user=self.user).order_by('priority').values_list('title', 'priority')),
+                             [('FIRST IMPORTED TASK', 1), ('SECOND IMPORTED TASK', 2)])
+
+            # A second run picks up after the last line
+            stdout = StringIO()
+            call_command('import_tasks', source.name, '--user', 'importer', stdout=stdout, stderr=StringIO())
+            self.assertIn('Resuming', stdout.getvalue())
+            self.assertIn('Imported 0 task(s), rejected 0', stdout.getvalue())
+            self.assertEqual(Task.objects.filter(user=self.user).count(), 2)
+
+
+# The async read endpoints authenticate like the DRF viewsets: session or API token
+@unsharded
+class AsyncReadTests(TestCase):
+    databases = '__all__'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('async-reader', password='async-reader-password')
+        cls.task = Task.objects.create(title='READ ASYNCHRONOUSLY', description='x', priority=1, user=cls.user)
+        TaskHistory.objects.create(task=cls.task, old_status='PENDING', new_status='IN_PROGRESS')
+
+    def get(self, client, url, **headers):
+        async def request():
+            return await client.get(url, **headers)
+        return async_to_sync(request)()
+
+    def test_token_and_session(self):
+        urls = ('/api/v1/async/tasks/', f'/api/v1/async/tasks/{self.task.pk}/', f'/api/v1/async/task/{self.task.pk}/history/')
+        token = AsyncClient()
+        session = AsyncClient()
+        session.force_login(self.user)
+        for url in urls:
+            with self.subTest(url=url):
+                response = self.get(token, url, authorization=f'Token {issue_token(self.user)}')
+                self.assertEqual(response.status_code, 200, response.content)
+                self.assertIn(b'READ ASYNCHRONOUSLY', response.content)
+                self.assertEqual(response.content, self.get(session, url).content)
+
+    def test_refused(self):
+        client = AsyncClient()
+        response = self.get(client, '/api/v1/async/tasks/')
+        self.assertEqual((response.status_code, response.json()['detail']), (403, 'Authentication credentials were not provided.'))
+
+        # The same answer as the viewset for a bad token
+        response = self.get(client, '/api/v1/async/tasks/', authorization='Token not-a-token')
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(response.json(), APIClient().get('/api/v1/tasks/', HTTP_AUTHORIZATION='Token not-a-token').json())
+
+
+# Ranked prefix search over titles and descriptions, combined with the other filters
+@unsharded
+class TaskSearchTests(TestCase):
+    databases = '__all__'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('searcher', password='searcher-password')
+        cls.deploy = Task.objects.create(title='DEPLOY THE DEPLOY SCRIPT', description='Deploy before lunch',
+                                         priority=1, user=cls.user)
+        cls.notes = Task.objects.create(title='WEEKLY PLANNING NOTES', priority=2, user=cls.user,
+                                        description='Agenda, hiring, budget, and whether to deploy the kubernetes upgrade')
+        cls.done = Task.objects.create(title='DEPLOYED LAST RELEASE', description='Shipped', priority=3, user=cls.user,
+                                       status='COMPLETED', completed=True)
+        other = User.objects.create_user('other-searcher', password='searcher-password')
+        cls.other = Task.objects.create(title='SOMEONE ELSES DEPLOY', description='Private', priority=1, user=other)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def search(self, **params):
+        response = self.client.get('/api/v1/tasks/', params)
+        self.assertEqual(response.status_code, 200, response.content)
+        return [task['id'] for task in response.json()['results']]
+
+    def test_rank_order(self):
+        # Most occurrences first, then the shorter document
+        self.assertEqual(self.search(search='deploy'), [self.deploy.id, self.done.id, self.notes.id])
+
+    def test_prefixes(self):
+        self.assertEqual(set(self.search(search='depl')), {self.deploy.id, self.notes.id, self.done.id})
+        self.assertEqual(self.search(search='plan week'), [self.notes.id])
+        self.assertEqual(self.search(search='planned'), [])
+
+    def test_description(self):
+        self.assertEqual(self.search(search='kubernetes'), [self.notes.id])
+        self.assertEqual(self.search(search='deploy lunch'), [self.deploy.id])
+
+    def test_filters(self):
+        self.assertEqual(self.search(search='depl', completed='true'), [self.done.id])
+        self.assertEqual(self.search(search='depl', completed='false'), [self.deploy.id, self.notes.id])
+        self.assertEqual(self.search(search='depl', status='COMPLETED'), [self.done.id])
+        self.assertEqual(self.search(search='kubernetes', status='COMPLETED'), [])
+
+    # FTS5 syntax in the query is searched for as words, never parsed
+    def test_special_characters(self):
+        expected = self.search(search='deploy')
+        for query in ['deploy"', '"deploy', 'deploy*', '-deploy', '^deploy', '(deploy)', 'deploy:', "deploy'; --"]:
+            with self.subTest(query=query):
+                self.assertEqual(self.search(search=query), expected)
+        self.assertEqual(self.search(search='deploy kubernetes'), [self.notes.id])
+        self.assertEqual(self.search(search='deploy OR lunch'), [])
+        self.assertEqual(self.search(search='NEAR(deploy lunch)'), [])
+        self.assertEqual(self.search(search='description:kubernetes'), [])
+        self.assertEqual(self.search(search='*'), [])
+        self.assertEqual(self.search(search='" OR "'), [])
+
+        # The owner column can't be searched across users
+        self.assertEqual(self.search(search=f'owner u{self.other.user_id} deploy'), [])
+        self.assertEqual(self.search(search=f'owner:u{self.other.user_id}'), [])
+
+
+# Compacted history keeps the transition counts the rollups are rebuilt from
+@unsharded
+class CompactHistoryTests(TestCase):
+    databases = '__all__'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('compactor', password='compactor-password')
+        cls.task = Task.objects.create(title='COMPACTED HISTORY TASK', description='x', priority=1, user=cls.user, status='IN_PROGRESS')
+        old = timezone.now() - timedelta(days=200)
+        for hours, old_status, new_status in ((0, 'COMPLETED', 'COMPLETED'), (1, 'COMPLETED', 'PENDING'), (2, 'PENDING', 'IN_PROGRESS')):
+            TaskHistory.objects.create(task=cls.task, old_status=old_status, new_status=new_status, updated_date=old + timedelta(hours=hours))
+
+    def transitions(self):
+        call_command('backfill_rollups', stdout=StringIO())
+        return dict(TaskStatusRollup.objects.values('status').annotate(total=Sum('transitions')).values_list('status', 'total'))
+
+    def test_compact_then_backfill(self):
+        before = self.transitions()
+        self.assertEqual(before, {'PENDING': 1, 'IN_PROGRESS': 1})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('compact_history', '--days', '30', stdout=StringIO())
+        self.assertFalse(TaskHistory.objects.filter(task=self.task).exists())
+        summary = self.task.history_summary
+        self.assertEqual((summary.transitions, summary.status_counts, summary.last_status),
+                         (2, {'PENDING': 1, 'IN_PROGRESS': 1}, 'IN_PROGRESS'))
+
+        self.assertEqual(self.transitions(), before)
+
+
+# List page fragments are cached per user, even when two users hold the same task version
+@unsharded
+class FragmentCacheTests(TestCase):
+    databases = '__all__'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user('alice', password='alice-password')
+        cls.bob = User.objects.create_user('bob', password='bob-password')
+        for priority in range(1, 6):
+            Task.objects.create(title=f'ALICE TASK {priority}', description='Hers', priority=priority,
+                                user=cls.alice, status='COMPLETED' if priority <= 3 else 'PENDING', completed=priority <= 3)
+        Task.objects.create(title='BOB ONLY TASK', description='His', priority=1, user=cls.bob)
+        recount_task_counters(cls.alice)
+        recount_task_counters(cls.bob)
+
+    def setUp(self):
+        task_cache().clear()
+        for user in (self.alice, self.bob):
+            task_cache().set(version_key(user.pk), 1, timeout=None)
+
+    def test_users_on_the_same_version(self):
+        self.client.force_login(self.alice)
+        response = self.client.get('/tasks')
+        self.assertContains(response, '3 of 5 tasks completed')
+        self.assertContains(response, 'Page 1 of 2')
+
+        self.client.force_login(self.bob)
+        response = self.client.get('/tasks')
+        self.assertContains(response, '0 of 1 tasks completed')
+        self.assertNotContains(response, 'Page 1 of 2')
+        self.assertNotContains(response, 'cursor=')
+
+
+# Server-Timing reports where a request spent its time
+@unsharded
+class RequestMetricsTests(TestCase):
+    databases = '__all__'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('timed', password='timed-password')
+        Task.objects.create(title='TIMED PAGE TASK', description='', priority=1, user=cls.user)
+
+    def server_timing(self, response):
+        return {
+            name: float(duration) for name, duration in re.findall(r'(\w+);dur=([\d.]+)', response['Server-Timing'])
+        }
+
+    @override_settings(TASK_METRICS_TOKEN='scraper-token')
+    def test_metrics_access(self):
+        self.client.get('/tasks')
+        metrics.registry.flush()
+        self.assertTrue(list(Path(settings.TASK_METRICS_DIR).glob('metrics-*.json')))
+
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer wrong-token').status_code, 403)
+        response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer scraper-token')
+        self.assertContains(response, 'task_manager_requests_total')
+
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        staff = User.objects.create_user('metrics-staff', password='staff-password', is_staff=True)
+        self.client.force_login(staff)
+        self.assertContains(self.client.get('/metrics'), 'task_manager_requests_total')
+
+    def test_page_render_timed(self):
+        task_cache().clear()
+        self.client.force_login(self.user)
+        for url in ('/tasks', '/completed-tasks', '/pending-tasks'):
+            with self.subTest(url=url):
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                self.assertGreater(self.server_timing(response)['render'], 0)
+
+
+# List reads go to a replica, a second SQLite file here with its own rows,
+# until the user writes and is pinned to the primary for TASK_DB_PIN_SECONDS
+@override_settings(TASK_DB_REPLICA_ALIAS='replica', TASK_DB_PIN_SECONDS=10)
+@unsharded
+class ReplicaRouterTests(TestCase):
+    # Takes in 'replica', added below for this class only
+    databases = '__all__'
+
+    @classmethod
+    def setUpClass(cls):
+        cls.replica_dir = TemporaryDirectory()
+        connections.settings['replica'] = {
+            **connections['default'].settings_dict,
+            'NAME': os.path.join(cls.replica_dir.name, 'replica.sqlite3'),
+        }
+        call_command('migrate', database='replica', verbosity=0)
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        connections['replica'].close()
+        del connections['replica']
+        del connections.settings['replica']
+        cls.replica_dir.cleanup()
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('replicated', password='replicated-password')
+        Task.objects.create(title='ON THE PRIMARY', description='x', priority=1, user=cls.user)
+        User.objects.using('replica').create(pk=cls.user.pk, username=cls.user.username)
+        Task.objects.using('replica').create(title='ON THE REPLICA', description='x', priority=1, user=cls.user)
+
+    def setUp(self):
+        task_cache().clear()
+        self.client.force_login(self.user)
+
+    def titles(self):
+        return list(Task.objects.filter(user=self.user).order_by('priority').values_list('title', flat=True))
+
+    def test_replica_reads(self):
+        with replica_reads(self.user):
+            self.assertEqual(self.titles(), ['ON THE REPLICA'])
+        self.assertEqual(self.titles(), ['ON THE PRIMARY'])
+        self.assertContains(self.client.get('/tasks'), 'ON THE REPLICA')
+
+    def test_pinned_to_primary_after_a_write(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            TaskService(self.user).create({'title': 'JUST WRITTEN', 'description': 'x', 'priority': 2})
+        with replica_reads(self.user):
+            self.assertEqual(self.titles(), ['ON THE PRIMARY', 'JUST WRITTEN'])
+        self.assertContains(self.client.get('/tasks'), 'JUST WRITTEN')
+
+        # Another user still reads from the replica
+        with replica_reads(User(pk=self.user.pk + 1)):
+            self.assertEqual(self.titles(), ['ON THE REPLICA'])
+
+        # Back on the replica once the pin expires
+        expired = time.time() + settings.TASK_DB_PIN_SECONDS + 1
+        with mock.patch('django.core.cache.backends.locmem.time.time', return_value=expired):
+            with replica_reads(self.user):
+                self.assertEqual(self.titles(), ['ON THE REPLICA'])
+
+
+# Soft-deleted tasks move to the archive tables, and stay readable through the archive API
+@unsharded
+class ArchiveTests(TestCase):
+    databases = '__all__'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('archivist', password='archivist-password')
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_archive_round_trip(self):
+        service = TaskService(self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            kept = service.create({'title': 'KEPT LIVE TASK', 'description': '', 'priority': 1})
+            gone = service.create({'title': 'ARCHIVED TASK', 'description': 'Old', 'priority': 2})
+        with self.captureOnCommitCallbacks(execute=True):
+            service.update(gone, {'status': 'IN_PROGRESS'})
+        with self.captureOnCommitCallbacks(execute=True):
+            service.delete(gone)
+
+        # Too recent for --days
+        call_command('archive_tasks', '--days', '1', stdout=StringIO())
+        self.assertTrue(Task.all_objects.filter(pk=gone.pk).exists())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('archive_tasks', stdout=StringIO())
+        self.assertFalse(Task.all_objects.filter(pk=gone.pk).exists())
+        self.assertFalse(TaskHistory.objects.filter(task_id=gone.pk).exists())
+        self.assertTrue(Task.objects.filter(pk=kept.pk).exists())
+
+        archived = self.client.get('/api/v1/archive/tasks/').json()['results']
+        self.assertEqual([(task['id'], task['title'], task['status']) for task in archived], [(gone.pk, 'ARCHIVED TASK', 'IN_PROGRESS')])
+        history = self.client.get(f'/api/v1/archive/tasks/{gone.pk}/history/').json()
+        self.assertEqual([(row['old_status'], row['new_status']) for row in history],
+                         [('PENDING', 'IN_PROGRESS'), ('IN_PROGRESS', 'CANCELLED')])
+
+        # Only to its owner
+        other = APIClient()
+        other.force_authenticate(User.objects.create_user('snoop', password='snoop-password'))
+        self.assertEqual(other.get(f'/api/v1/archive/tasks/{gone.pk}/').status_code, 404)
+
+
+# Signed API tokens: signature, revocation by generation, expiry
+@unsharded
+class SignedTokenTests(TestCase):
+    databases = '__all__'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('bearer', password='bearer-password')
+
+    def setUp(self):
+        task_cache().clear()
+        local_principals.clear()
+
+    def get_tasks(self, token):
+        return APIClient().get('/api/v1/tasks/', HTTP_AUTHORIZATION=f'Token {token}')
+
+    # 403 rather than 401, session authentication comes first and sends no challenge
+    def assertRejected(self, token, detail='Invalid token.'):
+        response = self.get_tasks(token)
+        self.assertEqual((response.status_code, response.json()['detail']), (403, detail))
+
+    def test_token(self):
+        response = APIClient().post('/api/v1/auth/token/', {'username': 'bearer', 'password': 'bearer-password'}, format='json')
+        token = response.json()['token']
+        self.assertEqual(self.get_tasks(token).status_code, 200)
+
+        # The principal is cached, checking a token takes no query
+        with self.assertNumQueries(0):
+            self.assertEqual(SignedTokenAuthentication().authenticate(
+                RequestFactory().get('/', HTTP_AUTHORIZATION=f'Token {token}')
+            )[0], self.user)
+
+        self.assertRejected(token[:-1] + ('a' if token[-1] != 'a' else 'b'))
+        self.assertRejected('not-a-token')
+        wrong = APIClient().post('/api/v1/auth/token/', {'username': 'bearer', 'password': 'wrong'}, format='json')
+        self.assertNotIn('token', wrong.json())
+
+    def test_revocation(self):
+        token = issue_token(self.user)
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Token {token}')
+        self.assertEqual(client.post('/api/v1/auth/token/revoke/').status_code, 204)
+
+        self.assertRejected(token)
+        self.assertEqual(self.get_tasks(issue_token(self.user)).status_code, 200)
+
+        # Deactivating the user drops the cached principal
+        token = issue_token(self.user)
+        self.user.is_active = False
+        self.user.save()
+        self.assertRejected(token)
+
+    def test_expiry(self):
+        issued = time.time() - settings.TASK_API_TOKEN_MAX_AGE - 60
+        with mock.patch('django.core.signing.time.time', return_value=issued):
+            token = issue_token(self.user)
+        self.assertRejected(token, 'Token expired.')
+
+
+# Every write stays within the query budget documented in tasks/services.py
+@unsharded
+class TaskServiceQueryBudgetTests(TestCase):
+    databases = '__all__'
+    transaction_control = re.compile(r'^(BEGIN|COMMIT|ROLLBACK|SAVEPOINT|RELEASE SAVEPOINT|ROLLBACK TO SAVEPOINT)\b')
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('budget', password='budget-password')
+        cls.task = Task.objects.create(title='QUERY BUDGET TASK', description='', priority=1, user=cls.user)
+        recount_task_counters(cls.user)
+        # Past the user's first transitions of the day, which also create the rollup rows
+        TaskStatusRollup.objects.bulk_create([
+            TaskStatusRollup(user=cls.user, day=timezone.localdate(), status=status) for status, _ in STATUS_CHOICES
+        ])
+
+    def setUp(self):
+        self.service = TaskService(self.user)
+
+    @contextmanager
+    def assertQueryBudget(self, budget):
+        with CaptureQueriesContext(connection) as captured, self.captureOnCommitCallbacks(execute=True):
+            yield
+        queries = [query['sql'] for query in captured if not self.transaction_control.match(query['sql'])]
+        self.assertLessEqual(len(queries), budget, 'Over the query budget:\n' + '\n'.join(queries))
+
+    def load_task(self):
+        return Task.objects.get(pk=self.task.pk)
+
+    def test_create(self):
+        with self.assertQueryBudget(QUERY_BUDGET['create']):
+            task = self.service.create({'title': 'BUDGETED CREATE', 'description': '', 'priority': 2})
+
+        self.assertEqual(task.user, self.user)
+        self.assertEqual(get_task_counters(self.user).total, 2)
+
+    def test_update(self):
+        task = self.load_task()
+        with self.assertQueryBudget(QUERY_BUDGET['update']):
+            self.service.update(task, {'priority': 1, 'status': 'COMPLETED', 'completed': True})
+
+        self.assertEqual(get_task_counters(self.user).completed, 1)
+        self.assertTrue(TaskHistory.objects.filter(task=task, old_status='PENDING', new_status='COMPLETED').exists())
+
+    def test_update_applied_by_form(self):
+        # A ModelForm applies the cleaned data to the instance before form_valid()
+        task = self.load_task()
+        task.status, task.completed = 'COMPLETED', True
+        with self.assertQueryBudget(QUERY_BUDGET['update']):
+            self.service.update(task, {'status': 'COMPLETED', 'completed': True})
+
+        self.assertEqual(get_task_counters(self.user).completed, 1)
+        self.assertEqual(TaskHistory.objects.filter(task=task).count(), 1)
+
+    def test_delete(self):
+        task = self.load_task()
+        with self.assertQueryBudget(QUERY_BUDGET['delete']):
+            self.assertEqual(self.service.delete(task), 1)
+
+        self.assertFalse(Task.objects.filter(pk=task.pk).exists())
+        self.assertEqual(get_task_counters(self.user).total, 0)
+        self.assertTrue(TaskHistory.objects.filter(task=task, new_status='CANCELLED').exists())
+
+    # The front ends load the task once, on top of the service's budget
+    def test_api_writes(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        url = f'/api/v1/tasks/{self.task.pk}/'
+        data = {'title': 'QUERY BUDGET TASK', 'description': 'x', 'priority': 1, 'status': 'IN_PROGRESS'}
+
+        with self.assertQueryBudget(1 + QUERY_BUDGET['update']):
+            self.assertEqual(client.put(url, data, format='json').status_code, 200)
+        with self.assertQueryBudget(1 + QUERY_BUDGET['delete']):
+            self.assertEqual(client.delete(url).status_code, 204)
+
+    def test_html_writes(self):
+        self.client.force_login(self.user)
+        data = {'title': 'QUERY BUDGET TASK', 'description': 'x', 'priority': 1, 'status': 'IN_PROGRESS'}
+        # Session and user lookups
+        overhead = 2
+
+        with self.assertQueryBudget(overhead + 1 + QUERY_BUDGET['update']):
+            self.assertEqual(self.client.post(f'/update-task/{self.task.pk}', data).status_code, 302)
+        with self.assertQueryBudget(overhead + 1 + QUERY_BUDGET['delete']):
+            self.assertEqual(self.client.post(f'/delete-task/{self.task.pk}').status_code, 302)
+        with self.assertQueryBudget(overhead + QUERY_BUDGET['create']):
+            self.assertEqual(self.client.post('/create-task', data).status_code, 302)
+
+
+# Delta sync returns what changed after the token, deletions as tombstones
+@override_settings(TASK_SYNC_GRACE_SECONDS=0)
+@unsharded
+class TaskSyncTests(TestCase):
+    databases = '__all__'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('syncer', password='syncer-password')
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def sync(self, **params):
+        response = self.client.get('/api/v1/tasks/sync/', params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_sync(self):
+        service = TaskService(self.user)
+        tasks = [
+            service.create({'title': f'SYNCED TASK {number}', 'description': '', 'priority': number})
+            for number in range(3)
+        ]
+
+        first = self.sync(limit=2)
+        self.assertEqual([task['id'] for task in first['changed']], [tasks[0].id, tasks[1].id])
+        self.assertTrue(first['has_more'])
+        second = self.sync(token=first['token'])
+        self.assertEqual([task['id'] for task in second['changed']], [tasks[2].id])
+        self.assertFalse(second['has_more'])
+
+        service.update(tasks[1], {'status': 'IN_PROGRESS'})
+        service.delete(tasks[2])
+        delta = self.sync(token=second['token'])
+        self.assertEqual([task['id'] for task in delta['changed']], [tasks[1].id])
+        self.assertEqual(delta['deleted'], [tasks[2].id])
+        self.assertEqual(self.sync(token=delta['token'])['changed'], [])
+
+    def test_invalid_token(self):
+        response = self.client.get('/api/v1/tasks/sync/', {'token': 'not-a-token'})
+        self.assertEqual(response.status_code, 400)
+
+
+# ?fields= trims both the representation and the selected columns
+@unsharded
+class SparseFieldsTests(TestCase):
+    databases = '__all__'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('sparse', password='sparse-password')
+        Task.objects.create(title='SPARSE FIELDS TASK', description='not selected', priority=1, user=cls.user)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_sparse_list(self):
+        with CaptureQueriesContext(connection) as captured:
+            response = self.client.get('/api/v1/tasks/', {'fields': 'id,title', 'cursor': ''})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(response.json()['results'][0]), ['id', 'title'])
+        self.assertFalse([query for query in captured if '"description"' in query['sql']])
+
+    def test_unknown_field(self):
+        self.assertEqual(self.client.get('/api/v1/tasks/', {'fields': 'id,secret'}).status_code, 400)
+
+
+# Status rollups follow the history writes and match a rebuild from it
+@unsharded
+class TaskStatusRollupTests(TestCase):
+    databases = '__all__'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('analyst', password='analyst-password')
+
+    def test_rollups(self):
+        service = TaskService(self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            first = service.create({'title': 'ROLLED UP TASK 1', 'description': '', 'priority': 1})
+            second = service.create({'title': 'ROLLED UP TASK 2', 'description': '', 'priority': 2})
+        with self.captureOnCommitCallbacks(execute=True):
+            service.update(first, {'status': 'IN_PROGRESS'})
+        with self.captureOnCommitCallbacks(execute=True):
+            service.update(first, {'status': 'COMPLETED', 'completed': True})
+            service.delete(second)
+
+        client = APIClient()
+        client.force_authenticate(self.user)
+        summary = client.get('/api/v1/analytics/rollups/summary/').json()
+        self.assertEqual(summary['status_counts'], {'CANCELLED': 1, 'COMPLETED': 1, 'IN_PROGRESS': 1})
+        self.assertEqual(summary['completions_per_day'], [{'day': str(timezone.localdate()), 'completions': 1}])
+        self.assertGreater(summary['average_completion_seconds'], 0)
+
+        rollups = lambda: list(TaskStatusRollup.objects.order_by('status').values_list('status', 'transitions', 'timed_completions'))
+        incremental = rollups()
+        call_command('backfill_rollups', stdout=StringIO())
+        self.assertEqual(rollups(), incremental)
+
+    # The initial history rows of an import keep the status, they are not transitions
+    def test_imported_history(self):
+        with NamedTemporaryFile('w', suffix='.ndjson') as source:
+            source.write(json.dumps({'title': 'IMPORTED COMPLETED TASK', 'description': 'x', 'priority': 1,
+                                     'status': 'COMPLETED', 'completed': True}) + '\n')
+            source.flush()
+            with self.captureOnCommitCallbacks(execute=True):
+                call_command('import_tasks', source.name, '--user', 'analyst', '--with-history', stdout=StringIO())
+
+        self.assertTrue(TaskHistory.objects.filter(task__user=self.user, old_status='COMPLETED', new_status='COMPLETED').exists())
+        self.assertFalse(TaskStatusRollup.objects.exists())
+        call_command('backfill_rollups', stdout=StringIO())
+        self.assertFalse(TaskStatusRollup.objects.exists())
+
+
+# Background jobs: key coalescing, retries, and work handed off by the writes
+@unsharded
+class JobQueueTests(TestCase):
+    databases = '__all__'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('worker', password='worker-password')
+        recount_task_counters(cls.user)
+
+    def setUp(self):
+        self.calls = []
+
+        def flaky(fail):
+            self.calls.append(fail)
+            if len(self.calls) <= fail:
+                raise RuntimeError('flaky job failed')
+
+        registry['test_flaky'] = JobDefinition(flaky, priority=0, max_attempts=2, atomic=False)
+        self.addCleanup(registry.pop, 'test_flaky')
+
+    def test_keys_coalesce_while_queued(self):
+        first = enqueue('recount_task_counters', {'user_id': self.user.pk}, key='recount')
+        self.assertEqual(enqueue('recount_task_counters', {'user_id': self.user.pk}, key='recount'), first)
+        self.assertEqual(claim_job('test-worker'), first)
+        # Running jobs don't count, they may have read their data already
+        self.assertNotEqual(enqueue('recount_task_counters', {'user_id': self.user.pk}, key='recount'), first)
+
+    def test_retries_with_backoff(self):
+        job = enqueue('test_flaky', {'fail': 1})
+        self.assertEqual(run_next_job('test-worker'), job)
+        job.refresh_from_db()
+        self.assertEqual((job.state, job.attempts), ('queued', 1))
+        self.assertIn('flaky job failed', job.last_error)
+        self.assertGreater(job.run_after, timezone.now())
+        self.assertIsNone(run_next_job('test-worker'))
+
+        Job.objects.filter(pk=job.pk).update(run_after=timezone.now())
+        run_next_job('test-worker')
+        job.refresh_from_db()
+        self.assertEqual((job.state, job.attempts), ('done', 2))
+
+        job = enqueue('test_flaky', {'fail': 5})
+        run_next_job('test-worker')
+        Job.objects.filter(pk=job.pk).update(run_after=timezone.now())
+        run_next_job('test-worker')
+        job.refresh_from_db()
+        self.assertEqual((job.state, job.attempts), ('failed', 2))
+
+    def test_priorities(self):
+        late = enqueue('test_flaky', {'fail': 0}, priority=5)
+        early = enqueue('test_flaky', {'fail': 0}, priority=1)
+        self.assertEqual(claim_job('test-worker'), early)
+        self.assertEqual(claim_job('test-worker'), late)
+
+    @override_settings(TASK_HISTORY_WRITE_BEHIND='job')
+    def test_history_handed_to_workers(self):
+        service = TaskService(self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            task = service.create({'title': 'HANDED OFF TASK', 'description': '', 'priority': 1})
+        with self.captureOnCommitCallbacks(execute=True):
+            service.update(task, {'status': 'COMPLETED', 'completed': True})
+        self.assertFalse(TaskHistory.objects.exists())
+        self.assertEqual(Job.objects.get().name, 'write_task_history')
+
+        task_cache().clear()
+        client = APIClient()
+        client.force_authenticate(self.user)
+        url = f'/api/v1/task/{task.pk}/history/'
+        etag = client.get(url)['ETag']
+
+        out = StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('run_workers', '--once', '--threads', '1', '--no-schedule', stdout=out)
+        self.assertIn('Ran 1 job(s)', out.getvalue())
+        # The cached history without the row is stale now
+        response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'COMPLETED', response.content)
+        history = TaskHistory.objects.get()
+        self.assertEqual((history.task, history.new_status), (task, 'COMPLETED'))
+        self.assertLess(history.updated_date, Job.objects.get().finished_date)
+        self.assertEqual(TaskStatusRollup.objects.get(user=self.user).timed_completions, 1)
+
+    def test_missing_counters_recounted_by_worker(self):
+        TaskCounter.objects.filter(user=self.user).delete()
+        with self.captureOnCommitCallbacks(execute=True):
+            TaskService(self.user).create({'title': 'UNCOUNTED TASK', 'description': '', 'priority': 1})
+        self.assertFalse(TaskCounter.objects.filter(user=self.user).exists())
+
+        run_next_job('test-worker')
+        self.assertEqual(TaskCounter.objects.get(user=self.user).total, 1)
+
+
+# Sharding needs more than one database:
+#   TASK_DB_SHARDS=shard1.sqlite3,shard2.sqlite3 python manage.py test tasks.tests.ShardingTests
+@skipUnless(len(settings.TASK_SHARDS) > 1, 'Set TASK_DB_SHARDS to test sharding')
+@override_settings(TASK_SHARD_FREEZE_SECONDS=0)
+class ShardingTests(TestCase):
+    databases = '__all__'
+
+    @classmethod
+    def setUpTestData(cls):
+        # Ids spread new users over the shards, the first one lands on shard_1
+        cls.user = User.objects.create_user('sharded', password='sharded-password')
+        while shard_for_user(cls.user) == 'default':
+            cls.user = User.objects.create_user(f'sharded-{cls.user.pk}', password='sharded-password')
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def create_task(self, title):
+        response = self.client.post('/api/v1/tasks/', {'title': title, 'description': 'On a shard', 'priority': 1}, format='json')
+        self.assertEqual(response.status_code, 201, response.content)
+        return response.json()['id']
+
+    def test_api_routes_to_the_users_shard(self):
+        shard = shard_for_user(self.user)
+        with self.captureOnCommitCallbacks(using=shard, execute=True):
+            task_id = self.create_task('SHARDED TASK')
+        with self.captureOnCommitCallbacks(using=shard, execute=True):
+            response = self.client.patch(f'/api/v1/tasks/{task_id}/', {'status': 'COMPLETED'}, format='json')
+        self.assertEqual(response.status_code, 200)
+
+        # Ids come from the shard's own range
+        self.assertEqual(task_id // settings.TASK_SHARD_ID_SPAN, settings.TASK_SHARDS.index(shard))
+        self.assertTrue(Task.objects.using(shard).filter(pk=task_id).exists())
+        self.assertFalse(Task.objects.using('default').filter(pk=task_id).exists())
+        self.assertEqual(TaskHistory.objects.using(shard).filter(task_id=task_id).count(), 1)
+        self.assertEqual([task['id'] for task in self.client.get('/api/v1/tasks/?search=sharded').json()['results']], [task_id])
+
+    # The export streams after the request is done, still from the user's shard
+    def test_export(self):
+        task_id = self.create_task('EXPORTED SHARDED TASK')
+        for export_format in ('ndjson', 'csv'):
+            with self.subTest(export_format=export_format):
+                response = self.client.get(f'/api/v1/tasks/export/{export_format}/')
+                self.assertIn(str(task_id), b''.join(response.streaming_content).decode())
+
+    # The async views resolve the shard and filter off the event loop
+    def test_async_search(self):
+        task_id = self.create_task('ASYNC SHARDED TASK')
+        client = AsyncClient()
+        client.force_login(self.user)
+        response = async_to_sync(client.get)('/api/v1/async/tasks/', {'search': 'async'})
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual([task['id'] for task in response.json()['results']], [task_id])
+
+    def test_rebalance_moves_the_user(self):
+        source = shard_for_user(self.user)
+        with self.captureOnCommitCallbacks(using=source, execute=True):
+            task_id = self.create_task('MOVING TASK')
+            self.client.patch(f'/api/v1/tasks/{task_id}/', {'status': 'COMPLETED'}, format='json')
+
+        out = StringIO()
+        call_command('rebalance_shards', self.user.username, '--to', 'default', stdout=out)
+        self.assertIn(f'moved from {source} to default', out.getvalue())
+
+        self.assertEqual(get_placement(self.user.pk).shard, 'default')
+        self.assertFalse(Task.all_objects.using(source).filter(user=self.user.pk).exists())
+        moved = Task.objects.using('default').get(pk=task_id)
+        self.assertEqual((moved.status, TaskHistory.objects.using('default').filter(task=moved).count()), ('COMPLETED', 1))
+
+        # A fresh request follows the user to the new shard
+        client = APIClient()
+        client.force_authenticate(User.objects.get(pk=self.user.pk))
+        self.assertEqual([task['id'] for task in client.get('/api/v1/tasks/').json()['results']], [task_id])
+
+    @override_settings(TASK_SHARD_FREEZE_SECONDS=2)
+    def test_frozen_user_cannot_write(self):
+        UserShard.objects.filter(user=self.user).update(state=FROZEN)
+        self.client.force_authenticate(User.objects.get(pk=self.user.pk))
+        response = self.client.post('/api/v1/tasks/', {'title': 'FROZEN TASK', 'description': 'On a shard', 'priority': 1}, format='json')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '2')
+        self.assertEqual(self.client.get('/api/v1/tasks/').status_code, 200)
+
+
+# Task change feed: resume, overflow and the ASGI stream itself
+@unsharded
+class TaskEventStreamTests(TestCase):
+    databases = '__all__'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('streamer', password='streamer-password')
+
+    def stream(self, last_event_id):
+        headers = [(b'authorization', f'Token {issue_token(self.user)}'.encode())]
+        if last_event_id:
+            headers.append((b'last-event-id', last_event_id.encode()))
+        scope = {'type': 'http', 'method': 'GET', 'path': '/api/v1/events/', 'query_string': b'', 'headers': headers}
+        messages = []
+
+        async def run():
+            opened = asyncio.Event()
+
+            async def receive():
+                if not messages:
+                    return {'type': 'http.request'}
+                await opened.wait()
+                return {'type': 'http.disconnect'}
+
+            async def send(message):
+                messages.append(message)
+                if message['type'] == 'http.response.body':
+                    opened.set()
+
+            await task_events_app(scope, receive, send)
+
+        async_to_sync(run)()
+        return messages[0]['status'], b''.join(message.get('body', b'') for message in messages[1:]).decode()
+
+    def test_resume_from_last_event_id(self):
+        service = TaskService(self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            task = service.create({'title': 'STREAMED TASK', 'description': '', 'priority': 1})
+        last_seen = broker.recent[-1].id
+        with self.captureOnCommitCallbacks(execute=True):
+            service.update(task, {'status': 'COMPLETED'})
+
+        status, body = self.stream(last_seen)
+        self.assertEqual(status, 200)
+        self.assertIn(f'id: {broker.recent[-1].id}\nevent: task.status\n', body)
+        self.assertNotIn('task.created', body)
+
+        status, body = self.stream('unknown-1')
+        self.assertIn('event: reset', body)
+
+    # Two web workers, each with its own broker, share the events through the database
+    def test_database_backend(self):
+        first, second = EventBroker(replay_size=10, queue_size=10), EventBroker(replay_size=10, queue_size=10)
+        publisher, reader = DatabaseEventBackend(first), DatabaseEventBackend(second)
+        publisher.load()
+        publisher.publish(self.user.pk, 'task.created', {'id': 1})
+        publisher.publish(self.user.pk, 'task.updated', {'id': 1})
+
+        # A worker starting later still replays what was published
+        reader.load()
+        self.assertEqual([(event.type, event.data) for event in second.recent], [('task.created', {'id': 1}), ('task.updated', {'id': 1})])
+        last_seen = second.recent[-1].id
+
+        reader.publish(self.user.pk, 'task.deleted', {'id': 1})
+        self.assertEqual((publisher.poll(), reader.poll()), (3, 1))
+        self.assertEqual([event.id for event in first.recent], [event.id for event in second.recent])
+        self.assertEqual([event.type for event in first.replay(self.user.pk, last_seen)], ['task.deleted'])
+
+    def test_slow_subscriber_overflows(self):
+        events = EventBroker(replay_size=10, queue_size=2)
+
+        async def run():
+            subscription, _ = events.subscribe(self.user.pk, asyncio.get_running_loop())
+            for sequence in range(1, 4):
+                events.deliver(Event('epoch', sequence, self.user.pk, 'task.updated', {}))
+            return subscription
+
+        subscription = async_to_sync(run)()
+        self.assertTrue(subscription.overflowed)
+        self.assertEqual(len(subscription.drain()), 2)
+        # The client resumes from the last event it received
+        self.assertEqual([event.sequence for event in events.replay(self.user.pk, 'epoch-2')], [3])
@@ -1,19 +1,25 @@
+from django.conf import settings
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.views import LoginView
 from django.forms import ModelForm, ValidationError
-from django.http import HttpResponseRedirect
+from django.http import Http404, HttpResponseRedirect
 from django.views.generic.detail import DetailView
 from django.views.generic.edit import CreateView, DeleteView, UpdateView
 from django.views.generic.list import ListView
 
-from tasks.api_views import TaskUtilityFunctions
+from tasks.cache import cached_response, get_user_version
+from tasks.counters import get_task_counters
+from tasks.metrics import timed
 from tasks.models import Task
+from tasks.pagination import paginate_keyset
+from tasks.routers import replica_reads
+from tasks.services import TaskService
 
 
 class AuthorisedTaskManager(LoginRequiredMixin):
     def get_queryset(self):
-        return Task.objects.filter(deleted=False, user=self.request.user)
+        return Task.objects.filter(user=self.request.user)
 
 class TaskCreateForm(ModelForm):
 
@@ -28,21 +34,14 @@ class TaskCreateForm(ModelForm):
         fields = ['title', 'description', 'priority', 'status', 'completed']
 
 
-class GenericTaskCreateView(LoginRequiredMixin, CreateView, TaskUtilityFunctions):
+class GenericTaskCreateView(LoginRequiredMixin, CreateView):
     form_class = TaskCreateForm
     template_name = 'task_create.html'
     extra_context = {'title': 'Create Todo'}
     success_url = '/tasks'
 
     def form_valid(self, form):
-        # Apply priority cascading logic
-        self.priority_cascading_logic(form.cleaned_data['priority'])
-        
-        # Save the task model
-        self.object = form.save()
-        self.object.user = self.request.user 
-        self.object.save()
-
+        self.object = TaskService(self.request.user).create(form.cleaned_data)
         return HttpResponseRedirect(self.get_success_url())
 
 
@@ -52,45 +51,26 @@ class GenericTaskDetailView(AuthorisedTaskManager, DetailView):
     extra_context = {'title': 'Task Details'}
 
 
-class GenericTaskUpdateView(AuthorisedTaskManager, UpdateView, TaskUtilityFunctions):
+class GenericTaskUpdateView(AuthorisedTaskManager, UpdateView):
     model = Task
     form_class = TaskCreateForm
     template_name = 'task_update.html'
     extra_context = {'title': 'Update Todo'}
     success_url = '/tasks'
 
+    # self.object was loaded by post(), TaskService reads its loaded values for the old state
     def form_valid(self, form):
-        # Get the current active task instance
-        task = self.get_object()
-
-        # Apply priority cascading logic
-        self.priority_cascading_logic(form.cleaned_data['priority'], task.id)
-
-        old_status = task.status
-        new_status = form.cleaned_data['status']
-
-        # Check for the status changes
-        if old_status != new_status:
-            self.create_task_history(task, old_status, new_status)
-        
-        return super().form_valid(form)
+        self.object = TaskService(self.request.user).update(self.object, form.cleaned_data)
+        return HttpResponseRedirect(self.get_success_url())
 
 
-class GenericTaskDeleteView(AuthorisedTaskManager, DeleteView, TaskUtilityFunctions):
+class GenericTaskDeleteView(AuthorisedTaskManager, DeleteView):
     model = Task
     template_name = 'task_delete.html'
     success_url = '/tasks'
 
     def form_valid(self, form):
-        task = self.get_object()
-        old_status = task.status
-        new_status = 'CANCELLED'
-
-        if old_status != new_status:
-            self.create_task_history(task, old_status, new_status)
-
-        Task.objects.filter(pk=task.id, user=self.request.user).update(deleted=True)
-
+        TaskService(self.request.user).delete(self.object)
         return HttpResponseRedirect(self.get_success_url())
 
 
@@ -105,42 +85,104 @@ class UserCreateView(CreateView):
     success_url = "/tasks"
 
 
-class GenericTaskView(LoginRequiredMixin, ListView):
-    template_name = 'tasks.html'
-    context_object_name = 'tasks'
-    paginate_by = 3
+# Versioned page cache with ETags, see tasks/cache.py
+class CachedPageMixin:
 
-    def get_queryset(self):
-        return Task.objects.filter(deleted=False, user=self.request.user).order_by('priority')
+    def get(self, request, *args, **kwargs):
+        return cached_response(request, lambda: super(CachedPageMixin, self).get(request, *args, **kwargs))
+
+
+# Page reads from the replica database unless the user just wrote, see
+# tasks/routers.py. Rendered here so the template's queries are routed too,
+# and timed like RequestMetricsMiddleware times the renders it runs.
+class ReplicaPageMixin:
+
+    def get(self, request, *args, **kwargs):
+        with replica_reads(request.user):
+            response = super().get(request, *args, **kwargs)
+            if hasattr(response, 'render'):
+                with timed('render'):
+                    response.render()
+        return response
+
+
+class TaskCountersMixin:
+    counted_field = 'total'
+
+    def get_task_counters(self):
+        if not hasattr(self, '_task_counters'):
+            self._task_counters = get_task_counters(self.request.user)
+        return self._task_counters
+
+    def get_task_count(self):
+        return getattr(self.get_task_counters(), self.counted_field)
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['completed_tasks_len'] = Task.objects.filter(completed=True, deleted=False, user=self.request.user).count()
-        context['total_tasks_len'] = Task.objects.filter(deleted=False, user=self.request.user).count()
+        counters = self.get_task_counters()
+        context['completed_tasks_len'] = counters.completed
+        context['total_tasks_len'] = counters.total
         return context
 
 
-class GenericCompleteTaskView(LoginRequiredMixin, ListView):
+# Fragment caching in the list templates: task cards are keyed on the task's
+# id and last change, the navigation and paginator on the user and their task
+# version (versions start from the clock, two users can hold the same one)
+class FragmentCacheMixin:
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['fragment_cache'] = settings.TASK_CACHE_ALIAS
+        context['fragment_timeout'] = settings.TASK_CACHE_TIMEOUT
+        context['tasks_version'] = get_user_version(self.request.user.pk)
+        return context
+
+
+# Keyset pages on (priority, id), page count comes from the task counters
+class KeysetPaginationMixin:
+    keyset_ordering = ('priority', 'id')
+    cursor_kwarg = 'cursor'
+
+    def paginate_queryset(self, queryset, page_size):
+        try:
+            page = paginate_keyset(
+                queryset,
+                self.keyset_ordering,
+                self.request.GET.get(self.cursor_kwarg),
+                page_size,
+                count=self.get_task_count(),
+            )
+        except ValueError:
+            raise Http404('Invalid cursor')
+        return (None, page, page.object_list, page.has_other_pages())
+
+
+class GenericTaskView(LoginRequiredMixin, CachedPageMixin, ReplicaPageMixin, FragmentCacheMixin, TaskCountersMixin, KeysetPaginationMixin, ListView):
+    template_name = 'tasks.html'
+    context_object_name = 'tasks'
+    paginate_by = 3
+
+    def get_queryset(self):
+        return Task.objects.filter(user=self.request.user).order_by('priority')
+
+
+class GenericCompleteTaskView(LoginRequiredMixin, CachedPageMixin, ReplicaPageMixin, FragmentCacheMixin, TaskCountersMixin, KeysetPaginationMixin, ListView):
     template_name = 'completed_tasks.html'
     context_object_name = 'completed_tasks'
     paginate_by = 3
+    counted_field = 'completed'
 
     def get_queryset(self):
-        return Task.objects.filter(completed=True, deleted=False, user=self.request.user).order_by('priority')
-
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
-        context['total_tasks_len'] = Task.objects.filter(deleted=False, user=self.request.user).count()
-        context['completed_tasks_len'] = Task.objects.filter(completed=True, deleted=False, user=self.request.user).count()
-        return context
+        return Task.objects.filter(completed=True, user=self.request.user).order_by('priority')
 
 
 class GenericPendingTaskView(GenericTaskView):
     template_name = 'pending_tasks.html'
     context_object_name = 'pending_tasks'
+    counted_field = 'pending'
 
     def get_queryset(self):
-        return Task.objects.filter(completed=False, deleted=False, user=self.request.user).order_by('priority')
+        return Task.objects.filter(completed=False, user=self.request.user).order_by('priority')
 
 
 def home_view(request):